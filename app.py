@@ -5,13 +5,70 @@ import socket
 import json
 import time
 import random
+import math
+import re
+import select
 import threading
 from threading import Lock
+import atexit
+import signal
+import _thread
 import subprocess
 from werkzeug.utils import secure_filename
+from werkzeug.wsgi import ClosingIterator
 import shutil
+import sqlite3
+import copy
+import hashlib
+import gzip
+import mimetypes
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed, wait as wait_futures, FIRST_COMPLETED
+from collections import namedtuple, deque, OrderedDict
+import itertools
+import heapq
+from queue import Queue, Empty
 from datetime import datetime
 
+try:
+    from jeepney import (DBusAddress, DBusErrorResponse, HeaderFields, MatchRule, Properties,
+                         message_bus, new_method_call)
+    from jeepney.io.threading import DBusRouter, open_dbus_connection
+    from jeepney.wrappers import unwrap_msg
+except ImportError:
+    # Optional: without jeepney the Wi-Fi endpoints fall back to spawning nmcli
+    open_dbus_connection = None
+
+try:
+    from PIL import Image, ImageOps, features as pil_features
+except ImportError:
+    # Optional: without Pillow photos are always served at full size
+    Image = None
+
+try:
+    import lgpio
+except ImportError:
+    # Optional: without lgpio relays are switched one pin at a time through gpiozero
+    lgpio = None
+
+try:
+    from smbus2 import SMBus
+except ImportError:
+    # Optional: without smbus2 relays on I2C expander boards cannot be driven
+    SMBus = None
+
+try:
+    import waitress
+except ImportError:
+    # Optional: without waitress the app runs on Flask's development server
+    waitress = None
+
+try:
+    import brotli
+except ImportError:
+    # Optional: without brotli static assets are precompressed with gzip only
+    brotli = None
+
 app = Flask(__name__)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -20,10 +77,129 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 def inject_system_name():
     """Provide system_name to all templates."""
     try:
-        return {"system_name": get_config().get("system_name", "Drinks Bro")}
+        return {"system_name": config_cache.get("system_name", "Drinks Bro")}
     except Exception:
         return {"system_name": "Drinks Bro"}
 
+# ----------------- STATIC ASSETS -----------------
+
+# Fingerprinted and precompressed at startup; everything else in static/ is served as-is
+STATIC_ASSET_EXTENSIONS = (".css", ".js")
+STATIC_BUILD_DIR = 'static_build'
+# Below this a compressed copy saves less than the headers cost
+STATIC_COMPRESS_MIN_SIZE = 1024
+STATIC_IMMUTABLE = "public, max-age=31536000, immutable"
+
+class StaticAssets:
+    """Content-hashed URLs for static/ css and js, with gzip/brotli copies built once.
+
+    "js/settings.js" is linked as "/static/js/settings.<hash>.js"; the hash changes whenever
+    the file does, so browsers may keep a fingerprinted URL forever. Compressed copies live
+    in STATIC_BUILD_DIR named by hash, so an unchanged file is not recompressed on restart.
+    Files stay in their directories, which keeps relative url()s in CSS working.
+    """
+
+    def __init__(self, static_dir, build_dir):
+        self.static_dir = static_dir
+        self.build_dir = build_dir
+        self.assets = {}  # logical path -> {"digest", "path", "variants": {encoding: path}}
+        self.fingerprints = {}  # fingerprinted path -> logical path
+
+    def build(self):
+        os.makedirs(self.build_dir, exist_ok=True)
+        assets, fingerprints, keep = {}, {}, set()
+        for root, _, files in os.walk(self.static_dir):
+            for name in sorted(files):
+                if not name.endswith(STATIC_ASSET_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                logical = os.path.relpath(path, self.static_dir).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()[:12]
+                base, ext = os.path.splitext(logical)
+                variants = {}
+                if len(data) >= STATIC_COMPRESS_MIN_SIZE:
+                    for encoding, suffix, compress in self._compressors():
+                        out = os.path.join(self.build_dir, f"{digest}{ext}{suffix}")
+                        if not os.path.exists(out):
+                            packed = compress(data)
+                            if len(packed) >= len(data):
+                                continue
+                            with open(out + ".tmp", "wb") as f:
+                                f.write(packed)
+                            os.replace(out + ".tmp", out)
+                        variants[encoding] = out
+                        keep.add(os.path.basename(out))
+                assets[logical] = {"digest": digest, "path": path, "variants": variants}
+                fingerprints[f"{base}.{digest}{ext}"] = logical
+        self.assets, self.fingerprints = assets, fingerprints
+        # Drop copies of files that have since changed
+        for name in os.listdir(self.build_dir):
+            if name not in keep:
+                try:
+                    os.remove(os.path.join(self.build_dir, name))
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _compressors():
+        # Preference order when the browser accepts both
+        if brotli is not None:
+            yield "br", ".br", lambda data: brotli.compress(data, quality=11)
+        yield "gzip", ".gz", lambda data: gzip.compress(data, compresslevel=9, mtime=0)
+
+    def url(self, logical):
+        """URL for a static file, fingerprinted when it is a built asset."""
+        asset = self.assets.get(logical)
+        if asset is None:
+            return f"/static/{logical}"
+        base, ext = os.path.splitext(logical)
+        return f"/static/{base}.{asset['digest']}{ext}"
+
+    def lookup(self, filename):
+        logical = self.fingerprints.get(filename)
+        return (logical, self.assets[logical]) if logical else (None, None)
+
+    def stats(self):
+        return {
+            "assets": len(self.assets),
+            "brotli": brotli is not None,
+            "compressed": {logical: sorted(a["variants"]) for logical, a in self.assets.items()},
+        }
+
+static_assets = StaticAssets(app.static_folder, STATIC_BUILD_DIR)
+try:
+    static_assets.build()
+except OSError as e:
+    # Read-only install: pages fall back to plain /static/ URLs
+    print(f"Static asset build failed: {e}")
+
+def serve_static(filename):
+    """Flask's static view, plus fingerprinted assets served immutable and precompressed."""
+    logical, asset = static_assets.lookup(filename)
+    if asset is None:
+        return app.send_static_file(filename)
+    encoding = request.accept_encodings.best_match(list(asset["variants"]))
+    path = asset["variants"][encoding] if encoding else asset["path"]
+    # Strong ETag per representation: the gzip and identity bytes differ
+    etag = f"{asset['digest']}-{encoding}" if encoding else asset["digest"]
+    # Name the file after the asset, not the hash-named compressed copy it is read from
+    response = send_file(os.path.abspath(path), mimetype=mimetypes.guess_type(logical)[0],
+                         download_name=os.path.basename(logical), etag=etag, conditional=True)
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["Cache-Control"] = STATIC_IMMUTABLE
+    return response
+
+app.view_functions["static"] = serve_static
+
+@app.context_processor
+def inject_asset_url():
+    """Provide asset_url() so templates link fingerprinted static files."""
+    return {"asset_url": static_assets.url}
+
 # Default relay configuration
 DEFAULT_RELAYS = [
     {"name": "Relay 1", "gpio": 26},
@@ -32,31 +208,6 @@ DEFAULT_RELAYS = [
     {"name": "Relay 4", "gpio": 20},
 ]
 
-relay_pins = {}
-
-# Add test locking mechanism
-test_lock = Lock()
-test_in_progress = False
-drink_progress = {
-    "active": False,
-    "drink_name": None,
-    "started_at": None,
-    "total_time": 0,
-    "expected_total": 0,
-    "current_step": 0,
-    "steps": 0,
-    "completed_time": 0.0,
-    "step_started_at": None,
-    "current_step_time": 0
-}
-self_test_progress = {
-    "active": False,
-    "relay": None,
-    "action": None,
-    "step": 0,
-    "steps": 0
-}
-
 # Constants
 DRINKS_CONFIG_FILE = "drinks.json"
 
@@ -124,24 +275,136 @@ def preflight_checks():
         return False, "Network check failed (no internet)"
     return True, "Preflight OK"
 
-# Initialize relay states
+# ----------------- RELAY STATE STORE -----------------
+
+RELAY_STATES_FILE = "relay_states.json"
+# Quiet period before a write-behind flush, and the longest a change may stay unflushed.
+RELAY_STATE_FLUSH_DELAY = 1.0
+RELAY_STATE_FLUSH_MAX_DELAY = 5.0
+
+class RelayStateStore:
+    """Authoritative in-memory relay states with coalesced write-behind to disk.
+
+    The hardware path updates the store directly; a background thread flushes
+    to relay_states.json once changes have settled, so a whole pour costs a
+    handful of writes instead of a load/save round trip per step.
+    """
+
+    def __init__(self, path, flush_delay=RELAY_STATE_FLUSH_DELAY, max_delay=RELAY_STATE_FLUSH_MAX_DELAY):
+        self.path = path
+        self.flush_delay = flush_delay
+        self.max_delay = max_delay
+        self.writes = 0
+        self._states = {}
+        self._dirty = False
+        self._last_change = 0.0
+        self._lock = Lock()
+        self._io_lock = Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        # Called as on_change(changes, removed) under the store lock, so deltas stay in order
+        self.on_change = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self._states = {str(k): bool(v) for k, v in data.items()}
+        except Exception:
+            self._states = {}
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._states)
+
+    def update(self, states):
+        with self._lock:
+            changes = {}
+            for name, value in states.items():
+                value = bool(value)
+                if name not in self._states or self._states[name] != value:
+                    self._states[name] = value
+                    changes[name] = value
+            if changes:
+                self._mark_dirty()
+                self._notify(changes)
+
+    def replace(self, states):
+        states = {name: bool(value) for name, value in states.items()}
+        with self._lock:
+            if states == self._states:
+                return
+            changes = {name: value for name, value in states.items() if self._states.get(name) != value}
+            removed = [name for name in self._states if name not in states]
+            self._states = states
+            self._mark_dirty()
+            self._notify(changes, removed)
+
+    def _notify(self, changes, removed=()):
+        # Caller holds self._lock
+        if self.on_change is None:
+            return
+        try:
+            self.on_change(changes, removed)
+        except Exception:
+            pass
+
+    def _mark_dirty(self):
+        # Caller holds self._lock
+        self._dirty = True
+        self._last_change = time.monotonic()
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._flush_loop, name="relay-state-flush", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def _flush_loop(self):
+        while True:
+            self._wake.wait()
+            first_change = time.monotonic()
+            # Debounce: wait for a quiet period, but never hold changes longer than max_delay
+            while True:
+                self._wake.clear()
+                with self._lock:
+                    quiet_for = time.monotonic() - self._last_change
+                waited = time.monotonic() - first_change
+                if quiet_for >= self.flush_delay or waited >= self.max_delay:
+                    break
+                self._wake.wait(min(self.flush_delay - quiet_for, self.max_delay - waited))
+            self.flush()
+
+    def flush(self):
+        """Write pending changes to disk now. Safe to call from any thread."""
+        with self._io_lock:
+            with self._lock:
+                if not self._dirty:
+                    return False
+                data = dict(self._states)
+                self._dirty = False
+            try:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self.path)
+                self.writes += 1
+                return True
+            except Exception:
+                with self._lock:
+                    self._dirty = True
+                return False
+
+relay_state_store = RelayStateStore(RELAY_STATES_FILE)
+atexit.register(relay_state_store.flush)
+
+# Turn every relay off, stopping any pour or test in progress
 def initialize_relay_states():
-    states = {relay: False for relay in relay_pins.keys()}
-    save_relay_states(states)
-    for relay in relay_pins.values():
-        relay.off()
+    relay_controller.call(AllOff(), timeout=5)
 
-# Load relay states from file
+# Load relay states (served from memory)
 def load_relay_states():
-    if not os.path.exists("relay_states.json"):
-        initialize_relay_states()
-    with open("relay_states.json", "r") as f:
-        return json.load(f)
-
-# Save relay states to file
-def save_relay_states(states):
-    with open("relay_states.json", "w") as f:
-        json.dump(states, f)
+    return relay_state_store.snapshot()
 
 # Load drinks configuration
 def load_drinks_config():
@@ -184,342 +447,2688 @@ def get_latest_version():
     with open("version.txt", "r") as f:
         return f.readline().strip()
 
-# Load configuration from config.json
-def get_config():
-    if not os.path.exists("config.json"):
-        default_config = {"system_name": "Drink Machine Controller"}
-        with open("config.json", "w") as f:
-            json.dump(default_config, f)
-    with open("config.json", "r") as f:
-        return json.load(f)
+# ----------------- EVENT STREAMS -----------------
 
-def save_config(config):
-    with open("config.json", "w") as f:
-        json.dump(config, f, indent=4)
+# Seconds between SSE keep-alive comments, so dead clients are noticed and proxies stay open
+SSE_KEEPALIVE = 15.0
+# Open event streams served at once. Each one holds a server thread for as long as its
+# page stays open, so this is a hard cap: further streams get 503 and retry later.
+# Override with config.json "request_lanes": {"stream": {"workers": N}}.
+SSE_MAX_CLIENTS = 16
 
-def get_relay_config():
-    config = get_config()
-    relays = config.get("relays")
-    if not isinstance(relays, list) or not relays:
-        return DEFAULT_RELAYS
-    cleaned = []
-    for idx, relay in enumerate(relays, start=1):
-        name = relay.get("name") or f"Relay {idx}"
-        try:
-            gpio = int(relay.get("gpio"))
-        except Exception:
-            gpio = DEFAULT_RELAYS[min(idx - 1, len(DEFAULT_RELAYS) - 1)]["gpio"]
-        cleaned.append({"name": name, "gpio": gpio})
-    return cleaned
+def sse_message(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
 
-def init_relay_pins():
-    global relay_pins
-    relay_pins = {}
-    for relay in get_relay_config():
-        relay_pins[relay["name"]] = OutputDevice(relay["gpio"], active_high=False)
+class EventChannel:
+    """Sequence-numbered broadcast of events to any number of SSE listeners.
 
-# Initialize relays on startup
-init_relay_pins()
+    Recent events are kept in a bounded history so a client reconnecting with
+    Last-Event-ID gets exactly what it missed; if that has already been
+    dropped (or the id is unknown) it gets a fresh `state` snapshot instead.
+    Listeners block on a condition variable rather than polling, but each one
+    still occupies a server thread while connected; the "stream" request lane
+    caps how many there are (SSE_MAX_CLIENTS).
+    """
 
-def relay_name_from_index(index):
-    relays = get_relay_config()
-    try:
-        idx = int(index) - 1
-    except Exception:
-        return f"Relay {index}"
-    if 0 <= idx < len(relays):
-        return relays[idx]["name"]
-    return f"Relay {index}"
-
-# Helper function to check NetworkManager status
-def check_networkmanager_status():
-    """Check if NetworkManager is properly configured."""
-    try:
-        # Check if NetworkManager service is running
-        nm_status = subprocess.run(
-            ["sudo", "systemctl", "is-active", "NetworkManager"],
-            capture_output=True,
-            text=True
-        )
-        
-        if nm_status.returncode != 0:
-            return False, "NetworkManager service not running"
-        
-        # Check if wifi radio is enabled
-        radio_status = subprocess.run(
-            ["nmcli", "radio", "wifi"],
-            capture_output=True,
-            text=True
-        )
-        
-        if "enabled" not in radio_status.stdout:
-            # Try to enable wifi radio
-            subprocess.run(["sudo", "nmcli", "radio", "wifi", "on"], capture_output=True)
-        
-        return True, "NetworkManager is ready"
-        
-    except Exception as e:
-        return False, f"Error checking NetworkManager: {str(e)}"
+    def __init__(self, history=256):
+        self.seq = 0
+        self.closed = False
+        self._events = deque(maxlen=history)
+        self._cond = threading.Condition()
 
-PHOTOS_FOLDER = 'photos/albums'
-PHOTO_LIB_JSON = 'photo_library.json'
+    def close(self):
+        """End every open stream (on shutdown); clients reconnect with Last-Event-ID."""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
 
-# USB mount locations to check
-USB_MOUNT_PATHS = [
-    '/mnt/usb',
-    '/media/pi', 
-    '/run/media/pi',
-    f'/media/{os.getenv("USER", "pi")}',
-    '/media/usb',
-    '/media/usb0',
-    '/media/usb1'
-]
+    def publish(self, event_type, data):
+        with self._cond:
+            self.seq += 1
+            self._events.append((self.seq, event_type, data))
+            self._cond.notify_all()
+            return self.seq
 
-def load_photo_library():
-    if not os.path.exists(PHOTO_LIB_JSON):
-        default_structure = {"folders": ["default"], "photos": {}}
-        save_photo_library(default_structure)
-    with open(PHOTO_LIB_JSON, "r") as f:
-        return json.load(f)
+    def oldest(self):
+        """Id of the oldest event still in the history (seq + 1 when it is empty)."""
+        with self._cond:
+            return self._events[0][0] if self._events else self.seq + 1
 
-def save_photo_library(data):
-    with open(PHOTO_LIB_JSON, "w") as f:
-        json.dump(data, f, indent=2)
+    def history(self):
+        with self._cond:
+            return list(self._events)
 
-def find_usb_mount():
-    """Find the first available USB mount point (including submounts)."""
-    # First, scan known mount roots
-    for path in USB_MOUNT_PATHS:
-        if not os.path.exists(path):
-            continue
+    def since(self, last_id):
+        """Events after last_id, or None if some of them are no longer in the history."""
+        with self._cond:
+            if last_id > self.seq:
+                return None
+            if self._events and last_id < self._events[0][0] - 1:
+                return None
+            if not self._events and last_id < self.seq:
+                return None
+            return [event for event in self._events if event[0] > last_id]
 
-        # If the path itself is a mount, use it.
-        if os.path.ismount(path):
-            try:
-                os.listdir(path)
-                return path
-            except PermissionError:
-                continue
+    def wait(self, last_id, timeout):
+        with self._cond:
+            if self.seq <= last_id and not self.closed:
+                self._cond.wait(timeout)
+        return self.since(last_id)
 
-        # If it's a directory, check its immediate subfolders for mounts (e.g., /media/pi/USB)
-        if os.path.isdir(path):
-            try:
-                for entry in os.listdir(path):
-                    subpath = os.path.join(path, entry)
-                    if os.path.ismount(subpath):
-                        try:
-                            os.listdir(subpath)
-                            return subpath
-                        except PermissionError:
-                            continue
-            except PermissionError:
+    def stream(self, last_event_id, snapshot, keepalive=SSE_KEEPALIVE):
+        """Generator of SSE text: replay or snapshot first, then live events."""
+        try:
+            last = int(last_event_id) if last_event_id not in (None, "") else None
+        except (TypeError, ValueError):
+            last = None
+        missed = self.since(last) if last is not None else None
+        if missed is None:
+            # Read seq before building the snapshot so nothing after it is lost
+            with self._cond:
+                last = self.seq
+            yield sse_message(last, "state", snapshot())
+        else:
+            for event in missed:
+                yield sse_message(*event)
+                last = event[0]
+        while not self.closed:
+            events = self.wait(last, keepalive)
+            if events is None:
+                # Fell too far behind the history; resynchronise from a snapshot
+                with self._cond:
+                    last = self.seq
+                yield sse_message(last, "state", snapshot())
+                continue
+            if not events:
+                yield ": keepalive\n\n"
                 continue
+            for event in events:
+                yield sse_message(*event)
+                last = event[0]
+        # Deliver whatever was published just before the channel closed
+        for event in self.since(last) or []:
+            yield sse_message(*event)
 
-    # Fallback: parse lsblk to discover removable USB mounts
-    try:
-        lsblk_result = subprocess.run(['lsblk', '-f'], capture_output=True, text=True)
-        for line in lsblk_result.stdout.splitlines():
-            if 'vfat' in line.lower() or 'exfat' in line.lower() or 'ntfs' in line.lower():
-                parts = line.split()
-                if parts:
-                    mountpoints = parts[-1:]
-                    for mp in mountpoints:
-                        if os.path.exists(mp) and os.path.ismount(mp):
-                            return mp
-    except Exception:
-        pass
+def sse_response(channel, snapshot):
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    return Response(
+        channel.stream(last_event_id, snapshot),
+        content_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    return None
+# Pour, order and self-test progress for /api/progress-stream
+progress_events = EventChannel()
 
-def get_image_files(directory):
-    """Get all image files from a directory"""
-    if not os.path.exists(directory):
-        return []
-    
-    image_extensions = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp'}
-    files = []
-    
-    try:
-        for filename in os.listdir(directory):
-            if any(filename.lower().endswith(ext) for ext in image_extensions):
-                file_path = os.path.join(directory, filename)
-                if os.path.isfile(file_path):
-                    files.append({
-                        'name': filename,
-                        'path': file_path,
-                        'size': os.path.getsize(file_path)
-                    })
-    except PermissionError:
-        pass
-    
-    return files
+# Relay state deltas for /api/relay-stream; consecutive ids let clients spot gaps
+relay_events = EventChannel()
 
-@app.route("/photo-library")
-def photo_library():
-    data = load_photo_library()
-    return render_template("photo_library.html", data=data)
+def publish_relay_changes(changes, removed):
+    data = {"changes": changes}
+    if removed:
+        data["removed"] = list(removed)
+    relay_events.publish("relay", data)
 
-@app.route("/api/photo-library/scan-usb", methods=["GET"])
-def scan_usb():
-    """Scan for USB drives"""
-    try:
-        usb_path = find_usb_mount()
-        
-        if usb_path:
-            # Check if there are any image files
-            image_files = get_image_files(usb_path)
-            
-            return jsonify({
-                'found': True,
-                'name': f'USB Drive ({os.path.basename(usb_path)})',
-                'path': usb_path,
-                'image_count': len(image_files)
-            })
-        else:
-            return jsonify({
-                'found': False,
-                'error': 'No mounted USB drive found',
-                'checked_paths': USB_MOUNT_PATHS
-            })
-            
-    except Exception as e:
-        return jsonify({
-            'found': False,
-            'error': f'Error scanning for USB: {str(e)}'
-        })
+relay_state_store.on_change = publish_relay_changes
 
-@app.route("/api/photo-library/list-usb", methods=["GET"])
-def list_usb_photos():
-    """List all photos on the USB drive"""
-    try:
-        usb_path = find_usb_mount()
-        
-        if not usb_path:
-            return jsonify({
-                'success': False,
-                'error': 'No USB drive found',
-                'photos': []
-            })
-        
-        photos = get_image_files(usb_path)
-        
-        return jsonify({
-            'success': True,
-            'photos': photos,
-            'usb_path': usb_path
-        })
-        
-    except Exception as e:
-        return jsonify({
-            'success': False,
-            'error': str(e),
-            'photos': []
-        })
+# ----------------- CONFIGURATION -----------------
 
-@app.route("/api/photo-library/usb-preview/<path:filename>", methods=["GET"])
-def usb_preview(filename):
-    """Serve USB photo previews"""
-    try:
-        usb_path = find_usb_mount()
-        if not usb_path:
-            return "USB not found", 404
+CONFIG_FILE = "config.json"
+DEFAULT_CONFIG = {"system_name": "Drink Machine Controller"}
 
-        file_path = os.path.normpath(os.path.join(usb_path, filename))
-        if not os.path.exists(file_path) or not os.path.isfile(file_path):
-            return "File not found", 404
-            
-        return send_file(file_path)
-        
-    except Exception as e:
-        return f"Error: {str(e)}", 500
+# Output drivers a relay can sit on: onboard GPIO, an MCP23017 I2C expander, or in-memory
+RELAY_DRIVERS = ("gpio", "mcp23017", "mock")
+MAX_RELAYS = 64
+MCP23017_DEFAULT_BUS = 1
+MCP23017_ADDRESSES = range(0x20, 0x28)
 
-@app.route("/photos/albums/<path:filename>")
-def serve_saved_photo(filename):
-    """Serve saved photos from the local library."""
-    try:
-        file_path = os.path.normpath(os.path.join(PHOTOS_FOLDER, filename))
-        if not os.path.exists(file_path) or not os.path.isfile(file_path):
-            return "File not found", 404
-        return send_file(file_path)
-    except Exception as e:
-        return f"Error: {str(e)}", 500
+# Validated relay entry; index is the 1-based position used by drink steps. `gpio` is the
+# BCM pin for onboard relays and the expander pin (0-15) for mcp23017 relays, whose
+# expander is identified by I2C `bus` and `address`.
+RelayConfig = namedtuple("RelayConfig", ["index", "name", "gpio", "driver", "bus", "address"],
+                         defaults=("gpio", None, None))
 
-@app.route("/api/photo-library/list-saved", methods=["GET"])
-def list_saved_photos():
-    """List all saved photos with URLs."""
+def _config_int(value, what, name):
+    """int() that also takes "0x20"-style strings; raises ValueError naming the field."""
     try:
-        data = load_photo_library()
-        photos = []
-        for filename, folder in data.get("photos", {}).items():
-            photos.append({
-                "name": filename,
-                "folder": folder,
-                "url": f"/photos/albums/{folder}/{filename}"
-            })
-        return jsonify({"success": True, "photos": photos, "folders": data.get("folders", [])})
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e), "photos": []})
+        return int(value, 0) if isinstance(value, str) else int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"Invalid {what} for {name}")
 
-@app.route("/api/photo-library/import-usb", methods=["POST"])
-def import_photos_usb():
-    """Import selected photos from USB"""
-    try:
-        folder = request.json.get('folder', 'default')
-        selected_photos = request.json.get('photos', [])
-        
-        if not selected_photos:
-            return jsonify({"success": False, "error": "No photos selected"})
-        
-        usb_path = find_usb_mount()
-        if not usb_path:
-            return jsonify({"success": False, "error": "USB drive not found"})
-        
-        data = load_photo_library()
-        
-        # Ensure folder exists
-        if folder not in data["folders"]:
-            data["folders"].append(folder)
-        
-        folder_path = os.path.join(PHOTOS_FOLDER, folder)
-        os.makedirs(folder_path, exist_ok=True)
-        os.chmod(folder_path, 0o775)
-        
-        imported = []
-        errors = []
-        
-        for photo_name in selected_photos:
-            try:
-                src = os.path.join(usb_path, photo_name)
-                if not os.path.exists(src):
-                    errors.append(f"File not found: {photo_name}")
-                    continue
-                
-                safe_filename = secure_filename(photo_name)
-                dest = os.path.join(folder_path, safe_filename)
-                
-                # Copy file
-                shutil.copy2(src, dest)
-                os.chmod(dest, 0o664)
-                
-                # Update library
-                data["photos"][safe_filename] = folder
-                imported.append(safe_filename)
-                
+def clean_relay_entry(idx, relay):
+    """Validate one raw relay entry into a RelayConfig; raises ValueError."""
+    if not isinstance(relay, dict):
+        raise ValueError(f"Relay {idx} is not an object")
+    name = str(relay.get("name") or "").strip() or f"Relay {idx}"
+    driver = str(relay.get("driver") or "gpio").lower()
+    if driver == "gpio":
+        return RelayConfig(idx, name, _config_int(relay.get("gpio"), "GPIO", name))
+    if driver == "mock":
+        return RelayConfig(idx, name, idx, "mock")
+    if driver != "mcp23017":
+        raise ValueError(f"Unknown driver {driver!r} for {name}")
+    pin = _config_int(relay.get("pin"), "expander pin", name)
+    if not 0 <= pin <= 15:
+        raise ValueError(f"Expander pin for {name} must be 0-15")
+    bus = _config_int(relay.get("bus", MCP23017_DEFAULT_BUS), "I2C bus", name)
+    address = _config_int(relay.get("address", MCP23017_ADDRESSES[0]), "I2C address", name)
+    if address not in MCP23017_ADDRESSES:
+        raise ValueError(f"I2C address for {name} must be 0x20-0x27")
+    return RelayConfig(idx, name, pin, "mcp23017", bus, address)
+
+def relay_config_entry(relay):
+    """The config.json / API form of a RelayConfig."""
+    if relay.driver == "mcp23017":
+        return {"name": relay.name, "driver": relay.driver, "bus": relay.bus,
+                "address": relay.address, "pin": relay.gpio}
+    if relay.driver == "mock":
+        return {"name": relay.name, "driver": relay.driver}
+    return {"name": relay.name, "gpio": relay.gpio}
+
+def relay_group_key(relay):
+    """Relays sharing a key sit on the same output device and are written together."""
+    return (relay.driver, relay.bus, relay.address)
+
+def parse_relay_config(config):
+    """Validate the relay list from config into an immutable tuple of RelayConfig.
+
+    Lenient, as config.json may be hand edited: a bad entry becomes an onboard relay on
+    its default pin and a repeated name gets its index appended.
+    """
+    relays = config.get("relays")
+    if not isinstance(relays, list) or not relays:
+        relays = DEFAULT_RELAYS
+    cleaned = []
+    seen = set()
+    for idx, relay in enumerate(relays[:MAX_RELAYS], start=1):
+        try:
+            entry = clean_relay_entry(idx, relay)
+        except ValueError:
+            name = (relay.get("name") if isinstance(relay, dict) else None) or f"Relay {idx}"
+            entry = RelayConfig(idx, name, DEFAULT_RELAYS[min(idx - 1, len(DEFAULT_RELAYS) - 1)]["gpio"])
+        if entry.name in seen:
+            entry = entry._replace(name=f"{entry.name} ({idx})")
+        seen.add(entry.name)
+        cleaned.append(entry)
+    return tuple(cleaned)
+
+class RelayRegistry:
+    """The configured relays, addressed in O(1) by 1-based index or by name.
+
+    Iterates, indexes (0-based) and measures like the tuple it wraps. `groups` maps each
+    output device (see relay_group_key) to its relays in config order.
+    """
+
+    def __init__(self, relays=()):
+        self.relays = tuple(relays)
+        self.names = tuple(relay.name for relay in self.relays)
+        self.by_name = {relay.name: relay for relay in self.relays}
+        groups = {}
+        for relay in self.relays:
+            groups.setdefault(relay_group_key(relay), []).append(relay)
+        self.groups = {key: tuple(members) for key, members in groups.items()}
+
+    def __len__(self):
+        return len(self.relays)
+
+    def __iter__(self):
+        return iter(self.relays)
+
+    def __getitem__(self, idx):
+        return self.relays[idx]
+
+    def __contains__(self, name):
+        return name in self.by_name
+
+    def at(self, index):
+        """RelayConfig for a 1-based index, or None."""
+        if isinstance(index, int) and 1 <= index <= len(self.relays):
+            return self.relays[index - 1]
+        return None
+
+    def resolve(self, ref):
+        """RelayConfig for a 1-based index or a name, or None."""
+        if isinstance(ref, int) and not isinstance(ref, bool):
+            return self.at(ref)
+        if isinstance(ref, str):
+            return self.by_name.get(ref)
+        return None
+
+class ConfigCache:
+    """Parsed config.json, reloaded only when the file's mtime/size change.
+
+    `loads` counts file parses and `checks` counts stat validations, so callers
+    can confirm that hot paths do no config I/O at all.
+    """
+
+    def __init__(self, path, default=None):
+        self.path = path
+        self.default = default or {}
+        self.loads = 0
+        self.checks = 0
+        self._lock = Lock()
+        self._signature = None
+        self._data = {}
+        self.relays = RelayRegistry()
+
+    def _stat_signature(self):
+        self.checks += 1
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _write(self, data, indent=None):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=indent)
+        os.replace(tmp_path, self.path)
+
+    def _apply(self, data, signature):
+        self._data = data
+        self._signature = signature
+        self.relays = RelayRegistry(parse_relay_config(data))
+
+    def refresh(self):
+        """Reload from disk if the file changed since the last parse."""
+        with self._lock:
+            signature = self._stat_signature()
+            if signature is None:
+                self._write(self.default)
+                signature = self._stat_signature()
+            if signature == self._signature:
+                return
+            with open(self.path, "r") as f:
+                data = json.load(f)
+            self.loads += 1
+            self._apply(data if isinstance(data, dict) else {}, signature)
+
+    def get(self, key, default=None):
+        self.refresh()
+        return self._data.get(key, default)
+
+    def data(self):
+        """Return a private copy of the full config for read-modify-write callers."""
+        self.refresh()
+        return copy.deepcopy(self._data)
+
+    def save(self, data):
+        """Write through the cache: persist to disk and adopt without re-parsing."""
+        with self._lock:
+            self._write(data, indent=4)
+            self._apply(copy.deepcopy(data), self._stat_signature())
+
+    def stats(self):
+        return {"loads": self.loads, "checks": self.checks, "relays": len(self.relays)}
+
+config_cache = ConfigCache(CONFIG_FILE, DEFAULT_CONFIG)
+
+# Load configuration from config.json (cached, reloaded on change)
+def get_config():
+    return config_cache.data()
+
+def save_config(config):
+    config_cache.save(config)
+
+def get_relay_config():
+    config_cache.refresh()
+    return [relay_config_entry(relay) for relay in config_cache.relays]
+
+# ----------------- RELAY BACKENDS -----------------
+
+RELAY_BACKEND_DEFAULT = "auto"
+RELAY_BACKENDS = ("auto", "lgpio", "gpiozero", "mock")
+RELAY_GPIOCHIP_DEFAULT = 0
+
+class RelayBackend:
+    """Drives a fixed set of relay outputs; `write` applies {name: on} together.
+
+    Counts writes and records the skew of each one: the time from the first output
+    changing to the last, which is what shows up as a visible stagger across relays.
+    """
+
+    name = None
+
+    def __init__(self):
+        self.writes = 0
+        self.pin_writes = 0
+        self.last_skew = 0.0
+        self.max_skew = 0.0
+
+    def _record(self, pins, skew):
+        self.writes += 1
+        self.pin_writes += pins
+        self.last_skew = skew
+        self.max_skew = max(self.max_skew, skew)
+
+    def stats(self):
+        return {
+            "backend": self.name,
+            "writes": self.writes,
+            "pin_writes": self.pin_writes,
+            "last_skew_us": round(self.last_skew * 1e6, 1),
+            "max_skew_us": round(self.max_skew * 1e6, 1),
+        }
+
+class GpiozeroRelayBackend(RelayBackend):
+    """One gpiozero OutputDevice per relay, switched one after another; works on any pin factory."""
+
+    name = "gpiozero"
+
+    def __init__(self):
+        super().__init__()
+        self._devices = {}
+
+    def open(self, relays):
+        for relay in relays:
+            self._devices[relay.name] = OutputDevice(relay.gpio, active_high=False)
+
+    def write(self, states):
+        started = time.perf_counter()
+        for name, on in states.items():
+            if on:
+                self._devices[name].on()
+            else:
+                self._devices[name].off()
+        self._record(len(states), time.perf_counter() - started if len(states) > 1 else 0.0)
+
+    def close(self):
+        for device in self._devices.values():
+            try:
+                device.off()
+                device.close()
+            except Exception:
+                pass
+        self._devices = {}
+
+class LgpioRelayBackend(RelayBackend):
+    """All relays claimed as one lgpio output group and written with a single group_write.
+
+    The kernel sets every line in the mask in one request, so relays switched together
+    change together. Lines are claimed active-low to match the relay boards.
+    """
+
+    name = "lgpio"
+
+    def __init__(self, chip=RELAY_GPIOCHIP_DEFAULT):
+        super().__init__()
+        self.chip = chip
+        self._handle = None
+        self._leader = None
+        self._bits = {}
+
+    def open(self, relays):
+        self._handle = lgpio.gpiochip_open(self.chip)
+        gpios = [relay.gpio for relay in relays]
+        if gpios:
+            lgpio.group_claim_output(self._handle, gpios, [0] * len(gpios), lgpio.SET_ACTIVE_LOW)
+            self._leader = gpios[0]
+        self._bits = {relay.name: 1 << idx for idx, relay in enumerate(relays)}
+
+    def write(self, states):
+        bits = mask = 0
+        for name, on in states.items():
+            mask |= self._bits[name]
+            if on:
+                bits |= self._bits[name]
+        if mask:
+            lgpio.group_write(self._handle, self._leader, bits, mask)
+        self._record(len(states), 0.0)
+
+    def close(self):
+        if self._handle is None:
+            return
+        try:
+            if self._leader is not None:
+                lgpio.group_write(self._handle, self._leader, 0)
+                lgpio.group_free(self._handle, self._leader)
+        finally:
+            lgpio.gpiochip_close(self._handle)
+            self._handle = self._leader = None
+
+class MockRelayBackend(RelayBackend):
+    """In-memory relays for tests and timing without a Pi.
+
+    `pin_delay` simulates the cost of one output change. With bank=True a write costs
+    one delay and all levels change at once; with bank=False each pin costs one delay
+    and changes in turn, like the per-pin loop. `history` keeps recent writes as
+    (time.monotonic(), {name: on}) with one entry per simultaneous change.
+    """
+
+    name = "mock"
+
+    def __init__(self, bank=True, pin_delay=0.0):
+        super().__init__()
+        self.bank = bank
+        self.pin_delay = pin_delay
+        self.levels = {}
+        self.history = deque(maxlen=256)
+
+    def open(self, relays):
+        self.levels = {relay.name: False for relay in relays}
+
+    def write(self, states):
+        for name in states:
+            if name not in self.levels:
+                raise KeyError(name)
+        if self.bank:
+            if self.pin_delay:
+                time.sleep(self.pin_delay)
+            self.levels.update(states)
+            self.history.append((time.monotonic(), dict(states)))
+            self._record(len(states), 0.0)
+            return
+        first = None
+        for name, on in states.items():
+            if self.pin_delay:
+                time.sleep(self.pin_delay)
+            self.levels[name] = on
+            now = time.monotonic()
+            first = first if first is not None else now
+            self.history.append((now, {name: on}))
+        self._record(len(states), (now - first) if states else 0.0)
+
+    def close(self):
+        self.levels = {name: False for name in self.levels}
+
+# MCP23017 registers with IOCON.BANK=0 (the power-on default), where the port B register
+# follows port A so one block write sets both
+MCP23017_IODIRA = 0x00
+MCP23017_OLATA = 0x14
+
+class Mcp23017RelayBackend(RelayBackend):
+    """Relays on one MCP23017 16-pin I2C expander; pins 0-7 are port A, 8-15 port B.
+
+    The output latch is kept in memory and every write is a single I2C block write of
+    both ports, however many of the expander's relays change. Active-low, like the
+    onboard relays.
+    """
+
+    name = "mcp23017"
+
+    def __init__(self, bus=MCP23017_DEFAULT_BUS, address=MCP23017_ADDRESSES[0]):
+        super().__init__()
+        self.bus = bus
+        self.address = address
+        self.transactions = 0
+        self._smbus = None
+        self._bits = {}
+        self._latch = 0xFFFF
+
+    def _write_ports(self, register, value):
+        self._smbus.write_i2c_block_data(self.address, register, [value & 0xFF, value >> 8])
+        self.transactions += 1
+
+    def open(self, relays):
+        if SMBus is None:
+            raise RuntimeError("smbus2 is required for mcp23017 relays")
+        self._smbus = SMBus(self.bus)
+        self._bits = {relay.name: 1 << relay.gpio for relay in relays}
+        used = 0
+        for bit in self._bits.values():
+            used |= bit
+        # Latch "off" before turning the pins into outputs so no relay clicks on at startup
+        self._latch = 0xFFFF
+        self._write_ports(MCP23017_OLATA, self._latch)
+        low, high = self._smbus.read_i2c_block_data(self.address, MCP23017_IODIRA, 2)
+        self._write_ports(MCP23017_IODIRA, (low | high << 8) & ~used)
+
+    def write(self, states):
+        latch = self._latch
+        for name, on in states.items():
+            bit = self._bits[name]
+            latch = latch & ~bit if on else latch | bit
+        if latch != self._latch:
+            self._write_ports(MCP23017_OLATA, latch)
+            self._latch = latch
+        self._record(len(states), 0.0)
+
+    def close(self):
+        if self._smbus is None:
+            return
+        try:
+            self._write_ports(MCP23017_OLATA, 0xFFFF)
+        finally:
+            self._smbus.close()
+            self._smbus = None
+
+    def stats(self):
+        return dict(super().stats(), bus=self.bus, address=hex(self.address), transactions=self.transactions)
+
+class RelayBank(RelayBackend):
+    """Relays spread over several output devices, one backend per relay group.
+
+    A write is split by group and each affected backend gets a single write, so a
+    change touching several relays on one expander is one bus transaction.
+    """
+
+    def __init__(self, groups):
+        super().__init__()
+        self.groups = list(groups)  # [(relays, backend)]
+        self._group_of = {relay.name: idx for idx, (relays, _) in enumerate(self.groups) for relay in relays}
+        self.name = "+".join(dict.fromkeys(backend.name for _, backend in self.groups)) or None
+
+    def write(self, states):
+        parts = {}
+        for name, on in states.items():
+            parts.setdefault(self._group_of[name], {})[name] = on
+        started = time.perf_counter()
+        # Groups turning something off go first, so a hand-over between devices never overlaps
+        for idx, part in sorted(parts.items(), key=lambda item: all(item[1].values())):
+            self.groups[idx][1].write(part)
+        if len(parts) == 1:
+            skew = self.groups[next(iter(parts))][1].last_skew
+        else:
+            skew = time.perf_counter() - started if parts else 0.0
+        self._record(len(states), skew)
+
+    def close(self):
+        for _, backend in self.groups:
+            try:
+                backend.close()
+            except Exception:
+                pass
+
+    def stats(self):
+        return dict(super().stats(), groups=[
+            dict(backend.stats(), relays=[relay.name for relay in relays]) for relays, backend in self.groups
+        ])
+
+def get_relay_backend_choice():
+    choice = str(config_cache.get("relay_backend", RELAY_BACKEND_DEFAULT)).lower()
+    return choice if choice in RELAY_BACKENDS else RELAY_BACKEND_DEFAULT
+
+def open_gpio_backend(relays):
+    """Open the configured backend for onboard `relays`; "auto" prefers lgpio bank writes, then gpiozero."""
+    choice = get_relay_backend_choice()
+    if choice == "mock":
+        candidates = [MockRelayBackend]
+    elif choice == "gpiozero" or lgpio is None:
+        candidates = [GpiozeroRelayBackend]
+    else:
+        try:
+            chip = int(config_cache.get("relay_gpiochip", RELAY_GPIOCHIP_DEFAULT))
+        except (TypeError, ValueError):
+            chip = RELAY_GPIOCHIP_DEFAULT
+        candidates = [lambda: LgpioRelayBackend(chip)]
+        if choice == "auto":
+            candidates.append(GpiozeroRelayBackend)
+    error = None
+    for factory in candidates:
+        backend = factory()
+        try:
+            backend.open(relays)
+            return backend
+        except Exception as e:
+            # e.g. no /dev/gpiochip (not a Pi) or the lines are claimed elsewhere
+            error = e
+            try:
+                backend.close()
+            except Exception:
+                pass
+    raise error
+
+def open_mcp23017_backend(relays):
+    backend = Mcp23017RelayBackend(relays[0].bus, relays[0].address)
+    try:
+        backend.open(relays)
+    except Exception:
+        try:
+            backend.close()
+        except Exception:
+            pass
+        raise
+    return backend
+
+def open_mock_backend(relays):
+    backend = MockRelayBackend()
+    backend.open(relays)
+    return backend
+
+# Driver name (RelayConfig.driver) -> opener taking that group's relays
+RELAY_DRIVER_OPENERS = {
+    "gpio": open_gpio_backend,
+    "mcp23017": open_mcp23017_backend,
+    "mock": open_mock_backend,
+}
+
+def open_relay_backend(relays):
+    """Open a backend per relay group and combine them into one RelayBank."""
+    registry = relays if isinstance(relays, RelayRegistry) else RelayRegistry(relays)
+    opened = []
+    try:
+        for (driver, _, _), group in registry.groups.items():
+            opened.append((group, RELAY_DRIVER_OPENERS[driver](group)))
+    except Exception:
+        RelayBank(opened).close()
+        raise
+    return RelayBank(opened)
+
+# ----------------- RELAY CONTROLLER -----------------
+
+# Commands for the relay controller. SetRelays is one transaction: `states` maps relay
+# name -> True/False (None toggles) and `pulses` maps relay name -> PulseSpec (or plain
+# seconds to hold it on once).
+SetRelays = namedtuple("SetRelays", ["states", "pulses"], defaults=(None,))
+# A timed pulse: on for `on_for` seconds, then off; `repeat` times with `off_for` seconds between
+PulseSpec = namedtuple("PulseSpec", ["on_for", "off_for", "repeat"], defaults=(0.0, 1))
+CancelPulses = namedtuple("CancelPulses", ["names"], defaults=(None,))  # None cancels every pulse
+# on_start runs on the controller thread when the pour actually begins (it may wait behind a test)
+RunPlan = namedtuple("RunPlan", ["plan", "drink_id", "order_id", "on_start"])
+# A test starts at once or is refused with RelayBusy; on_start runs on the controller thread when it starts
+RunTest = namedtuple("RunTest", ["kind", "on_start"], defaults=(None,))  # kind is "time" or "self"
+AllOff = namedtuple("AllOff", [])
+Reconfigure = namedtuple("Reconfigure", ["relays"])  # tuple of RelayConfig
+
+# Immutable view of the controller, replaced (never mutated) on every change
+RelaySnapshot = namedtuple("RelaySnapshot", ["states", "names", "busy", "drink", "self_test", "generation", "relays",
+                                             "pulses"],
+                           defaults=(RelayRegistry(), {}))
+# A running pulse: which phase it is in, when that phase ends and how many "on" phases are left
+LivePulse = namedtuple("LivePulse", ["seq", "spec", "remaining", "on", "deadline"])
+
+RELAY_TEST_KINDS = ("time", "self")
+
+class RelayBusy(Exception):
+    """A pour or test owns the relays."""
+
+class RelayAborted(Exception):
+    """A running pour or test was stopped by AllOff."""
+
+class RelayController:
+    """The only code that touches the relay outputs, run on its own thread.
+
+    Requests submit typed commands and wait on a Future for the result; reads use
+    `snapshot`, an immutable RelaySnapshot swapped in whole, so they take no lock.
+    Pours and tests are sessions: generators that switch relays and yield the
+    time.monotonic() deadline to resume at. The thread fires them between commands,
+    so it stays responsive mid-pour; manual switching is refused with RelayBusy
+    while a session runs, further sessions queue behind it, and AllOff stops it.
+    """
+
+    def __init__(self, open_backend):
+        self.open_backend = open_backend
+        self.commands = 0
+        self._queue = Queue()
+        self._backend = None  # RelayBackend driving the outputs; controller thread only
+        self._relays = RelayRegistry()
+        self._names = ()
+        # Heap of (deadline, seq, relay name), one live entry per running pulse. Cancelled
+        # pulses leave stale entries behind that are skipped when popped (or compacted).
+        self._timers = []
+        self._timer_seq = itertools.count()
+        self._pulses = {}  # relay name -> LivePulse; a later explicit set cancels it
+        self._session = None  # (name, generator, future)
+        self._wake_at = None
+        self._pending = deque()  # sessions waiting for the running one
+        self.snapshot = RelaySnapshot({}, (), None, {"active": False}, {"active": False}, 0)
+        self._thread = threading.Thread(target=self._run, name="relay-controller", daemon=True)
+        self._thread.start()
+
+    # --- producer side (any thread) ---
+
+    def submit(self, command):
+        future = Future()
+        self._queue.put((command, future))
+        return future
+
+    def call(self, command, timeout=None):
+        """Submit a command and wait for its result (re-raising its error)."""
+        return self.submit(command).result(timeout)
+
+    @property
+    def busy(self):
+        return self.snapshot.busy is not None
+
+    # --- controller thread ---
+
+    def _run(self):
+        while True:
+            deadlines = [d for d in (self._wake_at, self._timers[0][0] if self._timers else None) if d is not None]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            try:
+                command, future = self._queue.get(timeout=timeout)
+            except Empty:
+                command = None
+            if command is not None:
+                self.commands += 1
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = self._handle(command, future)
+                    except Exception as e:
+                        future.set_exception(e)
+                    else:
+                        if result is not future:
+                            future.set_result(result)
+            now = time.monotonic()
+            changes, deferred = {}, []
+            while self._timers and self._timers[0][0] <= now:
+                entry = heapq.heappop(self._timers)
+                _, seq, name = entry
+                pulse = self._pulses.get(name)
+                if pulse is None or pulse.seq != seq:
+                    continue
+                if name in changes:
+                    # Running so late that the next phase is due too; keep the edge for next tick
+                    deferred.append(entry)
+                    continue
+                changes[name] = self._next_pulse_phase(name, pulse)
+            for entry in deferred:
+                heapq.heappush(self._timers, entry)
+            if changes:
+                self._switch(changes)
+                self._publish(pulses=dict(self._pulses))
+            if self._session is not None and self._wake_at <= time.monotonic():
+                self._advance()
+
+    def _handle(self, command, future):
+        """Run one command; returning `future` means a session will resolve it later."""
+        if isinstance(command, SetRelays):
+            self._require_idle()
+            self._apply(command.states or {}, command.pulses or {})
+            return self.snapshot.states
+        if isinstance(command, RunPlan):
+            self._queue_session("pour", self._pour_session(command), future)
+            return future
+        if isinstance(command, RunTest):
+            if command.kind not in RELAY_TEST_KINDS:
+                raise ValueError(f"Unknown test {command.kind!r}")
+            # Tests are interactive: refuse rather than queue behind a pour
+            self._require_idle()
+            session = self._time_test_session() if command.kind == "time" else self._self_test_session()
+            self._queue_session(f"{command.kind}-test", session, future)
+            if command.on_start:
+                command.on_start()
+            return future
+        if isinstance(command, CancelPulses):
+            return self._cancel_pulses(command.names)
+        if isinstance(command, AllOff):
+            aborted = self._session is not None
+            if aborted:
+                name, generator, session_future = self._session
+                self._session = self._wake_at = None
+                generator.close()
+                session_future.set_exception(RelayAborted(f"{name} stopped"))
+            self._apply({name: False for name in self._names})
+            self._next_session()
+            return aborted
+        if isinstance(command, Reconfigure):
+            self._require_idle()
+            self._reconfigure(command.relays)
+            return self.snapshot.names
+        raise TypeError(f"Unknown relay command {command!r}")
+
+    def _require_idle(self):
+        if self._session is not None or self._pending:
+            raise RelayBusy("Relays are in use by a running test or pour")
+
+    def _publish(self, **changes):
+        self.snapshot = self.snapshot._replace(**changes)
+
+    def _apply(self, states, pulses=None):
+        """Validate and apply a batch of explicit states and timed pulses as one change.
+
+        Names are checked before any output moves. An explicit state cancels a running
+        pulse on that relay; a pulse turns the relay on now and replaces any earlier pulse.
+        """
+        pulses = pulses or {}
+        for name in itertools.chain(states, pulses):
+            if name not in self._relays:
+                raise KeyError(name)
+        current = self.snapshot.states
+        targets = {name: (not current.get(name, False)) if on is None else bool(on) for name, on in states.items()}
+        targets.update((name, True) for name in pulses)
+        self._switch(targets)
+        for name in states:
+            self._pulses.pop(name, None)
+        now = time.monotonic()
+        for name, spec in pulses.items():
+            if not isinstance(spec, PulseSpec):
+                spec = PulseSpec(float(spec))
+            pulse = LivePulse(next(self._timer_seq), spec, max(1, int(spec.repeat)), True,
+                              now + max(0.0, float(spec.on_for)))
+            self._pulses[name] = pulse
+            heapq.heappush(self._timers, (pulse.deadline, pulse.seq, name))
+        self._compact_timers()
+        self._publish(pulses=dict(self._pulses))
+
+    def _next_pulse_phase(self, name, pulse):
+        """Move a pulse past the phase that just ended; returns the relay's next state.
+
+        Phases are timed from the previous deadline rather than from now, so a repeating
+        pulse does not drift when the thread wakes late.
+        """
+        if pulse.on:
+            remaining = pulse.remaining - 1
+            if remaining <= 0:
+                del self._pulses[name]
+                return False
+            pulse = pulse._replace(remaining=remaining, on=False, deadline=pulse.deadline + pulse.spec.off_for)
+        else:
+            pulse = pulse._replace(on=True, deadline=pulse.deadline + pulse.spec.on_for)
+        self._pulses[name] = pulse
+        heapq.heappush(self._timers, (pulse.deadline, pulse.seq, name))
+        return pulse.on
+
+    def _cancel_pulses(self, names=None):
+        """Stop running pulses (all when `names` is None), switching off any mid-pulse relay."""
+        if names is not None:
+            for name in names:
+                if name not in self._relays:
+                    raise KeyError(name)
+        cancelled = [name for name in self._pulses if names is None or name in names]
+        off = {name: False for name in cancelled if self._pulses[name].on}
+        for name in cancelled:
+            del self._pulses[name]
+        if off:
+            self._switch(off)
+        self._compact_timers()
+        self._publish(pulses=dict(self._pulses))
+        return cancelled
+
+    def _compact_timers(self):
+        """Drop stale heap entries once they outnumber the live ones."""
+        if len(self._timers) <= 2 * len(self._pulses) + 64:
+            return
+        live = {(pulse.deadline, pulse.seq, name) for name, pulse in self._pulses.items()}
+        self._timers = [entry for entry in self._timers if entry in live]
+        heapq.heapify(self._timers)
+
+    def _switch(self, states):
+        """Drive outputs and record the new states in one store update; the caller validated names.
+
+        The backend applies the whole batch in one write where the hardware allows it. If the
+        write fails, the batch's relays are put back before re-raising, so it never lands half
+        applied.
+        """
+        if self._backend is None:
+            if not states:
+                return
+            raise RuntimeError("Relay outputs are not open")
+        previous = self.snapshot.states
+        try:
+            self._backend.write(states)
+        except Exception:
+            try:
+                self._backend.write({name: previous.get(name, False) for name in states})
+            except Exception:
+                pass
+            raise
+        merged = dict(previous)
+        merged.update(states)
+        self._publish(states=merged)
+        relay_state_store.update(states)
+
+    def _reconfigure(self, relays):
+        """Move to a new relay set, or stay on the current one if its outputs fail to open.
+
+        The old outputs are released first because the new set may reuse their pins. If the
+        new set then fails to open, the old one is reopened and the error re-raised.
+        """
+        registry = relays if isinstance(relays, RelayRegistry) else RelayRegistry(relays)
+        previous = self._relays
+        if self._backend is not None:
+            try:
+                self._backend.close()
+            except Exception:
+                pass
+        self._backend = None
+        self._timers.clear()
+        self._pulses.clear()
+        try:
+            self._backend = self.open_backend(registry)
+        except Exception:
+            restored = previous
+            try:
+                self._backend = self.open_backend(previous)
+            except Exception:
+                # Neither set opens: carry on with no relays rather than names without outputs
+                restored = RelayRegistry()
+            self._use_relays(restored, changed=restored is not previous)
+            raise
+        self._use_relays(registry)
+
+    def _use_relays(self, registry, changed=True):
+        # Compiled drink plans stay valid unless the relay set actually changed
+        self._relays = registry
+        self._names = registry.names
+        states = {name: False for name in self._names}
+        self._publish(states=states, names=self._names, relays=registry, pulses={},
+                      generation=self.snapshot.generation + (1 if changed else 0))
+        relay_state_store.replace(states)
+
+    def _queue_session(self, name, generator, future):
+        self._pending.append((name, generator, future))
+        if self._session is None:
+            self._next_session()
+
+    def _next_session(self):
+        while self._session is None and self._pending:
+            name, generator, future = self._pending.popleft()
+            self._session = (name, generator, future)
+            # The session owns every output now; running pulses must not fire into it
+            self._pulses.clear()
+            self._timers.clear()
+            self._publish(busy=name, pulses={})
+            self._wake_at = time.monotonic()
+        if self._session is None:
+            self._publish(busy=None)
+
+    def _advance(self):
+        name, generator, future = self._session
+        try:
+            self._wake_at = next(generator)
+            return
+        except StopIteration as done:
+            future.set_result(done.value)
+        except Exception as e:
+            future.set_exception(e)
+        self._session = self._wake_at = None
+        self._next_session()
+
+    # --- sessions (generators run on the controller thread) ---
+
+    def _pour_session(self, command):
+        plan, drink_id, order_id = command.plan, command.drink_id, command.order_id
+        if plan.generation != self.snapshot.generation:
+            raise ValueError(f"{plan.name}: relays were reconfigured, recompile the drink")
+        if command.on_start:
+            command.on_start()
+        started_at = time.time()
+        total = plan.total_time + POUR_LEAD_TIME
+        self._publish(drink={
+            "active": True, "order_id": order_id, "drink_name": plan.name, "started_at": started_at,
+            "total_time": plan.total_time, "expected_total": total, "current_step": 0, "steps": plan.steps,
+        })
+        progress_events.publish("pour-start", {
+            "order_id": order_id,
+            "drink_id": drink_id,
+            "drink_name": plan.name,
+            "total_time": total,
+            "steps": plan.steps,
+        })
+        ok = False
+        lateness = []
+        try:
+            # Reset all relays to OFF first, then settle before the first event
+            self._switch({name: False for name in self._names})
+            start = time.monotonic() + POUR_LEAD_TIME
+            # Events fire at absolute deadlines, so latency never accumulates into drift.
+            # Events due together are one switch: one write per expander, not per relay.
+            for at, group in itertools.groupby(plan.events, key=lambda event: event.at):
+                events = list(group)
+                deadline = start + at
+                if time.monotonic() < deadline:
+                    yield deadline
+                late = time.monotonic() - deadline
+                self._switch({event.relay_name: event.on for event in events})
+                for event in events:
+                    lateness.append(late)
+                    self._publish(drink=dict(self.snapshot.drink, current_step=event.step))
+                    progress_events.publish("step-start" if event.on else "step-end", {
+                        "order_id": order_id,
+                        "step": event.step,
+                        "steps": plan.steps,
+                        "relay": event.relay_name,
+                        "at": event.at,
+                        "late": late,
+                        "percent": min(99, (POUR_LEAD_TIME + event.at) / total * 100) if total > 0 else 99,
+                    })
+            yield start + plan.total_time
+            drink_timings[drink_id] = {
+                "finished_at": time.time(),
+                "lateness": lateness,
+                "max_lateness": max(lateness, default=0.0),
+            }
+            ok = True
+            return lateness
+        finally:
+            # Turn all relays off at the end, even if the pour failed or was stopped part way
+            self._switch({name: False for name in self._names})
+            self._publish(drink={"active": False})
+            timing = drink_timings.get(drink_id) if ok else None
+            progress_events.publish("pour-end", {
+                "order_id": order_id,
+                "drink_id": drink_id,
+                "drink_name": plan.name,
+                "success": ok,
+                "percent": 100 if ok else None,
+                "max_lateness": timing["max_lateness"] if timing else None,
+            })
+
+    def _time_test_session(self):
+        """Each relay on for 1s, then off, one after another."""
+        names = list(self._names)
+        progress_events.publish("test-start", {"test": "time", "steps": len(names) * 2})
+        result = None
+        try:
+            self._switch({name: False for name in names})
+            at = time.monotonic() + 0.5  # Small delay after reset
+            yield at
+            for name in names:
+                self._switch({name: True})
+                at += 1
+                yield at
+                self._switch({name: False})
+                at += 0.5  # Small delay between relays
+                yield at
+            result = "Time test completed successfully!"
+            return result
+        finally:
+            self._switch({name: False for name in self._names})
+            progress_events.publish("test-end", {"test": "time", "success": result is not None, "result": result})
+
+    def _self_test_session(self):
+        """Per relay: pulse on, off, second pulse, final off, announcing each step."""
+        names = list(self._names)
+        progress = {"active": True, "relay": None, "action": None, "step": 0, "steps": len(names) * 4}
+        self._publish(self_test=progress)
+        progress_events.publish("test-start", {"test": "self", "steps": progress["steps"]})
+        result = None
+        try:
+            self._switch({name: False for name in names})
+            at = time.monotonic() + 0.5  # Small delay after reset
+            yield at
+            for name in names:
+                for on, hold in ((True, 0.6), (False, 0.3), (True, 0.4), (False, 0.2)):
+                    self._switch({name: on})
+                    progress = dict(progress, step=progress["step"] + 1, relay=name, action="ON" if on else "OFF")
+                    self._publish(self_test=progress)
+                    progress_events.publish("test-step", {"test": "self", **self_test_progress_snapshot()})
+                    at += hold
+                    yield at
+            result = "Self test completed successfully!"
+            return result
+        finally:
+            self._switch({name: False for name in self._names})
+            self._publish(self_test={"active": False})
+            progress_events.publish("test-end", {"test": "self", "success": result is not None, "result": result})
+
+    def stats(self):
+        snapshot = self.snapshot
+        return {
+            "busy": snapshot.busy,
+            "pending_sessions": len(self._pending),
+            "pulses": len(snapshot.pulses),
+            "timers": len(self._timers),
+            "queued_commands": self._queue.qsize(),
+            "commands": self.commands,
+            "relays": list(snapshot.names),
+            "generation": snapshot.generation,
+        }
+
+    def backend_stats(self):
+        backend = self._backend
+        return backend.stats() if backend is not None else {"backend": None}
+
+relay_controller = RelayController(open_relay_backend)
+
+def init_relay_pins():
+    """(Re)open the configured relay outputs; raises RelayBusy during a pour or test."""
+    config_cache.refresh()
+    relay_controller.call(Reconfigure(config_cache.relays))
+
+# Initialize relays on startup
+init_relay_pins()
+
+PHOTOS_FOLDER = 'photos/albums'
+PHOTO_LIB_JSON = 'photo_library.json'
+
+# USB mount locations to check
+USB_MOUNT_PATHS = [
+    '/mnt/usb',
+    '/media/pi', 
+    '/run/media/pi',
+    f'/media/{os.getenv("USER", "pi")}',
+    '/media/usb',
+    '/media/usb0',
+    '/media/usb1'
+]
+
+# ----------------- BACKGROUND JOBS -----------------
+
+# Worker threads shared by all maintenance jobs
+JOB_WORKERS = 3
+# Jobs of one group that may run at once; groups not listed get JOB_GROUP_LIMIT_DEFAULT
+JOB_GROUP_LIMITS = {"relay-test": 1, "update": 1}
+JOB_GROUP_LIMIT_DEFAULT = 1
+# Finished jobs kept for status lookups, and output/progress events kept per job for replay
+JOB_HISTORY = 30
+JOB_EVENT_HISTORY = 1000
+JOB_UNFINISHED = ("queued", "running")
+
+class JobCancelled(Exception):
+    """Raised inside a job once it has been cancelled."""
+
+class Job:
+    """One background job: `work(job)` runs on a job worker and its return value is the result.
+
+    Work reports through `log()` and stops at the next `check_cancelled()` or
+    `run_process()` once cancelled; a running child process is terminated and
+    `on_cancel` is called so blocking work can be interrupted.
+
+    Output lines go to `events`, a sequence-numbered ring (an EventChannel) that any
+    number of viewers can replay and follow, as `line` events. A `progress` parser,
+    if given, turns lines into `progress` events (work can also `report()` its own);
+    an `end` event closes the channel.
+    """
+
+    def __init__(self, kind, work, group=None, title=None, on_cancel=None, progress=None):
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.group = group or kind
+        self.title = title or kind
+        self.work = work
+        self.on_cancel = on_cancel
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.events = EventChannel(history=JOB_EVENT_HISTORY)
+        self.lines_total = 0  # lines ever logged; the ring keeps only the recent ones
+        self.progress = None
+        self._progress = progress
+        self._cancel = threading.Event()
+        self._process = None
+        self._cond = threading.Condition()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    @property
+    def finished(self):
+        return self.status not in JOB_UNFINISHED
+
+    def log(self, line):
+        line = str(line).rstrip("\n")
+        with self._cond:
+            self.lines_total += 1
+            self.events.publish("line", {"line": line})
+            progress = self._progress.feed(line) if self._progress is not None else None
+            if progress is not None:
+                self.progress = progress
+                self.events.publish("progress", progress)
+
+    def report(self, progress):
+        """Publish progress the work measured itself rather than parsed from its output."""
+        with self._cond:
+            self.progress = progress
+            self.events.publish("progress", progress)
+
+    def output(self, tail):
+        """The last `tail` output lines still in the ring."""
+        lines = [data["line"] for _, event_type, data in self.events.history() if event_type == "line"]
+        return lines[-tail:] if tail else []
+
+    def snapshot(self):
+        """`state` for a viewer that missed lines the ring no longer holds."""
+        return {"id": self.id, "status": self.status, "progress": self.progress,
+                "lines_total": self.lines_total, "result": self.result, "error": self.error}
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    def run_process(self, args, shell=False, cwd=None):
+        """Run a command, logging its combined output line by line; returns (returncode, output)."""
+        self.check_cancelled()
+        process = subprocess.Popen(args, shell=shell, cwd=cwd, text=True, bufsize=1,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self._process = process
+        lines = []
+        try:
+            for line in process.stdout:
+                lines.append(line)
+                self.log(line)
+            process.wait()
+        finally:
+            self._process = None
+        self.check_cancelled()
+        return process.returncode, "".join(lines)
+
+    def cancel(self):
+        self._cancel.set()
+        process = self._process
+        if process is not None and process.poll() is None:
+            process.terminate()
+        if self.on_cancel is not None:
+            try:
+                self.on_cancel()
+            except Exception:
+                pass
+
+    def _finish(self, status, result=None, error=None):
+        with self._cond:
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished_at = time.time()
+            self.events.publish("end", {"status": status, "result": result, "error": error})
+            self.events.close()
+
+    def to_dict(self, tail=50):
+        now = time.time()
+        started, finished = self.started_at, self.finished_at
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "title": self.title,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at,
+            "started_at": started,
+            "finished_at": finished,
+            "queued_seconds": (started or finished or now) - self.created_at,
+            "run_seconds": ((finished or now) - started) if started else None,
+            "output": self.output(tail),
+            "output_lines": self.lines_total,
+            "progress": self.progress,
+        }
+
+class JobEngine:
+    """A fixed pool of worker threads running submitted Jobs in order, within per-group limits.
+
+    A job whose group is at its limit waits while later jobs of other groups run,
+    so a long system update never holds up a relay test.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, limits=None, history=JOB_HISTORY):
+        self.limits = dict(JOB_GROUP_LIMITS if limits is None else limits)
+        self.history = history
+        self._cond = threading.Condition()
+        self._jobs = OrderedDict()
+        self._queue = deque()
+        self._running = {}  # group -> running job count
+        self._threads = [threading.Thread(target=self._worker, name=f"job-worker-{n}", daemon=True)
+                         for n in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, kind, work, group=None, title=None, on_cancel=None, progress=None, unique=False):
+        """Queue a job and return it at once. With `unique`, an unfinished job of the same
+        kind is returned instead of starting a second one."""
+        with self._cond:
+            if unique:
+                for job in self._jobs.values():
+                    if job.kind == kind and not job.finished:
+                        return job
+            job = Job(kind, work, group=group, title=title, on_cancel=on_cancel, progress=progress)
+            self._jobs[job.id] = job
+            self._queue.append(job)
+            self._trim()
+            self._cond.notify_all()
+        return job
+
+    def get(self, job_id):
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._cond:
+            return list(self._jobs.values())
+
+    def latest(self, kind):
+        """The most recent job of `kind`, or None."""
+        with self._cond:
+            for job in reversed(self._jobs.values()):
+                if job.kind == kind:
+                    return job
+        return None
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; returns the job, or None if unknown."""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.finished:
+                return job
+            if job.status == "queued":
+                self._queue.remove(job)
+                job._cancel.set()
+                job._finish("cancelled")
+                return job
+        job.cancel()
+        return job
+
+    def close_streams(self):
+        """End every open job output stream (on shutdown); viewers reconnect with Last-Event-ID."""
+        for job in self.jobs():
+            job.events.close()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": len(self._threads),
+                "queued": len(self._queue),
+                "running": dict(self._running),
+                "limits": dict(self.limits),
+                "kept": len(self._jobs),
+            }
+
+    def _trim(self):
+        finished = [job_id for job_id, job in self._jobs.items() if job.finished]
+        for job_id in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job_id]
+
+    def _next_job(self):
+        for job in self._queue:
+            if self._running.get(job.group, 0) < self.limits.get(job.group, JOB_GROUP_LIMIT_DEFAULT):
+                return job
+        return None
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+                self._queue.remove(job)
+                self._running[job.group] = self._running.get(job.group, 0) + 1
+                job.status = "running"
+                job.started_at = time.time()
+            try:
+                result = job.work(job)
+            except Exception as e:
+                if job.cancelled:
+                    job._finish("cancelled", error="Cancelled")
+                else:
+                    job._finish("failed", error=str(e) or type(e).__name__)
+            else:
+                job._finish("cancelled" if job.cancelled else "done", result=result)
+            with self._cond:
+                self._running[job.group] -= 1
+                self._trim()
+                self._cond.notify_all()
+
+job_engine = JobEngine()
+
+# ----------------- PHOTO LIBRARY INDEX -----------------
+
+PHOTO_LIB_DB = 'photo_library.db'
+PHOTO_LIB_SCHEMA_VERSION = 2
+# Photo content lives once per distinct file, named by its sha256; folders only reference it
+PHOTO_BLOBS_DIR = 'photos/blobs'
+# Unreferenced blobs touched this recently survive GC: an import may not have committed its rows yet
+PHOTO_BLOB_GC_GRACE = 600
+PHOTO_COPY_BUFFER = 1024 * 1024
+# list-saved ?sort= values and the columns they order by
+PHOTO_SORT_COLUMNS = {
+    "name": "filename",
+    "folder": "folder, filename",
+    "added": "added_at",
+    "size": "size",
+}
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(PHOTO_COPY_BUFFER), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def copy_with_sha256(src, dest):
+    """Copy src to dest in large chunks, hashing on the way. Returns the sha256."""
+    digest = hashlib.sha256()
+    with open(src, "rb") as fsrc, open(dest, "wb") as fdst:
+        for chunk in iter(lambda: fsrc.read(PHOTO_COPY_BUFFER), b""):
+            digest.update(chunk)
+            fdst.write(chunk)
+    return digest.hexdigest()
+
+class PhotoLibrary:
+    """SQLite (WAL) index of photo folders and photos, keyed by (folder, filename).
+
+    Replaces the photo_library.json file that was rewritten whole on every change;
+    that file is imported once on first open and kept as photo_library.json.migrated.
+    Each thread gets its own connection; WAL lets page loads read while imports write.
+
+    Photo bytes are stored content-addressed under blobs_dir, so the same picture
+    imported twice or filed in several folders is one file, a move is a row update, and
+    blobs nothing references any more are garbage-collected.
+    """
+
+    def __init__(self, path, legacy_json=None, blobs_dir=PHOTO_BLOBS_DIR):
+        self.path = path
+        self.legacy_json = legacy_json
+        self.blobs_dir = blobs_dir
+        self._local = threading.local()
+        self._init_lock = Lock()
+        self._ready = False
+        self._gc_cond = threading.Condition()
+        self._gc_wake = False
+        self._gc_thread = None
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA foreign_keys=ON")
+            self._local.conn = conn
+        if not self._ready:
+            with self._init_lock:
+                if not self._ready:
+                    self._migrate(conn)
+                    self._ready = True
+        return conn
+
+    def _migrate(self, conn):
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= PHOTO_LIB_SCHEMA_VERSION:
+            return
+        with conn:
+            if version < 1:
+                conn.execute("""CREATE TABLE IF NOT EXISTS folders (
+                    name TEXT PRIMARY KEY,
+                    created_at REAL NOT NULL)""")
+                conn.execute("""CREATE TABLE IF NOT EXISTS photos (
+                    folder TEXT NOT NULL REFERENCES folders(name) ON DELETE CASCADE ON UPDATE CASCADE,
+                    filename TEXT NOT NULL,
+                    size INTEGER,
+                    added_at REAL NOT NULL,
+                    PRIMARY KEY (folder, filename))""")
+                conn.execute("CREATE INDEX IF NOT EXISTS photos_by_name ON photos(filename)")
+                conn.execute("CREATE INDEX IF NOT EXISTS photos_by_added ON photos(added_at)")
+                conn.execute("INSERT OR IGNORE INTO folders (name, created_at) VALUES ('default', ?)", (time.time(),))
+                if self.legacy_json and os.path.exists(self.legacy_json):
+                    self._import_legacy(conn)
+            if version < 2:
+                conn.execute("ALTER TABLE photos ADD COLUMN sha256 TEXT")
+                conn.execute("""CREATE TABLE IF NOT EXISTS blobs (
+                    sha256 TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    touched_at REAL NOT NULL)""")
+                conn.execute("CREATE INDEX IF NOT EXISTS photos_by_blob ON photos(sha256)")
+                conn.execute("CREATE INDEX IF NOT EXISTS blobs_by_size ON blobs(size)")
+                self._adopt_album_files(conn)
+            conn.execute(f"PRAGMA user_version = {PHOTO_LIB_SCHEMA_VERSION}")
+        if self.legacy_json and os.path.exists(self.legacy_json):
+            os.replace(self.legacy_json, self.legacy_json + ".migrated")
+
+    def _adopt_album_files(self, conn):
+        # One-time move of photos/albums/<folder>/<file> into the blob store (same filesystem: renames)
+        rows = conn.execute("SELECT folder, filename FROM photos WHERE sha256 IS NULL").fetchall()
+        for row in rows:
+            path = os.path.join(PHOTOS_FOLDER, row["folder"], row["filename"])
+            if os.path.isfile(path):
+                sha256, size, _ = self.store_file(path, move=True, conn=conn)
+                conn.execute("UPDATE photos SET sha256 = ?, size = ? WHERE folder = ? AND filename = ?",
+                             (sha256, size, row["folder"], row["filename"]))
+
+    def _import_legacy(self, conn):
+        with open(self.legacy_json, "r") as f:
+            data = json.load(f)
+        now = time.time()
+        for folder in data.get("folders", []):
+            conn.execute("INSERT OR IGNORE INTO folders (name, created_at) VALUES (?, ?)", (folder, now))
+        for filename, folder in data.get("photos", {}).items():
+            conn.execute("INSERT OR IGNORE INTO folders (name, created_at) VALUES (?, ?)", (folder, now))
+            path = os.path.join(PHOTOS_FOLDER, folder, filename)
+            try:
+                st = os.stat(path)
+                size, added_at = st.st_size, st.st_mtime
+            except OSError:
+                size, added_at = None, now
+            conn.execute("INSERT OR REPLACE INTO photos (folder, filename, size, added_at) VALUES (?, ?, ?, ?)",
+                         (folder, filename, size, added_at))
+
+    # --- folders ---
+
+    def folders(self):
+        rows = self._conn().execute("SELECT name FROM folders ORDER BY created_at, name")
+        return [row["name"] for row in rows]
+
+    def add_folder(self, name):
+        """Returns False if the folder already exists."""
+        with self._conn() as conn:
+            cur = conn.execute("INSERT OR IGNORE INTO folders (name, created_at) VALUES (?, ?)", (name, time.time()))
+        return cur.rowcount == 1
+
+    def delete_folder(self, name):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM folders WHERE name = ?", (name,))
+
+    # --- photos ---
+
+    def add_photo(self, folder, filename, size=None, sha256=None):
+        self.add_photos(folder, [(filename, size, sha256)])
+
+    def add_photos(self, folder, photos):
+        """Insert or refresh (filename, size, sha256) rows in one folder in a single transaction."""
+        now = time.time()
+        with self._conn() as conn:
+            conn.execute("INSERT OR IGNORE INTO folders (name, created_at) VALUES (?, ?)", (folder, now))
+            conn.executemany(
+                "INSERT OR REPLACE INTO photos (folder, filename, size, added_at, sha256) VALUES (?, ?, ?, ?, ?)",
+                [(folder, filename, size, now, sha256) for filename, size, sha256 in photos])
+
+    def has_photo(self, folder, filename):
+        return self._conn().execute(
+            "SELECT 1 FROM photos WHERE folder = ? AND filename = ?", (folder, filename)).fetchone() is not None
+
+    def move_photo(self, folder, filename, new_folder):
+        with self._conn() as conn:
+            conn.execute("INSERT OR IGNORE INTO folders (name, created_at) VALUES (?, ?)", (new_folder, time.time()))
+            conn.execute("DELETE FROM photos WHERE folder = ? AND filename = ?", (new_folder, filename))
+            conn.execute("UPDATE photos SET folder = ? WHERE folder = ? AND filename = ?",
+                         (new_folder, folder, filename))
+
+    def delete_photo(self, folder, filename):
+        with self._conn() as conn:
+            conn.execute("DELETE FROM photos WHERE folder = ? AND filename = ?", (folder, filename))
+
+    def resolve(self, folder, filename):
+        """Path of the blob holding folder/filename, or None if it isn't indexed or has no blob."""
+        row = self._conn().execute(
+            "SELECT sha256 FROM photos WHERE folder = ? AND filename = ?", (folder, filename)).fetchone()
+        return self.blob_path(row["sha256"]) if row and row["sha256"] else None
+
+    # --- blobs ---
+
+    def blob_path(self, sha256):
+        return os.path.join(self.blobs_dir, sha256[:2], sha256)
+
+    def has_blob(self, sha256):
+        return os.path.isfile(self.blob_path(sha256))
+
+    def store_file(self, src, move=False, conn=None):
+        """Add src's content to the blob store. Returns (sha256, size, written).
+
+        Content already stored costs a hash and no write (`written` is False). When no
+        blob has the same size the content must be new, so it is hashed while copying.
+        With move=True src is renamed into place, or removed if it was a duplicate.
+        """
+        conn = conn or self._conn()
+        size = os.path.getsize(src)
+        sha256 = None
+        if conn.execute("SELECT 1 FROM blobs WHERE size = ? LIMIT 1", (size,)).fetchone():
+            sha256 = file_sha256(src)
+            if self.has_blob(sha256):
+                self._touch_blob(conn, sha256, size)
+                if move:
+                    os.remove(src)
+                return sha256, size, False
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        if move:
+            sha256 = sha256 or file_sha256(src)
+            os.makedirs(os.path.dirname(self.blob_path(sha256)), exist_ok=True)
+            os.replace(src, self.blob_path(sha256))
+        else:
+            tmp_path = os.path.join(self.blobs_dir, f".{uuid.uuid4().hex}.part")
+            try:
+                sha256 = copy_with_sha256(src, tmp_path)
+                os.makedirs(os.path.dirname(self.blob_path(sha256)), exist_ok=True)
+                os.replace(tmp_path, self.blob_path(sha256))
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        os.chmod(self.blob_path(sha256), 0o664)
+        self._touch_blob(conn, sha256, size)
+        return sha256, size, True
+
+    def _touch_blob(self, conn, sha256, size):
+        if conn.in_transaction:
+            conn.execute("INSERT OR REPLACE INTO blobs (sha256, size, touched_at) VALUES (?, ?, ?)",
+                         (sha256, size, time.time()))
+        else:
+            with conn:
+                conn.execute("INSERT OR REPLACE INTO blobs (sha256, size, touched_at) VALUES (?, ?, ?)",
+                             (sha256, size, time.time()))
+
+    def collect_garbage(self):
+        """Delete blobs no photo references any more. Returns how many were removed."""
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT sha256 FROM blobs WHERE touched_at < ? AND sha256 NOT IN "
+            "(SELECT sha256 FROM photos WHERE sha256 IS NOT NULL)",
+            (time.time() - PHOTO_BLOB_GC_GRACE,)).fetchall()
+        removed = 0
+        for row in rows:
+            with conn:
+                # Re-check inside the write: a concurrent add may have just referenced it
+                cur = conn.execute(
+                    "DELETE FROM blobs WHERE sha256 = ? AND NOT EXISTS (SELECT 1 FROM photos WHERE sha256 = ?)",
+                    (row["sha256"], row["sha256"]))
+            if cur.rowcount:
+                try:
+                    os.remove(self.blob_path(row["sha256"]))
+                except FileNotFoundError:
+                    pass
+                removed += 1
+        return removed
+
+    def garbage_due(self):
+        """When the oldest unreferenced blob leaves its grace period, or None if there is none."""
+        row = self._conn().execute(
+            "SELECT MIN(touched_at) FROM blobs WHERE sha256 NOT IN "
+            "(SELECT sha256 FROM photos WHERE sha256 IS NOT NULL)").fetchone()
+        return row[0] + PHOTO_BLOB_GC_GRACE if row[0] is not None else None
+
+    def schedule_garbage_collection(self):
+        """Have the collector thread look again at what is due; call after anything frees blobs."""
+        with self._gc_cond:
+            self._gc_wake = True
+            if self._gc_thread is None:
+                self._gc_thread = threading.Thread(target=self._gc_loop, name="photo-gc", daemon=True)
+                self._gc_thread.start()
+            self._gc_cond.notify()
+
+    def _gc_loop(self):
+        # Blobs freed inside their grace period would otherwise wait for the next delete
+        while True:
+            with self._gc_cond:
+                self._gc_wake = False
+            due = self.garbage_due()
+            with self._gc_cond:
+                if not self._gc_wake:
+                    self._gc_cond.wait(None if due is None else max(0.0, due - time.time()) + 1)
+                if self._gc_wake:
+                    continue
+            try:
+                self.collect_garbage()
             except Exception as e:
-                errors.append(f"Error importing {photo_name}: {str(e)}")
+                print(f"Photo blob cleanup failed: {e}")
+                time.sleep(PHOTO_BLOB_GC_GRACE)
+
+    def find_folder(self, filename):
+        """Folder holding `filename`, for callers that only know the bare name (oldest match wins)."""
+        row = self._conn().execute(
+            "SELECT folder FROM photos WHERE filename = ? ORDER BY added_at LIMIT 1", (filename,)).fetchone()
+        return row["folder"] if row else None
+
+    def list_photos(self, folder=None, sort="folder", descending=False, limit=None, offset=0):
+        """One page of photos as dicts plus the total matching count."""
+        where, params = ("WHERE folder = ?", [folder]) if folder else ("", [])
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM photos {where}", params).fetchone()[0]
+        order = ", ".join(f"{column} {'DESC' if descending else 'ASC'}"
+                          for column in PHOTO_SORT_COLUMNS.get(sort, PHOTO_SORT_COLUMNS["folder"]).split(", "))
+        rows = conn.execute(
+            f"SELECT folder, filename, size, added_at FROM photos {where} ORDER BY {order} LIMIT ? OFFSET ?",
+            params + [-1 if limit is None else limit, offset])
+        return [dict(row) for row in rows], total
+
+    def summary(self):
+        """Folders in creation order with their photo counts."""
+        conn = self._conn()
+        counts = dict(conn.execute("SELECT folder, COUNT(*) FROM photos GROUP BY folder").fetchall())
+        folders = self.folders()
+        return {
+            "folders": folders,
+            "counts": {folder: counts.get(folder, 0) for folder in folders},
+            "total": sum(counts.values()),
+        }
+
+photo_index = PhotoLibrary(PHOTO_LIB_DB, legacy_json=PHOTO_LIB_JSON)
+# Also picks up blobs left behind by imports a restart interrupted
+photo_index.schedule_garbage_collection()
+
+def scan_usb_mount_paths():
+    """Probe the known mount roots (and lsblk) for a USB mount; slow, used where mountinfo is unavailable."""
+    # First, scan known mount roots
+    for path in USB_MOUNT_PATHS:
+        if not os.path.exists(path):
+            continue
+
+        # If the path itself is a mount, use it.
+        if os.path.ismount(path):
+            try:
+                os.listdir(path)
+                return path
+            except PermissionError:
+                continue
+
+        # If it's a directory, check its immediate subfolders for mounts (e.g., /media/pi/USB)
+        if os.path.isdir(path):
+            try:
+                for entry in os.listdir(path):
+                    subpath = os.path.join(path, entry)
+                    if os.path.ismount(subpath):
+                        try:
+                            os.listdir(subpath)
+                            return subpath
+                        except PermissionError:
+                            continue
+            except PermissionError:
+                continue
+
+    # Fallback: parse lsblk to discover removable USB mounts
+    try:
+        lsblk_result = subprocess.run(['lsblk', '-f'], capture_output=True, text=True)
+        for line in lsblk_result.stdout.splitlines():
+            if 'vfat' in line.lower() or 'exfat' in line.lower() or 'ntfs' in line.lower():
+                parts = line.split()
+                if parts:
+                    mountpoints = parts[-1:]
+                    for mp in mountpoints:
+                        if os.path.exists(mp) and os.path.ismount(mp):
+                            return mp
+    except Exception:
+        pass
+
+    return None
+
+# ----------------- USB MOUNT WATCHER -----------------
+
+MOUNTINFO_PATH = "/proc/self/mountinfo"
+# Filesystems USB sticks normally carry
+USB_FS_TYPES = {"vfat", "msdos", "exfat", "ntfs", "ntfs3", "fuseblk"}
+# Safety-net rescan period while the kernel notifies changes; rescan period when it cannot
+USB_MOUNT_RESCAN_INTERVAL = 60.0
+USB_MOUNT_FALLBACK_INTERVAL = 5.0
+
+MountEntry = namedtuple("MountEntry", ["mount_point", "fs_type", "source", "device"])
+
+def parse_mountinfo(text):
+    """Parse /proc/<pid>/mountinfo text into MountEntry tuples."""
+    mounts = []
+    for line in text.splitlines():
+        # "<id> <parent> <major:minor> <root> <mount point> <options> [optional...] - <fs type> <source> <super options>"
+        left, sep, right = line.partition(" - ")
+        fields, tail = left.split(), right.split()
+        if not sep or len(fields) < 5 or not tail:
+            continue
+        # Space, tab, newline and backslash in paths are escaped as \ooo
+        mount_point = re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), fields[4])
+        mounts.append(MountEntry(mount_point, tail[0], tail[1] if len(tail) > 1 else "", fields[2]))
+    return mounts
+
+def is_usb_block_device(device):
+    """True/False if sysfs places major:minor on a USB bus, None when sysfs can't tell."""
+    sys_path = f"/sys/dev/block/{device}"
+    if not os.path.exists(sys_path):
+        return None
+    return "/usb" in os.path.realpath(sys_path)
+
+def usb_mount_rank(mount_point):
+    """Index of the USB_MOUNT_PATHS root holding mount_point (the root itself or a direct child), else None."""
+    for rank, root in enumerate(USB_MOUNT_PATHS):
+        if mount_point == root or os.path.dirname(mount_point) == root:
+            return rank
+    return None
+
+def usb_mounts_from_mountinfo(text):
+    """Readable USB mount points from mountinfo text, in find_usb_mount() preference order."""
+    found = []
+    for entry in parse_mountinfo(text):
+        rank = usb_mount_rank(entry.mount_point)
+        if rank is None:
+            is_usb = is_usb_block_device(entry.device)
+            if is_usb is None:
+                # No sysfs: go by filesystem, skipping the Pi's own vfat boot partition
+                is_usb = entry.fs_type in USB_FS_TYPES and not entry.mount_point.startswith("/boot")
+            if not is_usb:
+                continue
+            rank = len(USB_MOUNT_PATHS)
+        if os.access(entry.mount_point, os.R_OK | os.X_OK):
+            found.append((rank, entry.mount_point))
+    found.sort()
+    mounts = []
+    for _, mount_point in found:
+        if mount_point not in mounts:
+            mounts.append(mount_point)
+    return mounts
+
+class UsbMountWatcher:
+    """Cached set of USB mounts, rebuilt only when the kernel reports a mount table change.
+
+    The kernel flags /proc/self/mountinfo with POLLPRI whenever anything is mounted or
+    unmounted (this is what udisks and systemd watch too), so a background thread waits on
+    that and lookups are a read of the cached tuple. Without a pollable mountinfo the
+    cache is rebuilt at most every USB_MOUNT_FALLBACK_INTERVAL seconds on lookup.
+    """
+
+    def __init__(self, mountinfo_path=MOUNTINFO_PATH):
+        self.mountinfo_path = mountinfo_path
+        self.mounts = ()
+        self.generation = 0
+        self.rebuilds = 0
+        self.lookups = 0
+        self.watching = False
+        self._rebuilt_at = 0.0
+        self._lock = Lock()
+        self._thread = None
+
+    def _rebuild(self, text=None):
+        try:
+            if text is None:
+                with open(self.mountinfo_path, "r") as f:
+                    text = f.read()
+            mounts = tuple(usb_mounts_from_mountinfo(text))
+        except OSError:
+            # No mountinfo (not Linux): probe the known mount roots instead
+            found = scan_usb_mount_paths()
+            mounts = (found,) if found else ()
+        with self._lock:
+            if mounts != self.mounts:
+                self.mounts = mounts
+                self.generation += 1
+            self.rebuilds += 1
+            self._rebuilt_at = time.time()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._watch_loop, name="usb-mounts", daemon=True)
+        self._rebuild()
+        self._thread.start()
+
+    def _watch_loop(self):
+        try:
+            f = open(self.mountinfo_path, "r")
+            poller = select.poll()
+            poller.register(f, select.POLLPRI | select.POLLERR)
+        except (OSError, AttributeError):
+            return
+        self.watching = True
+        try:
+            while True:
+                poller.poll(USB_MOUNT_RESCAN_INTERVAL * 1000)
+                f.seek(0)
+                self._rebuild(f.read())
+        except Exception:
+            self.watching = False
+        finally:
+            f.close()
+
+    def all(self):
+        if self._thread is None:
+            self._start()
+        elif not self.watching and time.time() - self._rebuilt_at > USB_MOUNT_FALLBACK_INTERVAL:
+            self._rebuild()
+        self.lookups += 1
+        return self.mounts
+
+    def first(self):
+        mounts = self.all()
+        return mounts[0] if mounts else None
+
+    def stats(self):
+        return {
+            "mounts": list(self.mounts),
+            "generation": self.generation,
+            "rebuilds": self.rebuilds,
+            "lookups": self.lookups,
+            "watching": self.watching,
+        }
+
+usb_mount_watcher = UsbMountWatcher()
+
+def find_usb_mount():
+    """Find the first available USB mount point (including submounts) from the watched mount table."""
+    return usb_mount_watcher.first()
+
+# ----------------- USB PHOTO LISTING -----------------
+
+USB_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.tiff', '.webp')
+# Camera cards nest photos a few levels down (DCIM/100CANON/...); stop well before pathological trees
+USB_LIST_MAX_DEPTH = 6
+USB_LIST_MAX_FILES = 20000
+USB_LIST_PAGE_SIZE = 200
+USB_LIST_MAX_PAGE_SIZE = 1000
+# Directories cameras and desktop OSes leave on sticks that never hold user photos
+USB_LIST_SKIP_DIRS = {"System Volume Information", "$RECYCLE.BIN", "LOST.DIR"}
+
+def iter_image_files(root, max_depth=USB_LIST_MAX_DEPTH, dir_mtimes=None):
+    """Yield image files under root depth-first, in name order, as they are found.
+
+    Uses os.scandir so file type comes from the directory entry; only matching images
+    cost a stat (for the size). Names are paths relative to root with "/" separators.
+    Hidden directories and symlinked directories are not followed. If dir_mtimes is a
+    dict it is filled with the st_mtime_ns of every directory visited.
+    """
+    stack = [("", 0)]
+    while stack:
+        rel_dir, depth = stack.pop()
+        dir_path = os.path.join(root, rel_dir) if rel_dir else root
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda e: e.name.lower())
+            if dir_mtimes is not None:
+                dir_mtimes[rel_dir] = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            name = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if depth < max_depth and not entry.name.startswith(".") \
+                            and entry.name not in USB_LIST_SKIP_DIRS:
+                        subdirs.append(name)
+                elif entry.name.lower().endswith(USB_IMAGE_EXTENSIONS) and not entry.name.startswith("._") \
+                        and entry.is_file():
+                    yield {'name': name, 'path': entry.path, 'size': entry.stat().st_size}
+            except OSError:
+                continue
+        # Reversed so the stack pops subdirectories in name order
+        stack.extend((d, depth + 1) for d in reversed(subdirs))
+
+class UsbPhotoListing:
+    """One mount's image listing, filled lazily from iter_image_files as pages are asked for."""
+
+    def __init__(self, root, mount_key):
+        self.root = root
+        self.mount_key = mount_key
+        self.token = uuid.uuid4().hex[:8]
+        self.files = []
+        self.dir_mtimes = {}
+        self.complete = False
+        self.truncated = False
+        self.lock = Lock()
+        self._walker = iter_image_files(root, dir_mtimes=self.dir_mtimes)
+
+    def fill(self, count=None):
+        """Walk until at least count files are listed (or everything, if count is None)."""
+        with self.lock:
+            while not self.complete and (count is None or len(self.files) < count):
+                if len(self.files) >= USB_LIST_MAX_FILES:
+                    self.truncated = True
+                    self.complete = True
+                    break
+                item = next(self._walker, None)
+                if item is None:
+                    self.complete = True
+                else:
+                    self.files.append(item)
+
+    def is_current(self, mount_key):
+        """True while the mount is the same and no directory walked so far has changed."""
+        if mount_key != self.mount_key:
+            return False
+        with self.lock:
+            dirs = list(self.dir_mtimes.items())
+        for rel_dir, mtime in dirs:
+            try:
+                if os.stat(os.path.join(self.root, rel_dir) if rel_dir else self.root).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+class UsbListingCache:
+    """Listing of the current USB mount, reused until the mount or a directory in it changes.
+
+    The key is the mount point, its device id and the mount watcher generation, so a
+    stick swapped for another at the same path is never served from the old listing.
+    Validating costs one stat per directory, not per file.
+    """
+
+    def __init__(self):
+        self.listing = None
+        self.builds = 0
+        self.hits = 0
+        self._lock = Lock()
+
+    def get(self, usb_path):
+        mount_key = (usb_path, os.stat(usb_path).st_dev, usb_mount_watcher.generation)
+        with self._lock:
+            listing = self.listing
+            if listing is not None and listing.is_current(mount_key):
+                self.hits += 1
+                return listing
+            listing = self.listing = UsbPhotoListing(usb_path, mount_key)
+            self.builds += 1
+            return listing
+
+    def stats(self):
+        listing = self.listing
+        return {
+            "builds": self.builds,
+            "hits": self.hits,
+            "root": listing.root if listing else None,
+            "listed": len(listing.files) if listing else 0,
+            "complete": listing.complete if listing else False,
+        }
+
+usb_listing_cache = UsbListingCache()
+
+def parse_usb_cursor(cursor, listing):
+    """Offset for a "<token>:<offset>" cursor, or None if it belongs to an older listing."""
+    if not cursor:
+        return 0
+    token, _, offset = cursor.partition(":")
+    if token != listing.token or not offset.isdigit():
+        return None
+    return int(offset)
+
+@app.route("/photo-library")
+def photo_library():
+    data = photo_index.summary()
+    return render_template("photo_library.html", data=data)
+
+@app.route("/api/photo-library/scan-usb", methods=["GET"])
+def scan_usb():
+    """Scan for USB drives"""
+    try:
+        usb_path = find_usb_mount()
+        
+        if usb_path:
+            # Counting walks the whole stick once; list-usb then pages from the cached listing
+            listing = usb_listing_cache.get(usb_path)
+            listing.fill()
+            
+            return jsonify({
+                'found': True,
+                'name': f'USB Drive ({os.path.basename(usb_path)})',
+                'path': usb_path,
+                'image_count': len(listing.files),
+                'truncated': listing.truncated
+            })
+        else:
+            return jsonify({
+                'found': False,
+                'error': 'No mounted USB drive found',
+                'checked_paths': USB_MOUNT_PATHS
+            })
+            
+    except Exception as e:
+        return jsonify({
+            'found': False,
+            'error': f'Error scanning for USB: {str(e)}'
+        })
+
+@app.route("/api/photo-library/list-usb", methods=["GET"])
+def list_usb_photos():
+    """List photos on the USB drive (including subfolders), one page at a time.
+
+    Pass the returned next_cursor as ?cursor= for the following page; it is null on
+    the last page. A cursor from before the stick changed is rejected with 409.
+    """
+    try:
+        usb_path = find_usb_mount()
+        
+        if not usb_path:
+            return jsonify({
+                'success': False,
+                'error': 'No USB drive found',
+                'photos': []
+            })
+        
+        limit = min(max(request.args.get('limit', USB_LIST_PAGE_SIZE, type=int), 1), USB_LIST_MAX_PAGE_SIZE)
+        listing = usb_listing_cache.get(usb_path)
+        offset = parse_usb_cursor(request.args.get('cursor'), listing)
+        if offset is None:
+            return jsonify({
+                'success': False,
+                'error': 'USB contents changed, reload the listing',
+                'photos': []
+            }), 409
         
-        save_photo_library(data)
+        # One extra so we know whether another page follows without walking the rest
+        listing.fill(offset + limit + 1)
+        photos = listing.files[offset:offset + limit]
+        has_more = len(listing.files) > offset + limit
         
         return jsonify({
-            "success": True,
-            "imported": imported,
-            "errors": errors,
-            "imported_count": len(imported)
+            'success': True,
+            'photos': photos,
+            'usb_path': usb_path,
+            'next_cursor': f"{listing.token}:{offset + limit}" if has_more else None,
+            'total': len(listing.files) if listing.complete else None,
+            'truncated': listing.truncated
+        })
+        
+    except Exception as e:
+        return jsonify({
+            'success': False,
+            'error': str(e),
+            'photos': []
         })
+
+# ----------------- PHOTO DERIVATIVES -----------------
+
+PHOTO_CACHE_DIR = 'photos/cache'
+# Bounding boxes served for ?size=; "screen" fits the 480x320 touchscreen
+PHOTO_VARIANTS = {"thumb": (240, 240), "screen": (480, 320)}
+# Default on-disk budget for derivatives (config: photo_cache_mb)
+PHOTO_CACHE_MB_DEFAULT = 64
+# Renders run on a small pool so a gallery load can't take every core
+PHOTO_RENDER_WORKERS = 2
+PHOTO_RENDER_TIMEOUT = 30
+PHOTO_QUALITY = 80
+# Photo URLs can be reused for new content (delete then re-upload), so revalidate via ETag
+PHOTO_CACHE_CONTROL = "no-cache"
+
+class PhotoDerivativeCache:
+    """Downscaled copies of photos on disk, LRU-evicted to stay under a byte budget.
+
+    Entries are keyed by source path + mtime + size + variant, so an edited or replaced
+    photo gets a new derivative and the stale one simply ages out. Concurrent requests
+    for the same missing variant share one render.
+    """
+
+    def __init__(self, directory, workers=PHOTO_RENDER_WORKERS):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # file name -> bytes, least recently used first
+        self._bytes = 0
+        self._originals = set()  # keys whose source is already smaller than the variant
+        self._pending = {}
+        self._loaded = False
+        self._lock = Lock()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="photo-render")
+
+    def _load(self):
+        # Index what earlier runs left behind, oldest use first (hits refresh the mtime)
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name, st.st_size))
+        for _, name, size in sorted(found):
+            self._entries[name] = size
+            self._bytes += size
+        self._loaded = True
+
+    def budget(self):
+        try:
+            return max(1, int(float(config_cache.get("photo_cache_mb", PHOTO_CACHE_MB_DEFAULT)) * 1024 * 1024))
+        except (TypeError, ValueError):
+            return PHOTO_CACHE_MB_DEFAULT * 1024 * 1024
+
+    def get(self, source, variant, fmt="jpeg"):
+        """Path to serve for `source` at `variant`: a cached derivative or the source itself."""
+        st = os.stat(source)
+        key = f"{os.path.abspath(source)}|{st.st_mtime_ns}|{st.st_size}|{variant}"
+        name = f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.{fmt}"
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if name in self._originals:
+                return source
+            future = None
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                self.hits += 1
+            else:
+                future = self._pending.get(name)
+                if future is None:
+                    self.misses += 1
+                    future = self._pool.submit(self._render, source, variant, fmt, name)
+                    self._pending[name] = future
+        if future is not None:
+            return future.result(timeout=PHOTO_RENDER_TIMEOUT)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Removed behind our back; forget it and serve the original this once
+            with self._lock:
+                self._bytes -= self._entries.pop(name, 0)
+            return source
+        return path
+
+    def _render(self, source, variant, fmt, name):
+        try:
+            box = PHOTO_VARIANTS[variant]
+            with Image.open(source) as img:
+                if max(img.size) <= min(box):
+                    with self._lock:
+                        self._originals.add(name)
+                    return source
+                # Let the JPEG decoder skip straight to roughly the target scale
+                img.draft("RGB", box)
+                img = ImageOps.exif_transpose(img)
+                img.thumbnail(box, Image.LANCZOS)
+                if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+                    img = img.convert("RGB")
+                path = os.path.join(self.directory, name)
+                tmp_path = path + ".tmp"
+                img.save(tmp_path, "WEBP" if fmt == "webp" else "JPEG", quality=PHOTO_QUALITY)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            with self._lock:
+                self._entries[name] = size
+                self._bytes += size
+                self._evict()
+            return path
+        finally:
+            with self._lock:
+                self._pending.pop(name, None)
+
+    def _evict(self):
+        budget = self.budget()
+        while self._bytes > budget and len(self._entries) > 1:
+            name, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "budget": self.budget(),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "rendering": len(self._pending),
+            }
+
+photo_cache = PhotoDerivativeCache(PHOTO_CACHE_DIR)
+
+def photo_variant_format():
+    """WebP when the browser takes it and Pillow can write it (config photo_webp), else JPEG."""
+    if (config_cache.get("photo_webp", True)
+            and "image/webp" in request.headers.get("Accept", "")
+            and pil_features.check("webp")):
+        return "webp"
+    return "jpeg"
+
+def send_photo(file_path, mimetype=None, etag=None):
+    """send_file for a photo, swapping in a cached downscaled copy when ?size= names a variant.
+
+    Pass `mimetype` for files whose name has no extension (content-addressed blobs), and
+    `etag` when the content has a known digest; otherwise the tag comes from the file's
+    mtime and size. A matching If-None-Match gets a 304 before any derivative is rendered.
+    """
+    if etag is None:
+        st = os.stat(file_path)
+        etag = f"{st.st_mtime_ns:x}-{st.st_size:x}"
+    variant = request.args.get("size")
+    if variant in PHOTO_VARIANTS and Image is not None:
+        fmt = photo_variant_format()
+        etag = f"{etag}-{variant}.{fmt}"
+    else:
+        variant = None
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = PHOTO_CACHE_CONTROL
+        if variant:
+            response.headers["Vary"] = "Accept"
+        return response
+
+    path = file_path
+    if variant:
+        try:
+            path = photo_cache.get(file_path, variant, fmt)
+        except Exception:
+            # Unreadable or exotic image: the original still works in the browser
+            path = file_path
+    if path != file_path:
+        response = send_file(os.path.abspath(path), mimetype=f"image/{fmt}", etag=etag)
+    else:
+        response = send_file(file_path, mimetype=mimetype, etag=etag)
+    if variant:
+        response.headers["Vary"] = "Accept"
+    response.headers["Cache-Control"] = PHOTO_CACHE_CONTROL
+    return response
+
+@app.template_filter("sized_photo")
+def sized_photo(url, size="thumb"):
+    """Point a library/USB photo URL at one of PHOTO_VARIANTS."""
+    if url and size in PHOTO_VARIANTS and (url.startswith("/photos/albums/")
+                                           or url.startswith("/api/photo-library/usb-preview/")):
+        return f"{url}{'&' if '?' in url else '?'}size={size}"
+    return url
+
+@app.route("/api/photo-cache-stats", methods=["GET"])
+def photo_cache_stats():
+    """Derivative cache counters for diagnostics."""
+    return jsonify({"success": True, **photo_cache.stats()})
+
+@app.route("/api/photo-library/usb-preview/<path:filename>", methods=["GET"])
+def usb_preview(filename):
+    """Serve USB photo previews"""
+    try:
+        usb_path = find_usb_mount()
+        if not usb_path:
+            return "USB not found", 404
+
+        file_path = os.path.normpath(os.path.join(usb_path, filename))
+        if not os.path.exists(file_path) or not os.path.isfile(file_path):
+            return "File not found", 404
+            
+        return send_photo(file_path)
+        
+    except Exception as e:
+        return f"Error: {str(e)}", 500
+
+@app.route("/photos/albums/<path:filename>")
+def serve_saved_photo(filename):
+    """Serve saved photos from the local library."""
+    try:
+        folder, _, name = filename.rpartition("/")
+        # Indexed photos live in the blob store; the album path covers anything not yet adopted
+        blob_path = photo_index.resolve(folder, name)
+        file_path = blob_path or os.path.normpath(os.path.join(PHOTOS_FOLDER, filename))
+        if not os.path.exists(file_path) or not os.path.isfile(file_path):
+            return "File not found", 404
+        # A blob's name is its sha256, which makes a strong validator without a stat
+        etag = os.path.basename(blob_path) if blob_path else None
+        return send_photo(file_path, mimetype=mimetypes.guess_type(name)[0], etag=etag)
+    except Exception as e:
+        return f"Error: {str(e)}", 500
+
+@app.route("/api/photo-library/list-saved", methods=["GET"])
+def list_saved_photos():
+    """List saved photos with URLs; ?folder=, ?sort=name|folder|added|size, ?order=desc, ?limit=, ?offset= page it."""
+    try:
+        limit = request.args.get("limit", type=int)
+        offset = max(0, request.args.get("offset", 0, type=int))
+        rows, total = photo_index.list_photos(
+            folder=request.args.get("folder") or None,
+            sort=request.args.get("sort", "folder"),
+            descending=request.args.get("order") == "desc",
+            limit=max(1, limit) if limit else None,
+            offset=offset,
+        )
+        photos = []
+        for row in rows:
+            photos.append({
+                "name": row["filename"],
+                "folder": row["folder"],
+                "size": row["size"],
+                "added_at": row["added_at"],
+                "url": f"/photos/albums/{row['folder']}/{row['filename']}"
+            })
+        return jsonify({"success": True, "photos": photos, "total": total, "offset": offset,
+                        "folders": photo_index.folders()})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e), "photos": []})
+
+# ----------------- PHOTO IMPORT JOBS -----------------
+
+# USB imports run on the job engine as "photo-import" jobs. Each import also keeps a
+# manifest of what it has stored, saved to disk, so one that was paused, cancelled or cut
+# short by a restart can be resumed as a new job that verifies and skips those photos.
+PHOTO_IMPORT_JOBS_FILE = 'photo_import_jobs.json'
+PHOTO_IMPORT_KIND = "photo-import"
+# Files copied at once; USB sticks rarely go faster with more
+PHOTO_IMPORT_WORKERS = 2
+# Library entries are committed every this many files or seconds, whichever comes first
+PHOTO_IMPORT_BATCH = 25
+PHOTO_IMPORT_BATCH_SECONDS = 2.0
+PHOTO_IMPORT_HISTORY = 20
+PHOTO_IMPORT_UNFINISHED = ("queued", "running")
+
+import_lock = threading.Lock()
+import_manifests = OrderedDict()  # import id -> manifest
+
+def _sync_import_status(manifest):
+    """Catch up with a job the engine dropped before it ran (caller holds import_lock)."""
+    if manifest["status"] == "queued":
+        job = job_engine.get(manifest["job_id"])
+        if job is None or job.status == "cancelled":
+            manifest.update(status="cancelled", finished_at=time.time())
+
+def import_job_to_dict(manifest):
+    _sync_import_status(manifest)
+    return {
+        "id": manifest["id"],
+        "job_id": manifest["job_id"],
+        "folder": manifest["folder"],
+        "status": manifest["status"],
+        "total": len(manifest["photos"]),
+        "done": manifest["imported_count"] + manifest["skipped_count"] + len(manifest["errors"]),
+        "imported_count": manifest["imported_count"],
+        "skipped_count": manifest["skipped_count"],
+        "errors": manifest["errors"][-20:],
+        "error_count": len(manifest["errors"]),
+        "bytes_done": manifest["bytes_done"],
+        "created_at": manifest["created_at"],
+        "finished_at": manifest["finished_at"],
+        "error": manifest["error"],
+    }
+
+def _save_import_jobs():
+    """Persist manifests (caller holds import_lock) so an interrupted import can resume."""
+    tmp_path = PHOTO_IMPORT_JOBS_FILE + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(list(import_manifests.values()), f)
+    os.replace(tmp_path, PHOTO_IMPORT_JOBS_FILE)
+
+def _trim_import_history():
+    for manifest in import_manifests.values():
+        _sync_import_status(manifest)
+    finished = [import_id for import_id, manifest in import_manifests.items()
+                if manifest["status"] not in PHOTO_IMPORT_UNFINISHED]
+    for import_id in finished[:max(0, len(finished) - PHOTO_IMPORT_HISTORY)]:
+        del import_manifests[import_id]
+
+def _queue_import(manifest):
+    """Hand a manifest to the job engine (caller holds import_lock)."""
+    job = job_engine.submit(PHOTO_IMPORT_KIND, lambda job: run_import_job(job, manifest),
+                            title=f"Import {len(manifest['photos'])} photos to {manifest['folder']}")
+    manifest.update(job_id=job.id, status="queued", error=None, finished_at=None)
+    return job
+
+def submit_import(folder, photos):
+    manifest = {
+        "id": uuid.uuid4().hex[:12],
+        "job_id": None,
+        "folder": folder,
+        "photos": list(dict.fromkeys(photos)),
+        "completed": {},  # photo name -> {"file", "size", "sha256"}
+        "errors": [],
+        "imported_count": 0,
+        "skipped_count": 0,
+        "bytes_done": 0,
+        "status": "queued",
+        "created_at": time.time(),
+        "finished_at": None,
+        "error": None,
+    }
+    with import_lock:
+        import_manifests[manifest["id"]] = manifest
+        _queue_import(manifest)
+        _trim_import_history()
+        _save_import_jobs()
+    return manifest
+
+def resume_import_job(import_id):
+    """Queue a paused or interrupted import again; already copied files are verified and skipped."""
+    with import_lock:
+        manifest = import_manifests.get(import_id)
+        if manifest is None:
+            return False, "Import job not found"
+        _sync_import_status(manifest)
+        if manifest["status"] in PHOTO_IMPORT_UNFINISHED:
+            return False, "Import job is already running"
+        if manifest["status"] == "done":
+            return False, "Import job already finished"
+        _queue_import(manifest)
+        _save_import_jobs()
+    return True, None
+
+def cancel_import(import_id):
+    """Cancel a queued or running import. Returns (manifest, error)."""
+    with import_lock:
+        manifest = import_manifests.get(import_id)
+        if manifest is None:
+            return None, "Import job not found"
+        _sync_import_status(manifest)
+        if manifest["status"] not in PHOTO_IMPORT_UNFINISHED:
+            return manifest, f"Import job is {manifest['status']}"
+        job_id = manifest["job_id"]
+    # A running import records its own end; a queued one is dropped and caught up here
+    job_engine.cancel(job_id)
+    with import_lock:
+        _sync_import_status(manifest)
+        _save_import_jobs()
+    return manifest, None
+
+def load_import_jobs():
+    """Reload manifests at startup and requeue imports a restart interrupted."""
+    try:
+        with open(PHOTO_IMPORT_JOBS_FILE, "r") as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return
+    with import_lock:
+        for manifest in saved:
+            manifest.setdefault("job_id", None)
+            manifest.pop("cancel", None)
+            import_manifests[manifest["id"]] = manifest
+            if manifest["status"] in PHOTO_IMPORT_UNFINISHED:
+                _queue_import(manifest)
+        _save_import_jobs()
+
+def import_photo(usb_path, photo_name, record):
+    """Store one photo's content; returns (file name, record, copied) where copied is False if already stored."""
+    usb_root = os.path.abspath(usb_path)
+    src = os.path.abspath(os.path.join(usb_root, photo_name))
+    if not src.startswith(usb_root + os.sep) or not os.path.isfile(src):
+        raise FileNotFoundError(f"File not found: {photo_name}")
+
+    safe_filename = secure_filename(photo_name)
+    # Resume: a photo is done if the source still hashes to the recorded content and that
+    # blob is still stored whole. Hashing reads the source but skips the write.
+    if record and record.get("sha256") and record.get("size") == os.path.getsize(src):
+        blob = photo_index.blob_path(record["sha256"])
+        if os.path.isfile(blob) and os.path.getsize(blob) == record["size"] \
+                and file_sha256(src) == record["sha256"]:
+            return safe_filename, record, False
+
+    sha256, size, written = photo_index.store_file(src)
+    return safe_filename, {"file": safe_filename, "size": size, "sha256": sha256}, written
+
+def _commit_import_batch(manifest, batch):
+    # Index first, then the manifest: a crash in between only costs a re-verify on resume
+    photo_index.add_photos(manifest["folder"], [(record["file"], record["size"], record["sha256"])
+                                                for record in batch.values()])
+    with import_lock:
+        manifest["completed"].update(batch)
+        _save_import_jobs()
+
+def _end_import(manifest, status, error=None):
+    with import_lock:
+        manifest.update(status=status, error=error, finished_at=time.time())
+        _save_import_jobs()
+    # A cancelled or failed import can leave stored blobs that nothing references
+    photo_index.schedule_garbage_collection()
+
+def run_import_job(job, manifest):
+    """Job work: store the manifest's photos, skipping ones already stored, in committed batches."""
+    with import_lock:
+        # A (re)run walks every photo; ones already stored are checked against their record and skipped
+        manifest.update(status="running", errors=[], imported_count=0, skipped_count=0, bytes_done=0)
+        pending = list(manifest["photos"])
+        records = dict(manifest["completed"])
+        _save_import_jobs()
+
+    usb_path = find_usb_mount()
+    if not usb_path:
+        _end_import(manifest, "paused", "USB drive not found")
+        raise RuntimeError("USB drive not found")
+
+    def work(photo_name):
+        if job.cancelled:
+            return photo_name, None, None
+        return (photo_name,) + import_photo(usb_path, photo_name, records.get(photo_name))[1:]
+
+    try:
+        batch = {}
+        last_commit = time.time()
+        with ThreadPoolExecutor(max_workers=PHOTO_IMPORT_WORKERS, thread_name_prefix="photo-copy") as pool:
+            futures = {pool.submit(work, name): name for name in pending}
+            for future in as_completed(futures):
+                photo_name = futures[future]
+                try:
+                    _, record, copied = future.result()
+                except Exception as e:
+                    job.log(f"{photo_name}: {e}")
+                    with import_lock:
+                        manifest["errors"].append({"photo": photo_name, "error": str(e)})
+                    continue
+                if record is None:
+                    continue
+                batch[photo_name] = record
+                with import_lock:
+                    manifest["bytes_done"] += record["size"]
+                    manifest["imported_count" if copied else "skipped_count"] += 1
+                    done = manifest["imported_count"] + manifest["skipped_count"] + len(manifest["errors"])
+                if len(batch) >= PHOTO_IMPORT_BATCH or time.time() - last_commit >= PHOTO_IMPORT_BATCH_SECONDS:
+                    _commit_import_batch(manifest, batch)
+                    batch = {}
+                    last_commit = time.time()
+                    job.report({"done": done, "total": len(pending), "percent": done * 100 // max(1, len(pending))})
+        _commit_import_batch(manifest, batch)
+    except Exception as e:
+        _end_import(manifest, "failed", str(e))
+        raise
+
+    if job.cancelled:
+        _end_import(manifest, "cancelled")
+        raise JobCancelled()
+    _end_import(manifest, "done")
+    summary = import_job_to_dict(manifest)
+    job.log(f"Imported {summary['imported_count']}, skipped {summary['skipped_count']}, "
+            f"failed {summary['error_count']} of {summary['total']}")
+    return {key: summary[key] for key in ("imported_count", "skipped_count", "error_count", "total")}
+
+load_import_jobs()
+
+@app.route("/api/photo-library/import-usb", methods=["POST"])
+def import_photos_usb():
+    """Start a background import of selected photos from USB"""
+    try:
+        folder = request.json.get('folder', 'default')
+        selected_photos = request.json.get('photos', [])
+        
+        if not selected_photos:
+            return jsonify({"success": False, "error": "No photos selected"})
+        
+        if not find_usb_mount():
+            return jsonify({"success": False, "error": "USB drive not found"})
+        
+        job = submit_import(folder, selected_photos)
+        with import_lock:
+            return jsonify({"success": True, "job_id": job["id"], "job": import_job_to_dict(job)}), 202
         
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+@app.route("/api/photo-library/import-jobs", methods=["GET"])
+def list_import_jobs():
+    with import_lock:
+        jobs = [import_job_to_dict(manifest) for manifest in import_manifests.values()]
+    return jsonify({"success": True, "jobs": jobs})
+
+@app.route("/api/photo-library/import-jobs/<job_id>", methods=["GET"])
+def get_import_job(job_id):
+    with import_lock:
+        manifest = import_manifests.get(job_id)
+        if manifest is None:
+            return jsonify({"success": False, "error": "Import job not found"}), 404
+        return jsonify({"success": True, "job": import_job_to_dict(manifest)})
+
+@app.route("/api/photo-library/import-jobs/<job_id>/cancel", methods=["POST"])
+def cancel_import_job(job_id):
+    manifest, error = cancel_import(job_id)
+    if manifest is None:
+        return jsonify({"success": False, "error": error}), 404
+    if error:
+        return jsonify({"success": False, "error": error}), 409
+    with import_lock:
+        return jsonify({"success": True, "job": import_job_to_dict(manifest)})
+
+@app.route("/api/photo-library/import-jobs/<job_id>/resume", methods=["POST"])
+def resume_import_job_route(job_id):
+    if job_id not in import_manifests:
+        return jsonify({"success": False, "error": "Import job not found"}), 404
+    ok, error = resume_import_job(job_id)
+    if not ok:
+        return jsonify({"success": False, "error": error}), 409
+    return jsonify({"success": True})
+
 @app.route("/api/photo-library/create-folder", methods=["POST"])
 def create_folder():
     """Create a new photo folder"""
@@ -528,18 +3137,9 @@ def create_folder():
         if not folder_name:
             return jsonify({"success": False, "error": "Folder name required"})
         
-        data = load_photo_library()
-        
-        if folder_name in data["folders"]:
+        if not photo_index.add_folder(folder_name):
             return jsonify({"success": False, "error": "Folder already exists"})
         
-        folder_path = os.path.join(PHOTOS_FOLDER, folder_name)
-        os.makedirs(folder_path, exist_ok=True)
-        os.chmod(folder_path, 0o775)
-        
-        data["folders"].append(folder_name)
-        save_photo_library(data)
-        
         return jsonify({"success": True, "folder": folder_name})
         
     except Exception as e:
@@ -625,6 +3225,8 @@ def debug_usb():
 
         # Report detected mount using shared logic
         debug_info['detected_mount'] = find_usb_mount()
+        debug_info['mount_watcher'] = usb_mount_watcher.stats()
+        debug_info['usb_listing'] = usb_listing_cache.stats()
         
         return jsonify(debug_info)
         
@@ -687,232 +3289,205 @@ def upload_photos():
     folder = request.form.get('folder', 'default')
     files = request.files.getlist('photos')
     
-    data = load_photo_library()
-    folder_path = os.path.join(PHOTOS_FOLDER, folder)
-    os.makedirs(folder_path, exist_ok=True)
-    os.chmod(folder_path, 0o775)
-    
+    os.makedirs(photo_index.blobs_dir, exist_ok=True)
     for file in files:
         filename = secure_filename(file.filename)
-        file_path = os.path.join(folder_path, filename)
-        file.save(file_path)
-        os.chmod(file_path, 0o664)
-        data["photos"][filename] = folder
+        # Save beside the blobs so storing it is a rename (or a delete if we already have it)
+        tmp_path = os.path.join(photo_index.blobs_dir, f".{uuid.uuid4().hex}.upload")
+        file.save(tmp_path)
+        sha256, size, _ = photo_index.store_file(tmp_path, move=True)
+        photo_index.add_photo(folder, filename, size, sha256)
     
-    save_photo_library(data)
     return jsonify({"success": True})
 
 @app.route("/api/photo-library/manage", methods=["POST"])
 def manage_photos():
+    """Folder/photo actions; photos are identified by name plus (optionally) their folder."""
     action = request.json.get("action")
-    data = load_photo_library()
     
     if action == "create_folder":
         folder_name = request.json.get("folder")
-        if folder_name not in data["folders"]:
-            folder_path = os.path.join(PHOTOS_FOLDER, folder_name)
-            os.makedirs(folder_path, exist_ok=True)
-            os.chmod(folder_path, 0o775)
-            data["folders"].append(folder_name)
+        if folder_name:
+            photo_index.add_folder(folder_name)
     
     elif action == "delete_folder":
         folder_name = request.json.get("folder")
-        if folder_name in data["folders"] and folder_name != 'default':
-            shutil.rmtree(os.path.join(PHOTOS_FOLDER, folder_name))
-            data["folders"].remove(folder_name)
-            data["photos"] = {k: v for k, v in data["photos"].items() if v != folder_name}
+        if folder_name in photo_index.folders() and folder_name != 'default':
+            photo_index.delete_folder(folder_name)
+            # Pre-blob-store album directory, if one is left over
+            shutil.rmtree(os.path.join(PHOTOS_FOLDER, folder_name), ignore_errors=True)
+            photo_index.collect_garbage()
+            photo_index.schedule_garbage_collection()
     
-    elif action == "move_photo":
+    elif action in ("move_photo", "delete_photo"):
         photo = request.json.get("photo")
-        new_folder = request.json.get("new_folder")
-        old_folder = data["photos"].get(photo, 'default')
-        old_path = os.path.join(PHOTOS_FOLDER, old_folder, photo)
-        new_path = os.path.join(PHOTOS_FOLDER, new_folder, photo)
-        
-        if os.path.exists(old_path):
-            shutil.move(old_path, new_path)
-            os.chmod(new_path, 0o664)
-            data["photos"][photo] = new_folder
-        else:
+        folder = request.json.get("folder") or photo_index.find_folder(photo) or 'default'
+        if not photo_index.has_photo(folder, photo):
             return jsonify({"success": False, "error": "Photo does not exist"}), 404
-    
-    elif action == "delete_photo":
-        photo = request.json.get("photo")
-        folder = data["photos"].get(photo, 'default')
-        photo_path = os.path.join(PHOTOS_FOLDER, folder, photo)
         
-        if os.path.exists(photo_path):
-            os.remove(photo_path)
-            del data["photos"][photo]
+        if action == "move_photo":
+            new_folder = str(request.json.get("new_folder") or "").strip()
+            if new_folder not in photo_index.folders():
+                new_folder = secure_filename(new_folder)
+            if not new_folder:
+                return jsonify({"success": False, "error": "Destination folder required"}), 400
+            if new_folder == folder:
+                return jsonify({"success": False, "error": "Photo is already in that folder"}), 400
+            # Content stays put in the blob store; only the reference moves
+            photo_index.move_photo(folder, photo, new_folder)
         else:
-            return jsonify({"success": False, "error": "Photo does not exist"}), 404
+            photo_index.delete_photo(folder, photo)
+            photo_index.collect_garbage()
+            photo_index.schedule_garbage_collection()
     
-    save_photo_library(data)
-    return jsonify({"success": True, "data": data})
+    return jsonify({"success": True, "data": photo_index.summary()})
 
 # New endpoint to check test status
 @app.route("/test-in-progress")
 def check_test_in_progress():
     """Check if a test is currently running."""
-    return jsonify({"testing": test_in_progress})
+    return jsonify({"testing": relay_controller.busy})
 
 # Testing endpoints
-@app.route("/time-test")
-def time_test():
-    """Run sequential relay test with 1 second delays."""
-    global test_in_progress
-    
-    # Check if test is already running
-    if test_in_progress:
-        return jsonify({"status": "Another test is currently in progress"}), 409
-        
-    try:
-        with test_lock:
-            test_in_progress = True
-            
-            # Reset all relays to OFF first
-            initialize_relay_states()
-            time.sleep(0.5)  # Small delay after reset
-            
-            for relay_name, relay in relay_pins.items():
-                # Turn on relay
-                relay.on()
-                states = load_relay_states()
-                states[relay_name] = True
-                save_relay_states(states)
-                time.sleep(1)
-                
-                # Turn off relay
-                relay.off()
-                states = load_relay_states()
-                states[relay_name] = False
-                save_relay_states(states)
-                time.sleep(0.5)  # Small delay between relays
-            
-            return jsonify({"status": "Time test completed successfully!"})
-    except Exception as e:
-        return jsonify({"status": f"Error during time test: {str(e)}"}), 500
-    finally:
-        test_in_progress = False
+def run_relay_test(kind):
+    """Start a relay test as a background job; its result is the test's status message.
+
+    The controller decides whether the relays are free: it starts the test at once or
+    refuses it with RelayBusy, which becomes a 409.
+    """
+    started = Future()
+    test = relay_controller.submit(RunTest(kind, lambda: started.set_result(True)))
+    wait_futures((started, test), timeout=5, return_when=FIRST_COMPLETED)
+    if not started.done():
+        try:
+            test.result(timeout=0)
+        except RelayBusy:
+            return jsonify({"success": False, "status": "Another test is currently in progress"}), 409
+        except Exception as e:
+            test.cancel()
+            return jsonify({"success": False, "status": f"Could not start the test: {e}"}), 503
+
+    def work(job):
+        return test.result()
+
+    # Cancelling stops the test on the controller, which turns every relay off
+    job = job_engine.submit("relay-test", work, title=f"{kind} test",
+                            on_cancel=lambda: relay_controller.submit(AllOff()))
+    return jsonify({"success": True, "job_id": job.id, "job": job.to_dict()}), 202
+
+@app.route("/time-test")
+def time_test():
+    """Run sequential relay test with 1 second delays."""
+    return run_relay_test("time")
 
 @app.route("/self-test")
 def self_test():
     """Run a deterministic relay self test (sequential on/off)."""
-    global test_in_progress
-    
-    # Check if test is already running
-    if test_in_progress:
-        return jsonify({"status": "Another test is currently in progress"}), 409
-        
-    try:
-        with test_lock:
-            test_in_progress = True
-            self_test_progress["active"] = True
-            self_test_progress["relay"] = None
-            self_test_progress["action"] = None
-            self_test_progress["step"] = 0
-            self_test_progress["steps"] = len(relay_pins) * 4
-            
-            # Reset all relays to OFF first
-            initialize_relay_states()
-            time.sleep(0.5)  # Small delay after reset
-            
-            # Run a clear on/off sequence for each relay
-            for relay_name, relay in relay_pins.items():
-                # Pulse on
-                self_test_progress["step"] += 1
-                self_test_progress["relay"] = relay_name
-                self_test_progress["action"] = "ON"
-                relay.on()
-                states = load_relay_states()
-                states[relay_name] = True
-                save_relay_states(states)
-                time.sleep(0.6)
-
-                # Pulse off
-                self_test_progress["step"] += 1
-                self_test_progress["action"] = "OFF"
-                relay.off()
-                states = load_relay_states()
-                states[relay_name] = False
-                save_relay_states(states)
-                time.sleep(0.3)
-
-                # Second pulse on
-                self_test_progress["step"] += 1
-                self_test_progress["action"] = "ON"
-                relay.on()
-                states = load_relay_states()
-                states[relay_name] = True
-                save_relay_states(states)
-                time.sleep(0.4)
-
-                # Final off before moving on
-                self_test_progress["step"] += 1
-                self_test_progress["action"] = "OFF"
-                relay.off()
-                states = load_relay_states()
-                states[relay_name] = False
-                save_relay_states(states)
-                time.sleep(0.2)
-
-            # Turn all relays off at the end
-            initialize_relay_states()
-            return jsonify({"status": "Self test completed successfully!"})
-    except Exception as e:
-        return jsonify({"status": f"Error during self test: {str(e)}"}), 500
-    finally:
-        test_in_progress = False
-        self_test_progress["active"] = False
+    return run_relay_test("self")
 
 @app.route("/toggle-all/<state>")
 def toggle_all(state):
     """Toggle all relays on or off."""
-    if test_in_progress:
-        return jsonify({"error": "Cannot toggle relays while test is in progress"}), 409
-        
     try:
         new_state = state.lower() == "on"
-        states = {}
-        
-        for relay_name, relay in relay_pins.items():
-            if new_state:
-                relay.on()
-            else:
-                relay.off()
-            states[relay_name] = new_state
-        
-        save_relay_states(states)
+        states = relay_controller.call(SetRelays({name: new_state for name in relay_controller.snapshot.names}))
         return jsonify({"status": "success", "states": states})
+    except RelayBusy:
+        return jsonify({"error": "Cannot toggle relays while test is in progress"}), 409
     except Exception as e:
         return jsonify({"status": "error", "message": str(e)}), 500
 
-# ENHANCED WiFi ENDPOINTS WITH NETWORKMANAGER SUPPORT
+# ----------------- NETWORK BACKENDS -----------------
 
-@app.route("/scan-wifi-networks")
-def scan_wifi_networks():
-    """Scan for available WiFi networks with enhanced NetworkManager support."""
-    try:
+# NetworkManager D-Bus API names
+NM_BUS_NAME = "org.freedesktop.NetworkManager"
+NM_PATH = "/org/freedesktop/NetworkManager"
+NM_IFACE = "org.freedesktop.NetworkManager"
+NM_DEVICE_IFACE = NM_IFACE + ".Device"
+NM_WIRELESS_IFACE = NM_IFACE + ".Device.Wireless"
+NM_AP_IFACE = NM_IFACE + ".AccessPoint"
+NM_ACTIVE_IFACE = NM_IFACE + ".Connection.Active"
+NM_IP4_IFACE = NM_IFACE + ".IP4Config"
+NM_SETTINGS_PATH = NM_PATH + "/Settings"
+NM_SETTINGS_IFACE = NM_IFACE + ".Settings"
+NM_CONNECTION_IFACE = NM_IFACE + ".Settings.Connection"
+
+NM_DEVICE_TYPE_WIFI = 2
+NM_DEVICE_STATE_ACTIVATED = 100
+NM_DEVICE_STATE_FAILED = 120
+NM_REASON_NO_SECRETS = 7
+NM_REASON_SSID_NOT_FOUND = 53
+NM_AP_FLAGS_PRIVACY = 0x1
+NM_AP_SEC_KEY_MGMT_PSK = 0x100
+NM_AP_SEC_KEY_MGMT_SAE = 0x400
+
+# Seconds to wait on a single bus call, a requested scan and a connection attempt
+NM_CALL_TIMEOUT = 5
+NM_SCAN_TIMEOUT = 10
+NM_CONNECT_TIMEOUT = 30
+# Seconds before "auto" tries the D-Bus backend again after it was unavailable
+NETWORK_BACKEND_RETRY = 60
+# Config key network_backend: "auto" (D-Bus, nmcli on failure), "dbus" or "nmcli"
+NETWORK_BACKEND_DEFAULT = "auto"
+
+class NetworkBackendError(Exception):
+    """The backend itself failed (no bus, NetworkManager gone, permission denied)."""
+
+    def __init__(self, message, dbus_name=None):
+        super().__init__(message)
+        self.dbus_name = dbus_name
+
+class NmcliBackend:
+    """Drives NetworkManager by spawning `nmcli` (via sudo where needed) and parsing its output."""
+
+    name = "nmcli"
+
+    def check_status(self):
+        # Check if NetworkManager service is running
+        nm_status = subprocess.run(
+            ["sudo", "systemctl", "is-active", "NetworkManager"],
+            capture_output=True,
+            text=True
+        )
+
+        if nm_status.returncode != 0:
+            return False, "NetworkManager service not running"
+
+        # Check if wifi radio is enabled
+        radio_status = subprocess.run(
+            ["nmcli", "radio", "wifi"],
+            capture_output=True,
+            text=True
+        )
+
+        if "enabled" not in radio_status.stdout:
+            # Try to enable wifi radio
+            subprocess.run(["sudo", "nmcli", "radio", "wifi", "on"], capture_output=True)
+
+        return True, "NetworkManager is ready"
+
+    def scan(self):
+        """Returns (True, networks) or (False, error)."""
         # First check if NetworkManager is enabled and working
         nm_status = subprocess.run(
             ["sudo", "systemctl", "is-active", "NetworkManager"],
             capture_output=True,
             text=True
         )
-        
+
         if nm_status.returncode != 0:
-            return jsonify({"success": False, "error": "NetworkManager is not running. Please enable it first."})
-        
+            return False, "NetworkManager is not running. Please enable it first."
+
         # Check if wifi device is available and managed
         device_check = subprocess.run(
             ["nmcli", "device", "status"],
             capture_output=True,
             text=True
         )
-        
+
         if device_check.returncode != 0:
-            return jsonify({"success": False, "error": "Cannot access NetworkManager devices"})
-        
+            return False, "Cannot access NetworkManager devices"
+
         # Look for wifi device in output
         wifi_device = None
         for line in device_check.stdout.strip().split('\n')[1:]:  # Skip header
@@ -920,47 +3495,47 @@ def scan_wifi_networks():
             if len(parts) >= 2 and parts[1] == "wifi":
                 wifi_device = parts[0]
                 break
-        
+
         if not wifi_device:
-            return jsonify({"success": False, "error": "No WiFi device found"})
-        
+            return False, "No WiFi device found"
+
         # Enable wifi device if it's disabled
-        enable_result = subprocess.run(
+        subprocess.run(
             ["sudo", "nmcli", "radio", "wifi", "on"],
             capture_output=True,
             text=True
         )
-        
+
         # Ensure the device is managed
-        manage_result = subprocess.run(
+        subprocess.run(
             ["sudo", "nmcli", "device", "set", wifi_device, "managed", "yes"],
             capture_output=True,
             text=True
         )
-        
+
         # Force a rescan
-        rescan_result = subprocess.run(
+        subprocess.run(
             ["sudo", "nmcli", "device", "wifi", "rescan"],
             capture_output=True,
             text=True
         )
-        
+
         # Small delay for scan to complete
         time.sleep(2)
-        
+
         # Get the list of networks with more robust command
         result = subprocess.run(
             ["nmcli", "-t", "-f", "SSID,SIGNAL,SECURITY,BARS", "device", "wifi", "list"],
             capture_output=True,
             text=True
         )
-        
+
         if result.returncode != 0:
-            return jsonify({"success": False, "error": f"WiFi scan failed: {result.stderr}"})
-        
+            return False, f"WiFi scan failed: {result.stderr}"
+
         networks = []
         seen_ssids = set()
-        
+
         # Parse the output (format: SSID:SIGNAL:SECURITY:BARS)
         for line in result.stdout.strip().split('\n'):
             if line:
@@ -969,41 +3544,29 @@ def scan_wifi_networks():
                     ssid = parts[0]
                     signal = int(parts[1]) if parts[1].isdigit() else 0
                     security = bool(parts[2].strip())  # True if there's any security
-                    
+
                     networks.append({
                         "ssid": ssid,
                         "signal": signal,
                         "security": security
                     })
                     seen_ssids.add(ssid)
-        
+
         # Sort by signal strength (strongest first)
         networks.sort(key=lambda x: x["signal"], reverse=True)
-        
-        return jsonify({"success": True, "networks": networks})
-        
-    except Exception as e:
-        return jsonify({"success": False, "error": f"Scan error: {str(e)}"})
 
-@app.route("/connect-wifi", methods=["POST"])
-def connect_wifi():
-    """Connect to a WiFi network with enhanced error handling."""
-    try:
-        data = request.json
-        if not data or "ssid" not in data:
-            return jsonify({"success": False, "error": "SSID is required"}), 400
-        
-        ssid = data["ssid"]
-        password = data.get("password", "")
-        
+        return True, networks
+
+    def connect(self, ssid, password=""):
+        """Returns (True, message) or (False, error)."""
         # First, delete any existing connection with the same SSID to avoid conflicts
-        delete_existing = subprocess.run(
+        subprocess.run(
             ["sudo", "nmcli", "connection", "delete", ssid],
             capture_output=True,
             text=True
         )
         # Don't check return code as connection might not exist
-        
+
         # Use nmcli to connect to the network with more robust parameters
         if password:
             # For secured networks
@@ -1018,104 +3581,596 @@ def connect_wifi():
                 "sudo", "nmcli", "device", "wifi", "connect", ssid,
                 "name", ssid
             ], capture_output=True, text=True)
-        
+
         if result.returncode == 0:
             # Wait a moment for connection to establish
             time.sleep(3)
-            
+
             # Verify connection
             status_check = subprocess.run(
                 ["nmcli", "-t", "-f", "GENERAL.CONNECTION", "device", "show", "wlan0"],
                 capture_output=True,
                 text=True
             )
-            
+
             if ssid in status_check.stdout:
-                return jsonify({
-                    "success": True, 
-                    "message": f"Successfully connected to {ssid}"
-                })
-            else:
-                return jsonify({
-                    "success": False,
-                    "error": "Connection appeared to succeed but verification failed"
-                })
-        else:
-            error_msg = result.stderr or result.stdout
-            
-            # Handle common error cases
-            if "Secrets were required" in error_msg:
-                return jsonify({
-                    "success": False,
-                    "error": "Invalid password"
-                })
-            elif "No network with SSID" in error_msg:
-                return jsonify({
-                    "success": False,
-                    "error": "Network not found. Try scanning again."
-                })
-            else:
-                return jsonify({
-                    "success": False, 
-                    "error": f"Connection failed: {error_msg}"
-                })
-                
-    except Exception as e:
-        return jsonify({"success": False, "error": f"Connection error: {str(e)}"})
+                return True, f"Successfully connected to {ssid}"
+            return False, "Connection appeared to succeed but verification failed"
 
-@app.route("/wifi-status")
-def wifi_status():
-    """Get current WiFi connection status with enhanced error handling."""
-    try:
+        error_msg = result.stderr or result.stdout
+
+        # Handle common error cases
+        if "Secrets were required" in error_msg:
+            return False, "Invalid password"
+        if "No network with SSID" in error_msg:
+            return False, "Network not found. Try scanning again."
+        return False, f"Connection failed: {error_msg}"
+
+    def wifi_status(self):
         # Check if connected to WiFi using nmcli
         connection_result = subprocess.run(
             ["nmcli", "-t", "-f", "GENERAL.CONNECTION,GENERAL.STATE", "device", "show", "wlan0"],
             capture_output=True,
             text=True
         )
-        
+
         if connection_result.returncode != 0:
-            return jsonify({"connected": False, "error": "Cannot check WiFi status"})
-        
+            return {"connected": False, "error": "Cannot check WiFi status"}
+
         # Parse the output
         lines = connection_result.stdout.strip().split('\n')
         connection_name = ""
         device_state = ""
-        
+
         for line in lines:
             if line.startswith("GENERAL.CONNECTION:"):
                 connection_name = line.split(':', 1)[1].strip()
             elif line.startswith("GENERAL.STATE:"):
                 device_state = line.split(':', 1)[1].strip()
-        
+
         # Check if device is connected (state 100)
         is_connected = "100" in device_state and connection_name and connection_name != "--"
+
+        if not is_connected:
+            return {"connected": False}
+
+        # Get IP address
+        ip_result = subprocess.run(
+            ["nmcli", "-t", "-f", "IP4.ADDRESS", "device", "show", "wlan0"],
+            capture_output=True,
+            text=True
+        )
+
+        ip = "Unknown"
+        if ip_result.returncode == 0:
+            for line in ip_result.stdout.strip().split('\n'):
+                if line.startswith("IP4.ADDRESS"):
+                    # Extract IP from format like "IP4.ADDRESS[1]:192.168.1.100/24"
+                    ip_part = line.split(':', 1)[1].strip()
+                    ip = ip_part.split('/')[0] if '/' in ip_part else ip_part
+                    break
+
+        return {"connected": True, "ssid": connection_name, "ip": ip}
+
+    def reset(self):
+        """Delete every saved WiFi connection. Returns how many were removed."""
+        removed = 0
+        wifi_connections_result = subprocess.run(
+            ["nmcli", "-t", "-f", "NAME,TYPE", "connection", "show"],
+            capture_output=True,
+            text=True
+        )
+
+        if wifi_connections_result.returncode == 0:
+            for line in wifi_connections_result.stdout.strip().split('\n'):
+                if line and ':wifi' in line:
+                    connection_name = line.split(':')[0]
+                    subprocess.run(
+                        ["sudo", "nmcli", "connection", "delete", connection_name],
+                        capture_output=True,
+                        text=True
+                    )
+                    removed += 1
+        return removed
+
+class NetworkManagerDBus:
+    """Talks to NetworkManager over one persistent system-bus connection.
+
+    Properties are read straight off the bus instead of parsing nmcli text, and the
+    PropertiesChanged/StateChanged signals NetworkManager emits wake pending scans and
+    connection attempts and invalidate the cached WiFi status. The bus address follows
+    DBUS_SYSTEM_BUS_ADDRESS, so a fake NetworkManager (e.g. python-dbusmock's template)
+    can stand in for the real one.
+    """
+
+    name = "dbus"
+
+    def __init__(self, bus="SYSTEM"):
+        if open_dbus_connection is None:
+            raise NetworkBackendError("jeepney is not installed")
+        self.bus = bus
+        self.calls = 0
+        self.signals = 0
+        self._router = None
+        self._lock = threading.RLock()
+        self._cond = threading.Condition()
+        self._device = None
+        self._device_states = {}
+        self._last_scan = {}
+        self._status = None
+        self._open()
+
+    # --- connection ---
+
+    def _open(self):
+        try:
+            router = DBusRouter(open_dbus_connection(bus=self.bus))
+        except Exception as e:
+            raise NetworkBackendError(f"Cannot connect to the system bus: {e}")
+        signals = Queue()
+        # Signals carry NetworkManager's unique name as sender, so filter locally by path only
+        router.filter(MatchRule(type="signal", path_namespace=NM_PATH), queue=signals)
+        self._router = router
+        try:
+            self._call(message_bus.AddMatch(
+                MatchRule(type="signal", sender=NM_BUS_NAME, path_namespace=NM_PATH)))
+            if not self._call(message_bus.NameHasOwner(NM_BUS_NAME))[0]:
+                raise NetworkBackendError("NetworkManager is not running")
+        except NetworkBackendError:
+            self._drop(router)
+            raise
+        threading.Thread(target=self._signal_loop, args=(router, signals),
+                         name="nm-signals", daemon=True).start()
+
+    def _drop(self, router):
+        with self._lock:
+            if self._router is router:
+                self._router = None
+        with self._cond:
+            self._device = None
+            self._status = None
+        try:
+            router.close()
+            router.conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        """Disconnect from the bus; the next call connects again."""
+        router = self._router
+        if router is not None:
+            self._drop(router)
+
+    def _call(self, msg, timeout=NM_CALL_TIMEOUT):
+        with self._lock:
+            if self._router is None:
+                self._open()
+            router = self._router
+        self.calls += 1
+        try:
+            return unwrap_msg(router.send_and_get_reply(msg, timeout=timeout))
+        except DBusErrorResponse as e:
+            detail = " ".join(str(d) for d in e.data) if e.data else e.name
+            raise NetworkBackendError(detail, dbus_name=e.name)
+        except Exception as e:
+            # Bus went away or stopped answering; reconnect on the next call
+            self._drop(router)
+            raise NetworkBackendError(f"D-Bus call failed: {e or type(e).__name__}")
+
+    def _signal_loop(self, router, signals):
+        while self._router is router:
+            try:
+                msg = signals.get(timeout=5)
+            except Empty:
+                continue
+            self._handle_signal(msg)
+
+    def _handle_signal(self, msg):
+        fields = msg.header.fields
+        path = fields.get(HeaderFields.path)
+        iface = fields.get(HeaderFields.interface)
+        member = fields.get(HeaderFields.member)
+        with self._cond:
+            self.signals += 1
+            if member == "PropertiesChanged":
+                prop_iface, changed = msg.body[0], msg.body[1]
+                if prop_iface == NM_WIRELESS_IFACE and "LastScan" in changed:
+                    self._last_scan[path] = changed["LastScan"][1]
+                elif prop_iface == NM_DEVICE_IFACE and "StateReason" in changed:
+                    self._device_states[path] = tuple(changed["StateReason"][1])
+            elif iface == NM_DEVICE_IFACE and member == "StateChanged":
+                self._device_states[path] = (msg.body[0], msg.body[2])
+            elif iface == NM_IFACE and member in ("DeviceAdded", "DeviceRemoved"):
+                self._device = None
+            self._status = None
+            self._cond.notify_all()
+
+    # --- bus helpers ---
+
+    def _addr(self, path, iface):
+        return DBusAddress(path, bus_name=NM_BUS_NAME, interface=iface)
+
+    def _method(self, path, iface, method, signature=None, body=(), timeout=NM_CALL_TIMEOUT):
+        return self._call(new_method_call(self._addr(path, iface), method, signature, body), timeout)
+
+    def _get(self, path, iface, prop):
+        return self._call(Properties(self._addr(path, iface)).get(prop))[0][1]
+
+    def _get_all(self, path, iface):
+        props = self._call(Properties(self._addr(path, iface)).get_all())[0]
+        return {key: value[1] for key, value in props.items()}
+
+    def _set(self, path, iface, prop, signature, value):
+        self._call(Properties(self._addr(path, iface)).set(prop, signature, value))
+
+    def _wifi_device(self):
+        with self._cond:
+            if self._device:
+                return self._device
+        for path in self._method(NM_PATH, NM_IFACE, "GetDevices")[0]:
+            if self._get(path, NM_DEVICE_IFACE, "DeviceType") == NM_DEVICE_TYPE_WIFI:
+                with self._cond:
+                    self._device = path
+                return path
+        return None
+
+    def _enable_radio(self, device):
+        if not self._get(NM_PATH, NM_IFACE, "WirelessEnabled"):
+            self._set(NM_PATH, NM_IFACE, "WirelessEnabled", "b", True)
+        if device and not self._get(device, NM_DEVICE_IFACE, "Managed"):
+            self._set(device, NM_DEVICE_IFACE, "Managed", "b", True)
+
+    def _access_points(self, device):
+        """Yield (path, props) for every access point NetworkManager currently sees."""
+        for ap in self._method(device, NM_WIRELESS_IFACE, "GetAllAccessPoints")[0]:
+            try:
+                yield ap, self._get_all(ap, NM_AP_IFACE)
+            except NetworkBackendError as e:
+                if not e.dbus_name:
+                    raise
+                # The access point vanished between listing and reading it
+
+    def _delete_connections(self, match):
+        removed = 0
+        for path in self._method(NM_SETTINGS_PATH, NM_SETTINGS_IFACE, "ListConnections")[0]:
+            settings = self._method(path, NM_CONNECTION_IFACE, "GetSettings")[0]
+            flat = {group: {key: value[1] for key, value in values.items()}
+                    for group, values in settings.items()}
+            if match(flat.get("connection", {})):
+                self._method(path, NM_CONNECTION_IFACE, "Delete")
+                removed += 1
+        return removed
+
+    # --- backend API ---
+
+    def check_status(self):
+        self._enable_radio(None)
+        return True, "NetworkManager is ready"
+
+    def scan(self):
+        """Returns (True, networks) or (False, error)."""
+        device = self._wifi_device()
+        if not device:
+            return False, "No WiFi device found"
+        self._enable_radio(device)
+        try:
+            before = self._get(device, NM_WIRELESS_IFACE, "LastScan")
+        except NetworkBackendError as e:
+            if not e.dbus_name:
+                raise
+            before = None  # NetworkManager older than 1.12
+        with self._cond:
+            self._last_scan[device] = before
+        try:
+            self._method(device, NM_WIRELESS_IFACE, "RequestScan", "a{sv}", ({},))
+            requested = True
+        except NetworkBackendError as e:
+            if not e.dbus_name:
+                raise
+            # Refused right after a previous scan; the current list is fresh anyway
+            requested = False
+        if requested:
+            if before is None:
+                time.sleep(2)
+            else:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._last_scan.get(device) != before, NM_SCAN_TIMEOUT)
+
+        best = {}
+        for _, props in self._access_points(device):
+            ssid = bytes(props.get("Ssid", b"")).decode("utf-8", "replace")
+            if not ssid:
+                continue
+            signal = int(props.get("Strength", 0))
+            security = bool(props.get("Flags", 0) & NM_AP_FLAGS_PRIVACY
+                            or props.get("WpaFlags", 0) or props.get("RsnFlags", 0))
+            if ssid not in best or signal > best[ssid]["signal"]:
+                best[ssid] = {"ssid": ssid, "signal": signal, "security": security}
+
+        networks = sorted(best.values(), key=lambda x: x["signal"], reverse=True)
+        return True, networks
+
+    def connect(self, ssid, password=""):
+        """Returns (True, message) or (False, error)."""
+        device = self._wifi_device()
+        if not device:
+            return False, "No WiFi device found"
+        self._delete_connections(lambda conn: conn.get("id") == ssid)
+
+        target = None
+        for ap, props in self._access_points(device):
+            if bytes(props.get("Ssid", b"")).decode("utf-8", "replace") == ssid:
+                if target is None or props.get("Strength", 0) > target[1].get("Strength", 0):
+                    target = (ap, props)
+        if target is None:
+            return False, "Network not found. Try scanning again."
+
+        settings = {
+            "connection": {"id": ("s", ssid), "type": ("s", "802-11-wireless")},
+            "802-11-wireless": {"ssid": ("ay", ssid.encode("utf-8")), "mode": ("s", "infrastructure")},
+        }
+        if password:
+            rsn = target[1].get("RsnFlags", 0)
+            key_mgmt = "sae" if rsn & NM_AP_SEC_KEY_MGMT_SAE and not rsn & NM_AP_SEC_KEY_MGMT_PSK else "wpa-psk"
+            settings["802-11-wireless-security"] = {"key-mgmt": ("s", key_mgmt), "psk": ("s", password)}
+
+        with self._cond:
+            self._device_states.pop(device, None)
+        try:
+            self._method(NM_PATH, NM_IFACE, "AddAndActivateConnection", "a{sa{sv}}oo",
+                         (settings, device, target[0]))
+        except NetworkBackendError as e:
+            if not e.dbus_name or e.dbus_name.endswith("PermissionDenied"):
+                raise
+            return False, f"Connection failed: {e}"
+
+        # Wait for NetworkManager to report the attempt finished instead of sleeping blindly
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self._device_states.get(device, (None,))[0]
+                in (NM_DEVICE_STATE_ACTIVATED, NM_DEVICE_STATE_FAILED),
+                NM_CONNECT_TIMEOUT)
+            state, reason = self._device_states.get(device, (None, None))
+
+        if state == NM_DEVICE_STATE_FAILED:
+            if reason == NM_REASON_NO_SECRETS:
+                return False, "Invalid password"
+            if reason == NM_REASON_SSID_NOT_FOUND:
+                return False, "Network not found. Try scanning again."
+            return False, f"Connection failed: NetworkManager reason {reason}"
+        status = self.wifi_status()
+        if status.get("connected") and status.get("ssid") == ssid:
+            return True, f"Successfully connected to {ssid}"
+        return False, "Connection appeared to succeed but verification failed"
+
+    def wifi_status(self):
+        with self._cond:
+            if self._status is not None:
+                return dict(self._status)
+            seen = self.signals
+        status = {"connected": False}
+        device = self._wifi_device()
+        if device:
+            props = self._get_all(device, NM_DEVICE_IFACE)
+            active = props.get("ActiveConnection", "/")
+            if props.get("State") == NM_DEVICE_STATE_ACTIVATED and active != "/":
+                ip = "Unknown"
+                ip4 = props.get("Ip4Config", "/")
+                if ip4 != "/":
+                    addresses = self._get(ip4, NM_IP4_IFACE, "AddressData")
+                    if addresses and "address" in addresses[0]:
+                        ip = addresses[0]["address"][1]
+                status = {"connected": True, "ssid": self._get(active, NM_ACTIVE_IFACE, "Id"), "ip": ip}
+        with self._cond:
+            # Only cache if nothing changed while we were reading
+            if self.signals == seen:
+                self._status = status
+        return dict(status)
+
+    def reset(self):
+        """Delete every saved WiFi connection. Returns how many were removed."""
+        return self._delete_connections(lambda conn: conn.get("type") == "802-11-wireless")
+
+nmcli_backend = NmcliBackend()
+network_backend = None
+network_backend_error = None
+network_backend_failed_at = 0.0
+network_backend_fallbacks = 0
+network_backend_lock = Lock()
+
+def get_network_backend_choice():
+    choice = str(config_cache.get("network_backend", NETWORK_BACKEND_DEFAULT)).lower()
+    return choice if choice in ("auto", "dbus", "nmcli") else NETWORK_BACKEND_DEFAULT
+
+def get_network_backend():
+    """The backend Wi-Fi operations should use, connecting to D-Bus on first use."""
+    global network_backend, network_backend_error, network_backend_failed_at
+    if get_network_backend_choice() == "nmcli":
+        return nmcli_backend
+    with network_backend_lock:
+        if network_backend is None and time.time() - network_backend_failed_at >= NETWORK_BACKEND_RETRY:
+            try:
+                network_backend = NetworkManagerDBus()
+                network_backend_error = None
+            except NetworkBackendError as e:
+                network_backend_error = str(e)
+                network_backend_failed_at = time.time()
+        if network_backend is None and get_network_backend_choice() == "dbus":
+            raise NetworkBackendError(network_backend_error or "D-Bus backend unavailable")
+        return network_backend or nmcli_backend
+
+def network_call(method, *args):
+    """Run a Wi-Fi operation on the configured backend, retrying with nmcli if D-Bus fails under "auto"."""
+    global network_backend_error, network_backend_fallbacks
+    backend = get_network_backend()
+    try:
+        return getattr(backend, method)(*args)
+    except NetworkBackendError as e:
+        if backend is nmcli_backend or get_network_backend_choice() == "dbus":
+            raise
+        network_backend_error = str(e)
+        network_backend_fallbacks += 1
+        return getattr(nmcli_backend, method)(*args)
+
+@app.route("/api/network-backend", methods=["GET"])
+def network_backend_info():
+    """Which Wi-Fi backend is in use and why D-Bus was last bypassed."""
+    try:
+        backend = get_network_backend()
+    except NetworkBackendError:
+        backend = None
+    info = {
+        "success": True,
+        "configured": get_network_backend_choice(),
+        "backend": backend.name if backend else None,
+        "error": network_backend_error,
+        "fallbacks": network_backend_fallbacks,
+    }
+    if isinstance(backend, NetworkManagerDBus):
+        info.update({"calls": backend.calls, "signals": backend.signals})
+    return jsonify(info)
+
+# ENHANCED WiFi ENDPOINTS WITH NETWORKMANAGER SUPPORT
+
+# ----------------- WIFI SCANNER -----------------
+
+# Default seconds before cached scan results count as stale (config: wifi_scan_interval)
+WIFI_SCAN_INTERVAL_DEFAULT = 60
+# Keep rescanning in the background only while someone looked at results this recently
+WIFI_SCAN_IDLE_AFTER = 300
+# Longest a request will wait for an in-flight scan when asked to (or when nothing is cached)
+WIFI_SCAN_WAIT_TIMEOUT = 20
+
+class WifiScanner:
+    """Background Wi-Fi scanner serving a timestamped cache of parsed networks.
+
+    Requests never run a scan themselves: they read the cache and, when it is
+    stale or a refresh is asked for, start a scan that every concurrent caller
+    shares, so there is only ever one scan in flight.
+    """
+
+    def __init__(self, scan_func):
+        self.scan_func = scan_func
+        self.networks = []
+        self.error = None
+        self.scanned_at = None
+        self.scans = 0
+        self._scanning = False
+        self._last_access = 0.0
+        self._lock = Lock()
+        self._done = threading.Event()
+        self._done.set()
+        self._thread = None
+
+    def interval(self):
+        try:
+            return max(5.0, float(config_cache.get("wifi_scan_interval", WIFI_SCAN_INTERVAL_DEFAULT)))
+        except (TypeError, ValueError):
+            return WIFI_SCAN_INTERVAL_DEFAULT
+
+    def is_stale(self):
+        return self.scanned_at is None or time.time() - self.scanned_at > self.interval()
+
+    def request_scan(self):
+        """Start a scan for a client unless one is already running. Returns True if a new scan started."""
+        with self._lock:
+            self._last_access = time.time()
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._refresh_loop, name="wifi-rescan", daemon=True)
+                self._thread.start()
+        return self._start_scan()
+
+    def _start_scan(self):
+        # Not a client visit, so periodic rescans don't keep themselves alive
+        with self._lock:
+            if self._scanning:
+                return False
+            self._scanning = True
+            self._done.clear()
+        threading.Thread(target=self._scan, name="wifi-scan", daemon=True).start()
+        return True
+
+    def _scan(self):
+        try:
+            ok, result = self.scan_func()
+        except Exception as e:
+            ok, result = False, f"Scan error: {str(e)}"
+        with self._lock:
+            if ok:
+                self.networks = result
+                self.error = None
+            else:
+                self.error = result
+            self.scanned_at = time.time()
+            self.scans += 1
+            self._scanning = False
+            self._done.set()
+
+    def _refresh_loop(self):
+        # Periodic rescans while the Wi-Fi screen is in use; idle kiosks leave the radio alone
+        # until the next request_scan() starts the loop again
+        while True:
+            time.sleep(self.interval())
+            with self._lock:
+                if time.time() - self._last_access >= WIFI_SCAN_IDLE_AFTER:
+                    self._thread = None
+                    return
+            self._start_scan()
+
+    def wait(self, timeout=WIFI_SCAN_WAIT_TIMEOUT):
+        return self._done.wait(timeout)
+
+    def snapshot(self):
+        with self._lock:
+            self._last_access = time.time()
+            age = time.time() - self.scanned_at if self.scanned_at else None
+            return {
+                "networks": list(self.networks),
+                "error": self.error,
+                "scanned_at": self.scanned_at,
+                "age": age,
+                "fresh": age is not None and age <= self.interval(),
+                "scanning": self._scanning,
+            }
+
+wifi_scanner = WifiScanner(lambda: network_call("scan"))
+
+@app.route("/scan-wifi-networks")
+def scan_wifi_networks():
+    """Cached WiFi networks; ?refresh=1 forces a rescan, ?wait=1 waits for it to finish."""
+    try:
+        if request.args.get("refresh") == "1" or wifi_scanner.is_stale():
+            wifi_scanner.request_scan()
+        if request.args.get("wait") == "1" or wifi_scanner.scanned_at is None:
+            wifi_scanner.wait()
+        snapshot = wifi_scanner.snapshot()
+        if snapshot["error"] and not snapshot["networks"]:
+            return jsonify({"success": False, **snapshot})
+        return jsonify({"success": True, **snapshot})
+    except Exception as e:
+        return jsonify({"success": False, "error": f"Scan error: {str(e)}"})
+
+@app.route("/connect-wifi", methods=["POST"])
+def connect_wifi():
+    """Connect to a WiFi network with enhanced error handling."""
+    try:
+        data = request.json
+        if not data or "ssid" not in data:
+            return jsonify({"success": False, "error": "SSID is required"}), 400
         
-        if is_connected:
-            # Get IP address
-            ip_result = subprocess.run(
-                ["nmcli", "-t", "-f", "IP4.ADDRESS", "device", "show", "wlan0"],
-                capture_output=True,
-                text=True
-            )
-            
-            ip = "Unknown"
-            if ip_result.returncode == 0:
-                for line in ip_result.stdout.strip().split('\n'):
-                    if line.startswith("IP4.ADDRESS"):
-                        # Extract IP from format like "IP4.ADDRESS[1]:192.168.1.100/24"
-                        ip_part = line.split(':', 1)[1].strip()
-                        ip = ip_part.split('/')[0] if '/' in ip_part else ip_part
-                        break
-            
-            return jsonify({
-                "connected": True,
-                "ssid": connection_name,
-                "ip": ip
-            })
-        else:
-            return jsonify({"connected": False})
-            
+        ok, message = network_call("connect", data["ssid"], data.get("password", ""))
+        if ok:
+            return jsonify({"success": True, "message": message})
+        return jsonify({"success": False, "error": message})
+                
+    except Exception as e:
+        return jsonify({"success": False, "error": f"Connection error: {str(e)}"})
+
+@app.route("/wifi-status")
+def wifi_status():
+    """Get current WiFi connection status with enhanced error handling."""
+    try:
+        return jsonify(network_call("wifi_status"))
     except Exception as e:
         return jsonify({"connected": False, "error": str(e)})
 
@@ -1187,21 +4242,12 @@ def load_usb_wifi_config():
         if not ssid or not password:
             return jsonify({"message": "Invalid WiFi config file format."}), 400
 
-        # Use the enhanced connect method
-        # Delete existing connection first
-        subprocess.run(["sudo", "nmcli", "connection", "delete", ssid], capture_output=True)
-        
-        # Connect using NetworkManager
-        result = subprocess.run([
-            "sudo", "nmcli", "device", "wifi", "connect", ssid,
-            "password", password,
-            "name", ssid
-        ], capture_output=True, text=True)
-        
-        if result.returncode == 0:
+        # Use the enhanced connect method (replaces any existing connection)
+        ok, message = network_call("connect", ssid, password)
+        if ok:
             return jsonify({"message": f"Successfully loaded WiFi config for SSID: {ssid}."})
         else:
-            return jsonify({"message": f"Failed to connect to {ssid}: {result.stderr or result.stdout}"}), 400
+            return jsonify({"message": f"Failed to connect to {ssid}: {message}"}), 400
     except Exception as e:
         return jsonify({"message": f"Error loading WiFi config: {e}"}), 500
 
@@ -1210,114 +4256,178 @@ def reset_network_settings():
     """Reset network settings with better error handling."""
     try:
         # Delete all WiFi connections
-        wifi_connections_result = subprocess.run(
-            ["nmcli", "-t", "-f", "NAME,TYPE", "connection", "show"],
-            capture_output=True,
-            text=True
-        )
-        
-        if wifi_connections_result.returncode == 0:
-            for line in wifi_connections_result.stdout.strip().split('\n'):
-                if line and ':wifi' in line:
-                    connection_name = line.split(':')[0]
-                    subprocess.run(
-                        ["sudo", "nmcli", "connection", "delete", connection_name],
-                        capture_output=True,
-                        text=True
-                    )
-        
+        network_call("reset")
         return jsonify({"message": "All WiFi network settings have been reset."})
     except Exception as e:
         return jsonify({"message": f"Error resetting network settings: {e}"}), 500
 
-# System update with real-time log streaming
-@app.route("/system-update-logs")
-def system_update_logs():
-    def generate():
-        ok, msg = preflight_checks()
-        if not ok:
-            yield f"data: Preflight failed: {msg}\n\n"
-            return
-        yield "data: Preflight OK. Starting system update...\n\n"
-        # Fix: Use shell=True and pass the command as a single string
-        process = subprocess.Popen(
-            "sudo apt-get update && sudo apt-get full-upgrade -y",
-            stdout=subprocess.PIPE, 
-            stderr=subprocess.STDOUT,  # Redirect stderr to stdout to capture all output
-            text=True, 
-            shell=True
-        )
-        
-        for line in process.stdout:
-            yield f"data: {line.strip()}\n\n"
-        
-        process.wait()
-        if process.returncode == 0:
-            yield "data: Update completed successfully. Rebooting...\n\n"
-            # Use a separate thread to allow the response to complete before rebooting
-            threading.Thread(target=lambda: subprocess.call("sudo reboot", shell=True)).start()
+# Seconds between a successful system update and the reboot, so viewers see the result
+SYSTEM_UPDATE_REBOOT_DELAY = 5
+
+APT_SUMMARY_RE = re.compile(r"^(\d+) upgraded, (\d+) newly installed")
+APT_FETCH_RE = re.compile(r"^Get:\d+ \S+ \S+ \S+ (\S+) ")
+APT_UNPACK_RE = re.compile(r"^Unpacking (\S+)")
+APT_SETUP_RE = re.compile(r"^Setting up (\S+)")
+
+class AptProgress:
+    """Turns apt-get output into structured progress for the system update job.
+
+    The "N upgraded, M newly installed" summary gives the package total; each
+    package is then fetched ("Get:"), unpacked and set up. `done` counts packages
+    set up; `percent` weighs the three stages 20/30/50.
+    """
+
+    def __init__(self):
+        self.phase = "update"
+        self.total = None
+        self.counts = {"fetched": 0, "unpacked": 0, "configured": 0}
+
+    def feed(self, line):
+        """Progress dict if `line` moved the update on, else None."""
+        match = APT_SUMMARY_RE.match(line)
+        if match:
+            self.total = int(match.group(1)) + int(match.group(2))
+            self.phase = "download" if self.total else "done"
+            return self._progress(None)
+        if self.total is None:
+            # Index downloads of `apt-get update` also print "Get:" lines
+            return None
+        for pattern, phase, count in ((APT_FETCH_RE, "download", "fetched"),
+                                      (APT_UNPACK_RE, "unpack", "unpacked"),
+                                      (APT_SETUP_RE, "configure", "configured")):
+            match = pattern.match(line)
+            if match:
+                self.phase = phase
+                self.counts[count] += 1
+                return self._progress(match.group(1))
+        return None
+
+    def _progress(self, package):
+        total = self.total or 0
+        if total:
+            stages = (0.2 * self.counts["fetched"] + 0.3 * self.counts["unpacked"]
+                      + 0.5 * self.counts["configured"])
+            percent = min(100, round(100 * stages / total))
         else:
-            yield "data: Update failed. Check logs.\n\n"
+            percent = 100
+        return {"phase": self.phase, "package": package, "done": min(self.counts["configured"], total),
+                "total": total, "percent": percent, **self.counts}
 
-    return Response(generate(), content_type="text/event-stream")
+def run_system_update(job):
+    """apt-get update + full-upgrade, then reboot; output goes to the job log."""
+    ok, msg = preflight_checks()
+    if not ok:
+        job.log(f"Preflight failed: {msg}")
+        raise RuntimeError(f"Preflight failed: {msg}")
+    job.log("Preflight OK. Starting system update...")
+    code, _ = job.run_process("sudo apt-get update && sudo apt-get full-upgrade -y", shell=True)
+    if code != 0:
+        job.log("Update failed. Check logs.")
+        raise RuntimeError(f"apt-get exited with status {code}")
+    job.log("Update completed successfully. Rebooting...")
+    threading.Timer(SYSTEM_UPDATE_REBOOT_DELAY, lambda: subprocess.call("sudo reboot", shell=True)).start()
+    return "System update completed. Rebooting now..."
 
-@app.route("/git-pull")
-def git_pull():
-    """Safely update the app repository."""
+def submit_system_update():
+    return job_engine.submit("system-update", run_system_update, group="update",
+                             title="System update", progress=AptProgress(), unique=True)
+
+def job_event_stream(job, last_event_id):
+    """SSE for a job's ring: the backlog after `last_event_id` (from the start without one), then live.
+
+    A viewer that fell further behind than the ring holds gets a `state` event with
+    the job status and how many lines it missed, then everything still kept.
+    """
     try:
-        ok, msg = preflight_checks()
-        if not ok:
-            return jsonify({"success": False, "error": f"Preflight failed: {msg}"})
+        last = max(0, int(last_event_id)) if last_event_id not in (None, "") else 0
+    except (TypeError, ValueError):
+        last = 0
+    oldest = job.events.oldest()
+    if last < oldest - 1:
+        yield sse_message(oldest - 1, "state", dict(job.snapshot(), missed=oldest - 1 - last))
+        last = oldest - 1
+    yield from job.events.stream(str(last), job.snapshot)
 
-        backup_state()
+# System update log: decoupled from the update itself, so viewers can come and go
+@app.route("/system-update-logs")
+def system_update_logs():
+    """Follow the system update's output (?job=<id>, default the latest update).
 
-        repo_path = BASE_DIR
-        current = run_cmd(["git", "-C", repo_path, "rev-parse", "HEAD"])
-        if current.returncode == 0 and current.stdout.strip():
-            write_commit_marker(".pre_update_commit", current.stdout.strip())
-        fsck = run_cmd(["git", "-C", repo_path, "fsck", "--full"])
-        if fsck.returncode != 0:
-            # Attempt repair by reinitializing from origin
-            origin = run_cmd(["git", "-C", repo_path, "remote", "get-url", "origin"])
-            if origin.returncode != 0:
-                return jsonify({"success": False, "error": "Git corruption detected and no origin remote found"})
-            origin_url = origin.stdout.strip()
-            # Remove .git and re-init
-            shutil.rmtree(os.path.join(repo_path, ".git"), ignore_errors=True)
-            run_cmd(["git", "-C", repo_path, "init"])
-            run_cmd(["git", "-C", repo_path, "remote", "add", "origin", origin_url])
-
-        # Fetch and hard reset to origin/HEAD
-        fetch = run_cmd(["git", "-C", repo_path, "fetch", "--all", "--prune"])
-        if fetch.returncode != 0:
-            return jsonify({"success": False, "error": fetch.stderr or fetch.stdout})
-
-        head = run_cmd(["git", "-C", repo_path, "symbolic-ref", "refs/remotes/origin/HEAD"])
-        branch = "origin/main"
-        if head.returncode == 0 and head.stdout.strip():
-            branch = head.stdout.strip().replace("refs/remotes/", "")
-
-        reset = run_cmd(["git", "-C", repo_path, "reset", "--hard", branch])
-        if reset.returncode != 0:
-            return jsonify({"success": False, "error": reset.stderr or reset.stdout})
+    Reconnecting with Last-Event-ID resumes exactly where the viewer left off. This
+    never starts an update; POST /system-update does.
+    """
+    job_id = request.args.get("job")
+    job = job_engine.get(job_id) if job_id else job_engine.latest("system-update")
+    if job is None or job.kind != "system-update":
+        return jsonify({"success": False, "error": "No system update to follow"}), 404
+    last_event_id = request.headers.get("Last-Event-ID") or request.args.get("last_event_id")
+    return Response(job_event_stream(job, last_event_id), content_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
-        ok_health, health_msg = health_check()
-        if not ok_health:
-            # Auto rollback
-            prev = read_commit_marker(".pre_update_commit")
-            if prev:
-                run_cmd(["git", "-C", repo_path, "reset", "--hard", prev])
-                return jsonify({"success": False, "error": f"Update failed health check. Rolled back. {health_msg}"})
-            return jsonify({"success": False, "error": f"Update failed health check. {health_msg}"})
-
-        # Mark last known good
-        new_head = run_cmd(["git", "-C", repo_path, "rev-parse", "HEAD"])
-        if new_head.returncode == 0 and new_head.stdout.strip():
-            write_commit_marker(".last_good_commit", new_head.stdout.strip())
-
-        return jsonify({"success": True, "output": f"Updated to {branch}\n{reset.stdout.strip()}"})
-    except Exception as e:
-        return jsonify({"success": False, "error": str(e)}), 500
+def run_app_update(job):
+    """Safely update the app repository; raises RuntimeError with the reason on failure."""
+    job.log("Running preflight checks...")
+    ok, msg = preflight_checks()
+    if not ok:
+        raise RuntimeError(f"Preflight failed: {msg}")
+
+    job.log(f"Backed up settings to {backup_state()}")
+
+    repo_path = BASE_DIR
+    current = run_cmd(["git", "-C", repo_path, "rev-parse", "HEAD"])
+    if current.returncode == 0 and current.stdout.strip():
+        write_commit_marker(".pre_update_commit", current.stdout.strip())
+    job.log("Checking repository integrity...")
+    code, _ = job.run_process(["git", "-C", repo_path, "fsck", "--full"])
+    if code != 0:
+        # Attempt repair by reinitializing from origin
+        origin = run_cmd(["git", "-C", repo_path, "remote", "get-url", "origin"])
+        if origin.returncode != 0:
+            raise RuntimeError("Git corruption detected and no origin remote found")
+        origin_url = origin.stdout.strip()
+        job.log(f"Repository is corrupt; re-initialising from {origin_url}")
+        # Remove .git and re-init
+        shutil.rmtree(os.path.join(repo_path, ".git"), ignore_errors=True)
+        run_cmd(["git", "-C", repo_path, "init"])
+        run_cmd(["git", "-C", repo_path, "remote", "add", "origin", origin_url])
+
+    # Fetch and hard reset to origin/HEAD
+    job.log("Fetching updates...")
+    code, output = job.run_process(["git", "-C", repo_path, "fetch", "--all", "--prune"])
+    if code != 0:
+        raise RuntimeError(output.strip() or "git fetch failed")
+
+    head = run_cmd(["git", "-C", repo_path, "symbolic-ref", "refs/remotes/origin/HEAD"])
+    branch = "origin/main"
+    if head.returncode == 0 and head.stdout.strip():
+        branch = head.stdout.strip().replace("refs/remotes/", "")
+
+    job.check_cancelled()
+    code, output = job.run_process(["git", "-C", repo_path, "reset", "--hard", branch])
+    if code != 0:
+        raise RuntimeError(output.strip() or "git reset failed")
+
+    ok_health, health_msg = health_check()
+    if not ok_health:
+        # Auto rollback
+        prev = read_commit_marker(".pre_update_commit")
+        if prev:
+            run_cmd(["git", "-C", repo_path, "reset", "--hard", prev])
+            raise RuntimeError(f"Update failed health check. Rolled back. {health_msg}")
+        raise RuntimeError(f"Update failed health check. {health_msg}")
+
+    # Mark last known good
+    new_head = run_cmd(["git", "-C", repo_path, "rev-parse", "HEAD"])
+    if new_head.returncode == 0 and new_head.stdout.strip():
+        write_commit_marker(".last_good_commit", new_head.stdout.strip())
+
+    return f"Updated to {branch}\n{output.strip()}"
+
+@app.route("/git-pull")
+def git_pull():
+    """Start a safe app update as a background job (or return the one already running)."""
+    job = job_engine.submit("app-update", run_app_update, group="update", title="App update", unique=True)
+    return jsonify({"success": True, "job_id": job.id, "job": job.to_dict()}), 202
 
 @app.route("/api/rollback", methods=["POST"])
 def rollback_update():
@@ -1374,24 +4484,169 @@ def test_mode():
 
 @app.route("/toggle/<relay_name>")
 def toggle_relay(relay_name):
-    if test_in_progress:
+    try:
+        states = relay_controller.call(SetRelays({relay_name: None}))
+    except RelayBusy:
         return jsonify({"error": "Cannot toggle relay while test is in progress"}), 409
-        
-    relay = relay_pins.get(relay_name)
-    if relay:
-        relay.toggle()
-        states = load_relay_states()
-        states[relay_name] = relay.is_active
-        save_relay_states(states)
-    return jsonify({"state": relay.is_active})
+    except KeyError:
+        return jsonify({"error": f"Unknown relay {relay_name}"}), 404
+    return jsonify({"state": states[relay_name]})
 
 @app.route("/get-states")
 def get_states():
+    return jsonify(relay_controller.snapshot.states)
+
+@app.route("/api/relay-backend", methods=["GET"])
+def relay_backend_info():
+    """Which backend drives the relay outputs, with its write counts and switching skew."""
+    return jsonify({
+        "success": True,
+        "configured": get_relay_backend_choice(),
+        **relay_controller.backend_stats(),
+        "controller": relay_controller.stats(),
+    })
+
+# Longest pulse (and gap between repeats) the relay APIs accept, in seconds
+RELAY_PULSE_MAX = 600
+RELAY_PULSE_REPEAT_MAX = 100
+
+def _pulse_seconds(value, what):
     try:
-        states = load_relay_states()
-        return jsonify(states)
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        seconds = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid {what} {value!r}")
+    if not math.isfinite(seconds) or not 0 < seconds <= RELAY_PULSE_MAX:
+        raise ValueError(f"{what} must be between 0 and {RELAY_PULSE_MAX} seconds")
+    return seconds
+
+def parse_pulse_spec(command):
+    """PulseSpec from a command's "pulse" seconds plus optional "repeat" count and "gap" seconds."""
+    on_for = _pulse_seconds(command["pulse"], "pulse")
+    repeat = command.get("repeat", 1)
+    if isinstance(repeat, bool) or not isinstance(repeat, int) or not 1 <= repeat <= RELAY_PULSE_REPEAT_MAX:
+        raise ValueError(f"repeat must be a whole number from 1 to {RELAY_PULSE_REPEAT_MAX}")
+    off_for = _pulse_seconds(command.get("gap", on_for), "gap") if repeat > 1 else 0.0
+    return PulseSpec(on_for, off_for, repeat)
+
+def parse_relay_batch(commands, relays):
+    """Turn batch commands into (states, pulses) keyed by relay name; raises ValueError.
+
+    Each command names a relay (by name, or 1-based index as drink steps do) and either a
+    "state" (true/false/"on"/"off") or a "pulse" in seconds, optionally with "repeat" and
+    a "gap" in seconds between repeats. A relay may appear only once.
+    """
+    if not isinstance(commands, list) or not commands:
+        raise ValueError("commands must be a non-empty list")
+    states, pulses = {}, {}
+    for idx, command in enumerate(commands, start=1):
+        if not isinstance(command, dict):
+            raise ValueError(f"command {idx} is not an object")
+        relay = relays.resolve(command.get("relay"))
+        if relay is None:
+            raise ValueError(f"command {idx}: unknown relay {command.get('relay')!r}")
+        name = relay.name
+        if name in states or name in pulses:
+            raise ValueError(f"command {idx}: {name} appears more than once")
+        if "pulse" in command:
+            try:
+                pulses[name] = parse_pulse_spec(command)
+            except ValueError as e:
+                raise ValueError(f"command {idx}: {e}")
+        elif "state" in command:
+            state = command["state"]
+            if isinstance(state, str) and state.lower() in ("on", "off"):
+                state = state.lower() == "on"
+            if not isinstance(state, bool):
+                raise ValueError(f"command {idx}: state must be true/false or \"on\"/\"off\"")
+            states[name] = state
+        else:
+            raise ValueError(f"command {idx}: needs a state or a pulse")
+    return states, pulses
+
+@app.route("/api/relays/batch", methods=["POST"])
+def relay_batch():
+    """Apply several relay states and pulses as one change; returns the resulting states."""
+    data = request.get_json(silent=True) or {}
+    try:
+        states, pulses = parse_relay_batch(data.get("commands"), relay_controller.snapshot.relays)
+        result = relay_controller.call(SetRelays(states, pulses))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except KeyError as e:
+        # Relays were reconfigured between parsing and applying
+        return jsonify({"success": False, "error": f"Unknown relay {e.args[0]}"}), 400
+    except RelayBusy as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    return jsonify({"success": True, "states": result,
+                    "pulses": {name: spec._asdict() for name, spec in pulses.items()}})
+
+def pulse_to_dict(name, pulse, now):
+    return {
+        "relay": name,
+        "on_for": pulse.spec.on_for,
+        "off_for": pulse.spec.off_for,
+        "repeat": pulse.spec.repeat,
+        "remaining": pulse.remaining,
+        "on": pulse.on,
+        "next_change_in": max(0.0, pulse.deadline - now),
+    }
+
+@app.route("/api/relays/pulses", methods=["GET", "POST", "DELETE"])
+def relay_pulses():
+    """Timed relay pulses run by the relay controller, so their length never depends on the browser.
+
+    POST {"relay", "duration", "repeat"?, "gap"?} (or {"pulses": [...]} of those) starts
+    pulses, replacing any running on the same relays. DELETE cancels the pulse on
+    `relay`, or every pulse without one. GET lists the running pulses.
+    """
+    if request.method == "GET":
+        now = time.monotonic()
+        return jsonify({"success": True, "pulses": [
+            pulse_to_dict(name, pulse, now) for name, pulse in relay_controller.snapshot.pulses.items()
+        ]})
+    data = request.get_json(silent=True) or {}
+    relays = relay_controller.snapshot.relays
+    try:
+        if request.method == "DELETE":
+            ref = data.get("relay", request.args.get("relay"))
+            names = None
+            if ref is not None:
+                relay = relays.resolve(int(ref) if isinstance(ref, str) and ref.isdigit() else ref)
+                if relay is None:
+                    return jsonify({"success": False, "error": f"Unknown relay {ref!r}"}), 404
+                names = [relay.name]
+            cancelled = relay_controller.call(CancelPulses(names))
+            return jsonify({"success": True, "cancelled": cancelled, "states": relay_controller.snapshot.states})
+        entries = data.get("pulses") if "pulses" in data else [data]
+        if not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+            raise ValueError("pulses must be a list of objects")
+        commands = []
+        for entry in entries:
+            if "duration" not in entry:
+                raise ValueError("each pulse needs a duration")
+            command = {key: entry[key] for key in ("relay", "repeat", "gap") if key in entry}
+            command["pulse"] = entry["duration"]
+            commands.append(command)
+        _, pulses = parse_relay_batch(commands, relays)
+        states = relay_controller.call(SetRelays({}, pulses))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except KeyError as e:
+        # Relays were reconfigured between parsing and applying
+        return jsonify({"success": False, "error": f"Unknown relay {e.args[0]}"}), 400
+    except RelayBusy as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    now = time.monotonic()
+    return jsonify({"success": True, "states": states, "pulses": [
+        pulse_to_dict(name, relay_controller.snapshot.pulses[name], now)
+        for name in pulses if name in relay_controller.snapshot.pulses
+    ]})
+
+@app.route("/api/relay-stream")
+def relay_stream():
+    """Server-Sent Events: a `state` snapshot, then one `relay` delta per change."""
+    return sse_response(relay_events, lambda: {"states": relay_controller.snapshot.states,
+                                               "testing": relay_controller.busy})
 
 @app.route("/settings")
 def settings():
@@ -1402,29 +4657,60 @@ def settings():
 @app.route("/api/relays", methods=["GET", "POST"])
 def relays_config():
     if request.method == "GET":
-        return jsonify({"success": True, "relays": get_relay_config()})
+        return jsonify({
+            "success": True,
+            "relays": get_relay_config(),
+            "drivers": list(RELAY_DRIVERS),
+            "max_relays": MAX_RELAYS,
+            "max_concurrent_relays": get_max_concurrent_relays() or 0
+        })
     data = request.json or {}
     relays = data.get("relays", [])
     if not isinstance(relays, list) or len(relays) == 0:
         return jsonify({"success": False, "error": "Relay list required"}), 400
-    cleaned = []
+    if len(relays) > MAX_RELAYS:
+        return jsonify({"success": False, "error": f"At most {MAX_RELAYS} relays are supported"}), 400
+    entries = []
+    names, outputs = set(), set()
     for idx, relay in enumerate(relays, start=1):
-        name = (relay.get("name") or f"Relay {idx}").strip()
         try:
-            gpio = int(relay.get("gpio"))
-        except Exception:
-            return jsonify({"success": False, "error": f"Invalid GPIO for {name}"}), 400
-        cleaned.append({"name": name, "gpio": gpio})
+            entry = clean_relay_entry(idx, relay)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        output = relay_group_key(entry) + (entry.gpio,)
+        if entry.name in names:
+            return jsonify({"success": False, "error": f"Relay name {entry.name!r} is used twice"}), 400
+        if entry.driver != "mock" and output in outputs:
+            return jsonify({"success": False, "error": f"{entry.name} uses an output already assigned"}), 400
+        names.add(entry.name)
+        outputs.add(output)
+        entries.append(entry)
+    cleaned = [relay_config_entry(entry) for entry in entries]
     config = get_config()
     config["relays"] = cleaned
-    save_config(config)
-    init_relay_pins()
-    return jsonify({"success": True, "relays": cleaned})
+    if "max_concurrent_relays" in data:
+        try:
+            config["max_concurrent_relays"] = max(0, int(data.get("max_concurrent_relays") or 0))
+        except (TypeError, ValueError):
+            return jsonify({"success": False, "error": "Invalid max concurrent relays"}), 400
+    # Open the new outputs before saving, so a set that can't be driven is never persisted
+    try:
+        relay_controller.call(Reconfigure(RelayRegistry(entries)))
+    except RelayBusy as e:
+        return jsonify({"success": False, "error": str(e)}), 409
+    except Exception as e:
+        return jsonify({"success": False, "error": f"Could not open the relay outputs: {e}"}), 400
+    try:
+        save_config(config)
+    except Exception as e:
+        init_relay_pins()
+        return jsonify({"success": False, "error": f"Could not save the relay config: {e}"}), 500
+    return jsonify({"success": True, "relays": cleaned, "max_concurrent_relays": config.get("max_concurrent_relays", 0)})
 
 @app.route("/api/system-name", methods=["GET", "POST"])
 def system_name():
     if request.method == "GET":
-        return jsonify({"system_name": get_config().get("system_name", "Drinks Bro")})
+        return jsonify({"system_name": config_cache.get("system_name", "Drinks Bro")})
     data = request.json or {}
     name = data.get("system_name", "").strip()
     if not name:
@@ -1454,6 +4740,11 @@ def screensaver():
     save_config(cfg)
     return jsonify({"success": True})
 
+@app.route("/api/config-stats", methods=["GET"])
+def config_stats():
+    """Config cache counters (file parses vs. stat checks)."""
+    return jsonify({"success": True, **config_cache.stats()})
+
 @app.route("/api/version-history", methods=["GET"])
 def version_history():
     try:
@@ -1486,33 +4777,466 @@ def check_updates():
 
 @app.route("/system-update", methods=["POST"])
 def system_update():
-    """
-    Perform a system update.
-    """
+    """Start a system update as a background job; follow it at /api/jobs/<job_id>."""
+    job = submit_system_update()
+    return jsonify({"status": "System update started.", "job_id": job.id, "job": job.to_dict()}), 202
+
+@app.route("/api/jobs", methods=["GET"])
+def list_jobs():
+    return jsonify({"success": True, "jobs": [job.to_dict(tail=0) for job in job_engine.jobs()],
+                    **job_engine.stats()})
+
+@app.route("/api/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """Job status, timings and the last `tail` output lines (default 50)."""
+    job = job_engine.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
     try:
-        update_command = "sudo apt-get update && sudo apt-get full-upgrade -y"
-        result = subprocess.run(update_command, shell=True, text=True, capture_output=True)
-        if result.returncode != 0:
-            return jsonify({"status": "System update failed.", "details": result.stderr}), 500
+        tail = max(0, min(JOB_EVENT_HISTORY, int(request.args.get("tail", 50))))
+    except ValueError:
+        tail = 50
+    return jsonify({"success": True, "job": job.to_dict(tail=tail)})
 
-        # Schedule reboot
-        subprocess.Popen(["sudo", "reboot"])
-        return jsonify({"status": "System update completed. Rebooting now..."})
-    except Exception as e:
-        return jsonify({"status": "System update failed.", "details": str(e)}), 500
+@app.route("/api/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job(job_id):
+    job = job_engine.cancel(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    if job.finished and job.status != "cancelled":
+        return jsonify({"success": False, "error": f"Job is {job.status}"}), 409
+    return jsonify({"success": True, "job": job.to_dict()})
 
 @app.route("/reboot", methods=["POST"])
 def reboot_system():
     initialize_relay_states()
+    relay_state_store.flush()
     os.system("sudo reboot")
     return jsonify({"status": "System is rebooting..."})
 
 @app.route("/shutdown", methods=["POST"])
 def shutdown_system():
     initialize_relay_states()
+    relay_state_store.flush()
     os.system("sudo shutdown now")
     return jsonify({"status": "System is shutting down..."})
 
+# ----------------- DRINK PLANS -----------------
+
+# Settle time between the initial all-off reset and the first pour event
+POUR_LEAD_TIME = 0.5
+
+# One relay transition at an absolute offset (seconds) from the start of the pour
+PlanEvent = namedtuple("PlanEvent", ["at", "step", "relay_name", "on"])
+# A drink compiled against the current relay outputs; steps/step_offsets keep the original numbering
+DrinkPlan = namedtuple("DrinkPlan", ["name", "source", "concurrent", "events", "total_time", "steps",
+                                     "step_offsets", "generation", "max_concurrent"])
+
+drink_plans = {}
+# Measured timing of the last pour per drink id: list of per-event lateness in seconds
+drink_timings = {}
+
+# Above this many distinct pours the concurrent scheduler uses LPT instead of an exact search
+EXACT_SCHEDULE_LIMIT = 12
+
+def get_max_concurrent_relays():
+    """Power-supply limit on simultaneously active relays from config (None = unlimited)."""
+    try:
+        limit = int(config_cache.get("max_concurrent_relays") or 0)
+    except (TypeError, ValueError):
+        return None
+    return limit if limit > 0 else None
+
+def _validate_step(name, idx, step, relays):
+    """Validate one raw drink step; returns (relay_name, on, duration)."""
+    if not isinstance(step, dict):
+        raise ValueError(f"{name}: step {idx} is not an object")
+    action = str(step.get("action", "")).lower()
+    if action not in ("on", "off"):
+        raise ValueError(f"{name}: step {idx} has invalid action {step.get('action')!r}")
+    try:
+        duration = float(step.get("time", 0))
+    except (TypeError, ValueError):
+        raise ValueError(f"{name}: step {idx} has invalid time {step.get('time')!r}")
+    if not math.isfinite(duration) or duration < 0:
+        raise ValueError(f"{name}: step {idx} has invalid time {step.get('time')!r}")
+    try:
+        relay_idx = int(step.get("relay")) - 1
+    except (TypeError, ValueError):
+        raise ValueError(f"{name}: step {idx} has invalid relay {step.get('relay')!r}")
+    if not 0 <= relay_idx < len(relays):
+        raise ValueError(f"{name}: step {idx} uses relay {relay_idx + 1}, only {len(relays)} configured")
+    relay_name = relays[relay_idx].name
+    if relay_name not in relay_controller.snapshot.relays:
+        raise ValueError(f"{name}: step {idx} relay {relay_name!r} is not initialised")
+    return relay_name, action == "on", duration
+
+def _lpt_lanes(durations, lanes):
+    """Longest-processing-time assignment of durations to lanes."""
+    loads = [0.0] * lanes
+    assign = [0] * len(durations)
+    for i in sorted(range(len(durations)), key=lambda i: -durations[i]):
+        lane = min(range(lanes), key=lambda l: loads[l])
+        assign[i] = lane
+        loads[lane] += durations[i]
+    return assign, max(loads)
+
+def _min_makespan_lanes(durations, lanes):
+    """Assign durations to `lanes` sequential lanes minimising the longest lane.
+
+    Exact branch-and-bound for small recipes, LPT beyond EXACT_SCHEDULE_LIMIT.
+    """
+    best_assign, best = _lpt_lanes(durations, lanes)
+    if len(durations) > EXACT_SCHEDULE_LIMIT:
+        return best_assign, best
+    lower_bound = max(max(durations), sum(durations) / lanes)
+    order = sorted(range(len(durations)), key=lambda i: -durations[i])
+    loads = [0.0] * lanes
+    assign = [0] * len(durations)
+
+    def search(k):
+        nonlocal best, best_assign
+        if best <= lower_bound + 1e-9:
+            return
+        if k == len(order):
+            makespan = max(loads)
+            if makespan < best - 1e-9:
+                best, best_assign = makespan, list(assign)
+            return
+        i = order[k]
+        tried = set()
+        for lane in range(lanes):
+            # Lanes with equal load are interchangeable; only try one of them
+            if loads[lane] in tried or loads[lane] + durations[i] >= best - 1e-9:
+                continue
+            tried.add(loads[lane])
+            loads[lane] += durations[i]
+            assign[i] = lane
+            search(k + 1)
+            loads[lane] -= durations[i]
+
+    search(0)
+    return best_assign, best
+
+def schedule_pours(pours, limit=None):
+    """Place independent (relay_name, duration, steps) pours on a shared timeline.
+
+    Without a limit every pump starts at t=0; with one, pours are packed into
+    `limit` back-to-back lanes so the schedule is as short as possible while
+    never running more than `limit` relays at once. Returns [(start, pour)].
+    """
+    if not pours:
+        return []
+    if limit is None or limit >= len(pours):
+        return [(0.0, pour) for pour in pours]
+    assign, _ = _min_makespan_lanes([pour[1] for pour in pours], limit)
+    lane_time = [0.0] * limit
+    placed = []
+    for i in sorted(range(len(pours)), key=lambda i: -pours[i][1]):
+        lane = assign[i]
+        placed.append((lane_time[lane], pours[i]))
+        lane_time[lane] += pours[i][1]
+    return placed
+
+def compile_drink(drink):
+    """Validate a drink and compile its steps into a DrinkPlan.
+
+    Sequential drinks run their steps in order: relays are resolved to their
+    configured names up front (the relay controller switches them by name),
+    zero-length steps are folded into the next event group, and transitions
+    that would not change a relay's state are dropped.
+    Drinks marked "concurrent" treat each "on" step as an independent pour of
+    `time` seconds and are scheduled in parallel under max_concurrent_relays.
+    Raises ValueError describing the first bad step.
+    """
+    if not isinstance(drink, dict) or not isinstance(drink.get("steps"), list):
+        raise ValueError("Drink must have a list of steps")
+    name = drink.get("name") or "Drink"
+    concurrent = bool(drink.get("concurrent"))
+    config_cache.refresh()
+    relays = config_cache.relays
+    limit = get_max_concurrent_relays()
+    validated = [_validate_step(name, idx, step, relays) for idx, step in enumerate(drink["steps"], start=1)]
+
+    transitions = []  # (offset, step_number, relay_name, on)
+    step_offsets = [(0.0, duration) for _, _, duration in validated]
+    if concurrent:
+        # Same pump twice is one longer pour; "off" steps are implicit at the end of each pour
+        pours = {}
+        for idx, (relay_name, on, duration) in enumerate(validated, start=1):
+            if on and duration > 0:
+                total, steps = pours.get(relay_name, (0.0, []))
+                pours[relay_name] = (total + duration, steps + [idx])
+        total_time = 0.0
+        for start, (relay_name, duration, steps) in schedule_pours(
+                [(relay_name, total, steps) for relay_name, (total, steps) in pours.items()], limit):
+            transitions.append((start, steps[0], relay_name, True))
+            transitions.append((start + duration, steps[-1], relay_name, False))
+            offset = start
+            for idx in steps:
+                step_offsets[idx - 1] = (offset, validated[idx - 1][2])
+                offset += validated[idx - 1][2]
+            total_time = max(total_time, start + duration)
+    else:
+        offset = 0.0
+        for idx, (relay_name, on, duration) in enumerate(validated, start=1):
+            transitions.append((offset, idx, relay_name, on))
+            step_offsets[idx - 1] = (offset, duration)
+            offset += duration
+        total_time = offset
+
+    # Group by offset (last action per relay wins), then keep only real state changes.
+    # Offs sort before ons so a relay handing over to the next never overlaps it.
+    groups = {}
+    for at, step_number, relay_name, on in transitions:
+        groups.setdefault(at, {})[relay_name] = (step_number, on)
+    current = {relay_name: False for relay_name in relay_controller.snapshot.names}
+    events = []
+    for at in sorted(groups):
+        for relay_name, (step_number, on) in sorted(groups[at].items(), key=lambda item: item[1][1]):
+            if current[relay_name] == on:
+                continue
+            current[relay_name] = on
+            events.append(PlanEvent(at, step_number, relay_name, on))
+            if limit is not None and sum(current.values()) > limit:
+                raise ValueError(f"{name}: step {step_number} would run more than {limit} relays at once")
+
+    return DrinkPlan(
+        name=name,
+        source=copy.deepcopy(drink["steps"]),
+        concurrent=concurrent,
+        events=tuple(events),
+        total_time=total_time,
+        steps=len(drink["steps"]),
+        step_offsets=tuple(step_offsets),
+        generation=relay_controller.snapshot.generation,
+        max_concurrent=limit,
+    )
+
+def compile_drinks(drinks):
+    """Compile every drink, returning {index: DrinkPlan}. Raises ValueError on the first bad drink."""
+    if not isinstance(drinks, list):
+        raise ValueError("Drinks must be a list")
+    return {idx: compile_drink(drink) for idx, drink in enumerate(drinks)}
+
+def get_drink_plan(drink_id, drink):
+    """Return the compiled plan for a drink, recompiling if the recipe or relays changed."""
+    plan = drink_plans.get(drink_id)
+    if (plan is None or plan.generation != relay_controller.snapshot.generation
+            or plan.source != drink.get("steps") or plan.name != (drink.get("name") or "Drink")
+            or plan.concurrent != bool(drink.get("concurrent"))
+            or plan.max_concurrent != get_max_concurrent_relays()):
+        plan = compile_drink(drink)
+        drink_plans[drink_id] = plan
+    return plan
+
+def plan_to_dict(plan):
+    return {
+        "name": plan.name,
+        "concurrent": plan.concurrent,
+        "max_concurrent": plan.max_concurrent,
+        "total_time": plan.total_time,
+        "steps": plan.steps,
+        "events": [
+            {"at": event.at, "step": event.step, "relay": event.relay_name, "on": event.on}
+            for event in plan.events
+        ],
+    }
+
+# ----------------- ORDER QUEUE -----------------
+
+# Default pause between consecutive orders so the next cup can be placed
+ORDER_GAP_DEFAULT = 3.0
+# How many finished orders to keep for status lookups
+ORDER_HISTORY_LIMIT = 50
+ORDER_FINISHED = ("done", "failed", "cancelled")
+
+order_cond = threading.Condition()
+order_queue = deque()
+orders = OrderedDict()
+order_ids = itertools.count(1)
+current_order_id = None
+order_worker_thread = None
+order_stats = {
+    "submitted": 0,
+    "completed": 0,
+    "failed": 0,
+    "cancelled": 0,
+    "max_depth": 0,
+}
+# Seconds each recent order spent queued before pouring started
+order_waits = deque(maxlen=100)
+
+def get_order_gap():
+    try:
+        return max(0.0, float(config_cache.get("order_gap_seconds", ORDER_GAP_DEFAULT)))
+    except (TypeError, ValueError):
+        return ORDER_GAP_DEFAULT
+
+def order_to_dict(order, position=None):
+    data = {
+        "id": order["id"],
+        "drink_id": order["drink_id"],
+        "drink_name": order["plan"].name,
+        "status": order["status"],
+        "queued_at": order["queued_at"],
+        "started_at": order["started_at"],
+        "finished_at": order["finished_at"],
+        "total_time": order["plan"].total_time,
+        "error": order["error"],
+    }
+    if position is not None:
+        data["position"] = position
+    return data
+
+def order_position(order_id):
+    """0 while pouring or next up, n for the nth order waiting behind it; None if not pending."""
+    with order_cond:
+        if order_id == current_order_id:
+            return 0
+        for idx, order in enumerate(order_queue):
+            if order["id"] == order_id:
+                return idx + (1 if current_order_id is not None else 0)
+    return None
+
+def estimate_order_wait(order_id):
+    """Seconds until an order should start pouring, from plan times and the order gap."""
+    gap = get_order_gap()
+    with order_cond:
+        if order_id == current_order_id:
+            return 0.0
+        wait = 0.0
+        current = orders.get(current_order_id)
+        if current and current["started_at"]:
+            elapsed = time.time() - current["started_at"]
+            wait += max(0.0, current["plan"].total_time + POUR_LEAD_TIME - elapsed) + gap
+        for order in order_queue:
+            if order["id"] == order_id:
+                return wait
+            wait += order["plan"].total_time + POUR_LEAD_TIME + gap
+    return None
+
+def order_stats_snapshot():
+    with order_cond:
+        waits = list(order_waits)
+        depth = len(order_queue)
+        stats = dict(order_stats)
+    stats["depth"] = depth
+    stats["gap"] = get_order_gap()
+    stats["avg_wait"] = sum(waits) / len(waits) if waits else 0.0
+    stats["max_wait"] = max(waits, default=0.0)
+    stats["last_wait"] = waits[-1] if waits else 0.0
+    return stats
+
+def orders_snapshot():
+    with order_cond:
+        return {
+            "current": current_order_id,
+            "queue": [order["id"] for order in order_queue],
+            "finished": {
+                order["id"]: order["status"] for order in orders.values() if order["status"] in ORDER_FINISHED
+            },
+        }
+
+def _publish_order(order):
+    # Caller holds order_cond so the queue in the event matches the order's status
+    data = order_to_dict(order)
+    data["current"] = current_order_id
+    data["queue"] = [queued["id"] for queued in order_queue]
+    progress_events.publish("order", data)
+
+def _trim_order_history():
+    # Caller holds order_cond
+    finished = [oid for oid, order in orders.items() if order["status"] in ORDER_FINISHED]
+    for oid in finished[:max(0, len(finished) - ORDER_HISTORY_LIMIT)]:
+        del orders[oid]
+
+def submit_order(drink_id, plan):
+    """Append an order for a compiled drink plan and make sure the worker is running."""
+    global order_worker_thread
+    with order_cond:
+        order = {
+            "id": next(order_ids),
+            "drink_id": drink_id,
+            "plan": plan,
+            "status": "queued",
+            "queued_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+        }
+        orders[order["id"]] = order
+        order_queue.append(order)
+        order_stats["submitted"] += 1
+        order_stats["max_depth"] = max(order_stats["max_depth"], len(order_queue))
+        _publish_order(order)
+        if order_worker_thread is None or not order_worker_thread.is_alive():
+            order_worker_thread = threading.Thread(target=order_worker, name="order-worker", daemon=True)
+            order_worker_thread.start()
+        order_cond.notify_all()
+    return order
+
+def cancel_order(order_id):
+    """Cancel a pending order. Returns (ok, error)."""
+    with order_cond:
+        order = orders.get(order_id)
+        if not order:
+            return False, "Order not found"
+        if order["status"] != "queued":
+            return False, f"Order is already {order['status']}"
+        if order_id == current_order_id:
+            return False, "Order is already starting"
+        order_queue.remove(order)
+        order["status"] = "cancelled"
+        order["finished_at"] = time.time()
+        order_stats["cancelled"] += 1
+        _publish_order(order)
+        _trim_order_history()
+        order_cond.notify_all()
+    return True, None
+
+def order_worker():
+    """Single executor thread: hands queued orders to the relay controller one at a time."""
+    global current_order_id
+    last_finished = None
+    while True:
+        with order_cond:
+            while not order_queue:
+                order_cond.wait()
+            # Leave time to swap cups between back-to-back orders
+            gap = get_order_gap()
+            while order_queue and last_finished is not None and time.monotonic() - last_finished < gap:
+                order_cond.wait(gap - (time.monotonic() - last_finished))
+            if not order_queue:
+                continue
+            order = order_queue.popleft()
+            current_order_id = order["id"]
+
+        def mark_pouring(order=order):
+            # Called by the controller once any running test has finished
+            with order_cond:
+                order["status"] = "pouring"
+                order["started_at"] = time.time()
+                order_waits.append(order["started_at"] - order["queued_at"])
+                _publish_order(order)
+
+        try:
+            relay_controller.call(RunPlan(order["plan"], order["drink_id"], order["id"], mark_pouring))
+            status, error = "done", None
+        except Exception as e:
+            status, error = "failed", str(e)
+
+        with order_cond:
+            order["status"] = status
+            order["error"] = error
+            order["finished_at"] = time.time()
+            order_stats["completed" if status == "done" else "failed"] += 1
+            current_order_id = None
+            _publish_order(order)
+            _trim_order_history()
+            order_cond.notify_all()
+        last_finished = time.monotonic()
+
 # ----------------- DRINKS ROUTES -----------------
 
 @app.route("/drinks-config")
@@ -1526,7 +5250,14 @@ def make_drinks():
     """Render make drinks page."""
     config = get_config()
     drinks = load_drinks_config()
-    return render_template("make-drinks.html", system_name=config["system_name"], drinks=drinks)
+    # Pour time per drink from its compiled plan (concurrent drinks are shorter than the step sum)
+    pour_times = []
+    for idx, drink in enumerate(drinks):
+        try:
+            pour_times.append(get_drink_plan(idx, drink).total_time)
+        except Exception:
+            pour_times.append(sum(step.get("time", 0) for step in drink.get("steps", [])))
+    return render_template("make-drinks.html", system_name=config["system_name"], drinks=drinks, pour_times=pour_times)
 
 @app.errorhandler(404)
 def page_not_found(e):
@@ -1552,7 +5283,14 @@ def save_drinks():
             return jsonify({"success": False, "error": "Invalid request data"}), 400
         
         drinks = data["drinks"]
+        try:
+            plans = compile_drinks(drinks)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         save_drinks_config(drinks)
+        drink_plans.clear()
+        drink_plans.update(plans)
+        drink_timings.clear()
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
@@ -1571,112 +5309,451 @@ def get_drink(drink_id):
 
 @app.route("/api/make-drink/<int:drink_id>", methods=["POST"])
 def make_drink(drink_id):
-    """Make a drink by executing its relay sequence."""
-    global test_in_progress
-    
-    if test_in_progress:
-        return jsonify({"success": False, "error": "Test in progress, cannot make drink"}), 409
-    
+    """Queue a drink; it is poured by the order worker in FIFO order."""
     try:
         drinks = load_drinks_config()
         if drink_id < 0 or drink_id >= len(drinks):
             return jsonify({"success": False, "error": "Drink not found"}), 404
         
         drink = drinks[drink_id]
+        try:
+            plan = get_drink_plan(drink_id, drink)
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
         
-        # Create a thread to make the drink
-        def make_drink_thread():
-            global test_in_progress
-            try:
-                with test_lock:
-                    test_in_progress = True
-                    # Initialize progress tracking
-                    drink_progress["active"] = True
-                    drink_progress["drink_name"] = drink["name"]
-                    drink_progress["started_at"] = time.time()
-                    drink_progress["total_time"] = sum(step["time"] for step in drink["steps"])
-                    drink_progress["expected_total"] = drink_progress["total_time"] + 0.5 + (0.2 * len(drink["steps"]))
-                    drink_progress["current_step"] = 0
-                    drink_progress["steps"] = len(drink["steps"])
-                    drink_progress["step_started_at"] = time.time()
-                    drink_progress["current_step_time"] = 0
-                    drink_progress["completed_time"] = 0.0
-                    
-                    # Reset all relays to OFF first
-                    initialize_relay_states()
-                    time.sleep(0.5)  # Small delay after reset
-                    
-                    # Execute each step in the sequence
-                    for idx, step in enumerate(drink["steps"], start=1):
-                        drink_progress["current_step"] = idx
-                        drink_progress["step_started_at"] = time.time()
-                        drink_progress["current_step_time"] = max(0.0, float(step["time"]))
-                        relay_name = relay_name_from_index(step['relay'])
-                        relay = relay_pins.get(relay_name)
-                        if relay:
-                            if step["action"] == "on":
-                                relay.on()
-                            else:
-                                relay.off()
-                            
-                            # Update state
-                            states = load_relay_states()
-                            states[relay_name] = relay.is_active
-                            save_relay_states(states)
-                            
-                            # Wait for specified time
-                        time.sleep(step["time"])
-                        # Track completed time for accurate progress
-                        drink_progress["completed_time"] += max(0.0, float(step["time"]))
-                    
-                    # Turn all relays off at the end
-                    initialize_relay_states()
-            finally:
-                test_in_progress = False
-                drink_progress["active"] = False
-        
-        # Start the drink making process in a separate thread
-        threading.Thread(target=make_drink_thread).start()
+        # Queue the order; the order worker pours it when the relays are free
+        order = submit_order(drink_id, plan)
+        position = order_position(order["id"])
+        wait = estimate_order_wait(order["id"])
         
         return jsonify({
             "success": True, 
-            "message": f"Making {drink['name']}...",
-            "total_time": sum(step["time"] for step in drink["steps"]),
-            "estimated_time": sum(step["time"] for step in drink["steps"]) + 0.5 + (0.2 * len(drink["steps"]))
+            "message": f"Making {plan.name}..." if position == 0 else f"{plan.name} queued (#{position + 1})",
+            "order_id": order["id"],
+            "position": position,
+            "estimated_wait": wait,
+            "total_time": plan.total_time,
+            "estimated_time": plan.total_time + POUR_LEAD_TIME
         })
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
-@app.route("/api/drink-progress", methods=["GET"])
-def get_drink_progress():
+@app.route("/api/orders", methods=["GET"])
+def list_orders():
+    """Current order, pending queue and wait statistics."""
+    with order_cond:
+        pending = [order_to_dict(order, idx) for idx, order in enumerate(order_queue)]
+        current = order_to_dict(orders[current_order_id]) if current_order_id in orders else None
+        recent = [order_to_dict(order) for order in orders.values() if order["status"] in ORDER_FINISHED]
+    return jsonify({
+        "success": True,
+        "current": current,
+        "queue": pending,
+        "recent": recent[-10:],
+        "stats": order_stats_snapshot()
+    })
+
+@app.route("/api/orders/<int:order_id>", methods=["GET"])
+def get_order(order_id):
+    with order_cond:
+        order = orders.get(order_id)
+        if not order:
+            return jsonify({"success": False, "error": "Order not found"}), 404
+        data = order_to_dict(order, order_position(order_id))
+    data["estimated_wait"] = estimate_order_wait(order_id)
+    return jsonify({"success": True, "order": data})
+
+@app.route("/api/orders/<int:order_id>/cancel", methods=["POST"])
+def cancel_order_route(order_id):
+    ok, error = cancel_order(order_id)
+    if not ok:
+        return jsonify({"success": False, "error": error}), 409 if error != "Order not found" else 404
+    return jsonify({"success": True})
+
+@app.route("/api/drinks/<int:drink_id>/plan", methods=["GET"])
+def get_drink_plan_route(drink_id):
+    """Compiled pour plan for a drink plus the measured lateness of its last pour."""
+    try:
+        drinks = load_drinks_config()
+        if drink_id < 0 or drink_id >= len(drinks):
+            return jsonify({"success": False, "error": "Drink not found"}), 404
+        try:
+            plan = get_drink_plan(drink_id, drinks[drink_id])
+        except ValueError as e:
+            return jsonify({"success": False, "error": str(e)}), 400
+        return jsonify({"success": True, "plan": plan_to_dict(plan), "timing": drink_timings.get(drink_id)})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+def drink_progress_snapshot():
+    drink_progress = relay_controller.snapshot.drink
     if not drink_progress["active"]:
-        return jsonify({"active": False})
+        return {"active": False}
     elapsed = time.time() - (drink_progress["started_at"] or time.time())
     total = max(0.1, drink_progress.get("expected_total") or drink_progress.get("total_time") or 0.1)
     percent = min(99, (elapsed / total) * 100)
-    return jsonify({
+    return {
         "active": True,
+        "order_id": drink_progress["order_id"],
         "drink_name": drink_progress["drink_name"],
         "elapsed": elapsed,
         "total_time": total,
         "percent": percent,
         "current_step": drink_progress["current_step"],
         "steps": drink_progress["steps"]
-    })
+    }
 
-@app.route("/api/self-test-progress", methods=["GET"])
-def get_self_test_progress():
+def self_test_progress_snapshot():
+    self_test_progress = relay_controller.snapshot.self_test
     if not self_test_progress["active"]:
-        return jsonify({"active": False})
-    return jsonify({
+        return {"active": False}
+    return {
         "active": True,
         "relay": self_test_progress["relay"],
         "action": self_test_progress["action"],
         "step": self_test_progress["step"],
         "steps": self_test_progress["steps"]
-    })
+    }
+
+def progress_state():
+    """Everything a progress-stream client needs to (re)build its view."""
+    return {
+        "drink": drink_progress_snapshot(),
+        "self_test": self_test_progress_snapshot(),
+        "orders": orders_snapshot(),
+        "testing": relay_controller.busy,
+    }
+
+@app.route("/api/drink-progress", methods=["GET"])
+def get_drink_progress():
+    return jsonify(drink_progress_snapshot())
+
+@app.route("/api/self-test-progress", methods=["GET"])
+def get_self_test_progress():
+    return jsonify(self_test_progress_snapshot())
+
+@app.route("/api/progress-stream")
+def progress_stream():
+    """Server-Sent Events for orders, pours and self tests; honours Last-Event-ID."""
+    return sse_response(progress_events, progress_state)
+
+# ----------------- REQUEST LANES -----------------
+
+# Per-lane concurrency: "workers" run at once, up to "queue" more wait at most "timeout"
+# seconds, and anything beyond that gets an immediate 503. Running and waiting requests
+# both hold a server thread, so only the control lane queues: everything else is refused
+# at once rather than parking a thread. Override any of these with config.json
+# "request_lanes", e.g. {"bulk": {"workers": 2}}.
+REQUEST_LANE_DEFAULTS = {
+    # Relay switching, pours and their progress: small, but never behind bulk work
+    "control": {"workers": 4, "queue": 8, "timeout": 5},
+    # Open event streams each hold a thread for as long as the page is open
+    "stream": {"workers": SSE_MAX_CLIENTS, "queue": 0, "timeout": 0},
+    # Photo transfers, USB imports, updates and network changes that can run for minutes
+    "bulk": {"workers": 3, "queue": 0, "timeout": 0},
+    "default": {"workers": 6, "queue": 0, "timeout": 0},
+}
+
+# (path prefix, lane); first match wins, anything unmatched is "default"
+REQUEST_LANE_RULES = (
+    ("/toggle/", "control"),
+    ("/toggle-all/", "control"),
+    ("/api/relays/batch", "control"),
+    ("/api/relays/pulses", "control"),
+    ("/api/make-drink/", "control"),
+    ("/api/orders", "control"),
+    ("/get-states", "control"),
+    ("/api/drink-progress", "control"),
+    ("/api/self-test-progress", "control"),
+    ("/test-in-progress", "control"),
+    ("/time-test", "control"),
+    ("/self-test", "control"),
+    ("/api/progress-stream", "stream"),
+    ("/api/relay-stream", "stream"),
+    ("/photos/", "bulk"),
+    ("/api/photo-library/", "bulk"),
+    ("/system-update-logs", "stream"),
+    ("/system-update", "bulk"),
+    ("/git-pull", "bulk"),
+    ("/api/rollback", "bulk"),
+    ("/check-updates", "bulk"),
+    ("/scan-wifi-networks", "bulk"),
+    ("/connect-wifi", "bulk"),
+    ("/enable-networkmanager", "bulk"),
+    ("/load-usb-wifi-config", "bulk"),
+    ("/reset-network-settings", "bulk"),
+)
+
+class RequestLane:
+    """Bounded concurrency with a bounded, time-limited wait queue."""
+
+    def __init__(self, name, workers, queue, timeout):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.queue = max(0, int(queue))
+        self.timeout = max(0.0, float(timeout))
+        self.active = 0
+        self.waiting = 0
+        self.served = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.max_wait = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if there is room; False means reject."""
+        with self._cond:
+            if self.active < self.workers:
+                self.active += 1
+                self.served += 1
+                return True
+            if self.waiting >= self.queue:
+                self.rejected += 1
+                return False
+            self.waiting += 1
+            started = time.monotonic()
+            deadline = started + self.timeout
+            try:
+                while self.active >= self.workers:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self._cond.wait(remaining)
+                self.active += 1
+                self.served += 1
+                self.max_wait = max(self.max_wait, time.monotonic() - started)
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self.workers,
+                "queue": self.queue,
+                "timeout": self.timeout,
+                "active": self.active,
+                "waiting": self.waiting,
+                "served": self.served,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "max_wait": round(self.max_wait, 3),
+            }
+
+# WSGI environ flag: the response body is already in memory (see mark_buffered_response)
+REQUEST_LANE_BUFFERED = "relay_control.buffered"
+
+class RequestLanes:
+    """WSGI middleware that runs each request class in its own lane.
+
+    A buffered response frees its lane slot as soon as the app returns it. A streamed
+    one (event streams, send_file) holds the slot until its body has been sent or the
+    client went away, so photo downloads count against "bulk" for as long as they
+    transfer. Lanes that are full answer 503 at once instead of tying up server threads.
+    Requests are counted the same way, so shutdown can drain streamed responses.
+    """
+
+    def __init__(self, wsgi_app, lanes, rules=REQUEST_LANE_RULES):
+        self.wsgi_app = wsgi_app
+        self.lanes = {name: RequestLane(name, **settings) for name, settings in lanes.items()}
+        self.rules = rules
+        self.in_flight = 0
+        self.draining = False
+        self._cond = threading.Condition()
+
+    def classify(self, path):
+        for prefix, lane in self.rules:
+            if path.startswith(prefix):
+                return lane
+        return "default"
+
+    def threads(self):
+        """Server threads the lanes can hold at once, running and waiting requests together."""
+        return sum(lane.workers + lane.queue for lane in self.lanes.values())
+
+    @staticmethod
+    def _unavailable(start_response, error, retry_after):
+        body = json.dumps({"success": False, "error": error}).encode()
+        start_response("503 Service Unavailable", [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+            ("Retry-After", str(retry_after)),
+        ])
+        return [body]
+
+    def _done(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def __call__(self, environ, start_response):
+        with self._cond:
+            if self.draining:
+                return self._unavailable(start_response, "Server is shutting down", 5)
+            self.in_flight += 1
+        lane = self.lanes[self.classify(environ.get("PATH_INFO", ""))]
+        if not lane.acquire():
+            self._done()
+            return self._unavailable(start_response, f"Server busy ({lane.name} requests), try again", 2)
+
+        def finish():
+            lane.release()
+            self._done()
+
+        try:
+            result = self.wsgi_app(environ, start_response)
+        except BaseException:
+            finish()
+            raise
+        if environ.get(REQUEST_LANE_BUFFERED):
+            finish()
+            return result
+        return ClosingIterator(result, finish)
+
+    def drain(self, timeout):
+        """Refuse new requests and wait for in-flight ones, bodies included; True if they all finished in time."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            self.draining = True
+            while self.in_flight > 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def stats(self):
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+def request_lane_settings():
+    overrides = config_cache.get("request_lanes") or {}
+    lanes = {}
+    for name, defaults in REQUEST_LANE_DEFAULTS.items():
+        settings = dict(defaults)
+        override = overrides.get(name) if isinstance(overrides, dict) else None
+        if isinstance(override, dict):
+            settings.update((key, value) for key, value in override.items() if key in defaults)
+        lanes[name] = settings
+    return lanes
+
+request_lanes = RequestLanes(app.wsgi_app, request_lane_settings())
+app.wsgi_app = request_lanes
+
+@app.after_request
+def mark_buffered_response(response):
+    """Flag bodies that are already in memory, so their lane slot is freed right away."""
+    if not response.is_streamed or response.status_code in (204, 304) or request.method == "HEAD":
+        request.environ[REQUEST_LANE_BUFFERED] = True
+    return response
+
+@app.route("/api/request-lanes", methods=["GET"])
+def request_lane_stats():
+    """Per-lane load and rejection counters."""
+    return jsonify({"success": True, "lanes": request_lanes.stats()})
+
+# ----------------- SERVING -----------------
+
+# config.json keys for serving, with their defaults
+SERVER_DEFAULTS = {
+    # "production" serves through waitress; "dev" uses Flask's development server
+    "server_mode": "production",
+    "server_host": "0.0.0.0",
+    "server_port": 5000,
+    # 0 sizes the pool to what the request lanes can hold at once, so a request a lane
+    # admits never waits inside waitress behind open streams or bulk transfers
+    "server_threads": 0,
+    "server_connection_limit": 100,
+    # Idle keep-alive and stalled client connections are dropped after this many seconds
+    "server_channel_timeout": 30,
+    "server_max_body_mb": 64,
+    # How long shutdown waits for in-flight requests before turning the relays off anyway
+    "server_shutdown_timeout": 10,
+}
+
+def server_setting(key):
+    default = SERVER_DEFAULTS[key]
+    try:
+        return type(default)(config_cache.get(key, default))
+    except (TypeError, ValueError):
+        return default
+
+def server_thread_count():
+    threads = server_setting("server_threads")
+    return threads if threads > 0 else request_lanes.threads()
+
+def make_production_server(wsgi_app, host=None, port=None):
+    """A waitress server for wsgi_app configured from config.json."""
+    return waitress.create_server(
+        wsgi_app,
+        host=host or server_setting("server_host"),
+        port=port if port is not None else server_setting("server_port"),
+        threads=server_thread_count(),
+        connection_limit=max(1, server_setting("server_connection_limit")),
+        channel_timeout=max(1, server_setting("server_channel_timeout")),
+        max_request_body_size=max(1, server_setting("server_max_body_mb")) * 1024 * 1024,
+        clear_untrusted_proxy_headers=True,
+        ident="relay-control",
+    )
+
+def shutdown_relays():
+    """Turn every relay off and persist that; the last step of any shutdown."""
+    try:
+        initialize_relay_states()
+    finally:
+        relay_state_store.flush()
+
+def run_server():
+    """Serve until SIGTERM/SIGINT, then drain requests and turn the relays off."""
+    mode = str(server_setting("server_mode")).lower()
+    if mode == "production" and waitress is None:
+        print("waitress is not installed; using the development server")
+        mode = "dev"
+    stopping = threading.Event()
+
+    def stop_after_drain():
+        # End open event streams first, or draining would wait on them until the timeout
+        progress_events.close()
+        relay_events.close()
+        job_engine.close_streams()
+        if not request_lanes.drain(server_setting("server_shutdown_timeout")):
+            print("Shutdown timed out with requests still running")
+        _thread.interrupt_main()
+
+    def on_signal(signum, frame):
+        if mode != "production" or stopping.is_set():
+            # Dev server can't drain, and a second signal means stop now
+            raise KeyboardInterrupt
+        stopping.set()
+        threading.Thread(target=stop_after_drain, name="shutdown", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    try:
+        if mode == "production":
+            server = make_production_server(app)
+            print(f"Serving on http://{server_setting('server_host')}:{server_setting('server_port')} "
+                  f"with {server.adj.threads} threads")
+            if request_lanes.threads() > server.adj.threads:
+                print(f"Request lanes can hold {request_lanes.threads()} requests at once, more than "
+                      f"server_threads; control requests may wait behind other lanes")
+            # Returns once interrupted, after waitress has let its workers finish
+            server.run()
+            server.close()
+        else:
+            # Explicitly disable debug/reloader so systemd doesn't think the service exited.
+            app.run(host=server_setting("server_host"), port=server_setting("server_port"),
+                    debug=False, use_reloader=False, threaded=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown_relays()
 
 if __name__ == "__main__":
     initialize_relay_states()  # Reset states on startup
-    # Explicitly disable debug/reloader so systemd doesn't think the service exited.
-    app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
+    run_server()
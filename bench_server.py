@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Compare the production (waitress) and development (Werkzeug) servers on the same routes.
+
+Both servers run app.py in this process on their own ports and get the same load: a number
+of keep-alive clients cycling through a mix of page, API and static requests. Prints
+requests/sec and latency percentiles for each. Off the Pi, run with
+GPIOZERO_PIN_FACTORY=mock so the relays are simulated.
+
+    python3 bench_server.py --clients 16 --seconds 10
+"""
+import argparse
+import http.client
+import re
+import threading
+import time
+
+from werkzeug.serving import make_server
+
+import app as relay_app
+
+DEFAULT_ROUTES = [
+    "/dashboard",
+    "/get-states",
+    "/api/drinks",
+    "/api/orders",
+    "/api/drink-progress",
+    "/api/photo-library/list-saved",
+]
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+def client_loop(port, routes, deadline, offset, results, lock):
+    latencies, errors = [], 0
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    i = offset
+    while time.monotonic() < deadline:
+        route = routes[i % len(routes)]
+        i += 1
+        started = time.perf_counter()
+        try:
+            conn.request("GET", route, headers={"Accept-Encoding": "gzip, br"})
+            response = conn.getresponse()
+            response.read()
+            if response.status >= 500:
+                errors += 1
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - started)
+        if response.getheader("Connection", "").lower() == "close":
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    conn.close()
+    with lock:
+        results["latencies"].extend(latencies)
+        results["errors"] += errors
+
+def run_load(port, routes, clients, seconds):
+    results = {"latencies": [], "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+    threads = [threading.Thread(target=client_loop, args=(port, routes, deadline, n, results, lock))
+               for n in range(clients)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    latencies = results["latencies"]
+    return {
+        "requests": len(latencies),
+        "errors": results["errors"],
+        "rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+    }
+
+def start_dev_server(port):
+    server = make_server("127.0.0.1", port, relay_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown
+
+def start_production_server(port):
+    server = relay_app.make_production_server(relay_app.app, host="127.0.0.1", port=port)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    def stop():
+        server.close()
+        server.task_dispatcher.shutdown(timeout=2)
+    return stop
+
+def static_routes():
+    """Fingerprinted asset URLs from a rendered page, as a browser would fetch them."""
+    with relay_app.app.test_client() as client:
+        html = client.get("/dashboard").get_data(as_text=True)
+    return re.findall(r'(?:src|href)="(/static/[^"]+)"', html)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clients", type=int, default=16, help="concurrent keep-alive clients")
+    parser.add_argument("--seconds", type=float, default=10.0, help="load duration per server")
+    parser.add_argument("--port", type=int, default=5081, help="first port; the second server uses port+1")
+    parser.add_argument("--route", action="append", dest="routes", help="route to request (repeatable)")
+    parser.add_argument("--no-static", action="store_true", help="leave static assets out of the mix")
+    args = parser.parse_args()
+
+    routes = args.routes or DEFAULT_ROUTES + ([] if args.no_static else static_routes())
+    print(f"{len(routes)} routes, {args.clients} clients, {args.seconds:g}s per server")
+
+    servers = [("dev (werkzeug)", start_dev_server, args.port),
+               ("production (waitress)", start_production_server, args.port + 1)]
+    if relay_app.waitress is None:
+        print("waitress is not installed; benchmarking the development server only")
+        servers = servers[:1]
+
+    rows = []
+    for name, start, port in servers:
+        stop = start(port)
+        time.sleep(0.5)
+        # Warm caches (config, templates, derivatives) before measuring
+        run_load(port, routes, 2, 1.0)
+        rows.append((name, run_load(port, routes, args.clients, args.seconds)))
+        stop()
+
+    print(f"{'server':<24}{'req/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}{'errors':>8}")
+    for name, r in rows:
+        print(f"{name:<24}{r['rps']:>10.1f}{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['max_ms']:>10.1f}{r['errors']:>8}")
+
+if __name__ == "__main__":
+    main()
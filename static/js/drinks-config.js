@@ -378,6 +378,9 @@ function openDrinkModal(drinkIndex = -1) {
             updatePhotoPreview(photoSelector.value);
         }
         
+        const concurrentToggle = document.getElementById('concurrentPour');
+        if (concurrentToggle) concurrentToggle.checked = !!drink.concurrent;
+        
         // Populate steps
         drink.steps.forEach((step, index) => {
             addRelayStep(step.relay, step.time, step.action);
@@ -425,7 +428,7 @@ function loadPhotoOptions() {
                     card.className = 'btn btn-outline w-100';
                     card.style.textAlign = 'left';
                     card.innerHTML = `
-                        <img src="${photo.url}" alt="${photo.name}" style="width:100%; height:120px; object-fit:cover; border-radius:10px; margin-bottom:8px;">
+                        <img src="${sizedPhotoUrl(photo.url, 'thumb')}" alt="${photo.name}" style="width:100%; height:120px; object-fit:cover; border-radius:10px; margin-bottom:8px;">
                         <div>${photo.folder}/${photo.name}</div>
                     `;
                     card.addEventListener('click', () => {
@@ -449,7 +452,7 @@ function updatePhotoPreview(url) {
         img.src = '';
         return;
     }
-    img.src = url;
+    img.src = sizedPhotoUrl(url, 'screen');
     wrap.style.display = 'block';
 }
 
@@ -497,14 +500,17 @@ function addRelayStep(relay = 1, time = 5, action = 'on') {
     stepElement.className = 'relay-step';
     stepElement.dataset.index = index;
     
-    const relaySelectOptions = relayOptions.length
-        ? relayOptions.map((r, i) => `<option value="${i + 1}" ${relay === i + 1 ? 'selected' : ''}>${r.name}</option>`).join('')
-        : `
-            <option value="1" ${relay === 1 ? 'selected' : ''}>Relay 1</option>
-            <option value="2" ${relay === 2 ? 'selected' : ''}>Relay 2</option>
-            <option value="3" ${relay === 3 ? 'selected' : ''}>Relay 3</option>
-            <option value="4" ${relay === 4 ? 'selected' : ''}>Relay 4</option>
-        `;
+    // Until /api/relays answers, offer numbered relays; always keep the step's own relay
+    // selectable so a recipe using relay 17 is not silently saved as relay 1
+    const names = relayOptions.length
+        ? relayOptions.map(r => r.name)
+        : Array.from({ length: Math.max(4, relay) }, (_, i) => `Relay ${i + 1}`);
+    if (relay > names.length) {
+        for (let i = names.length + 1; i <= relay; i++) names.push(`Relay ${i} (not configured)`);
+    }
+    const relaySelectOptions = names
+        .map((name, i) => `<option value="${i + 1}" ${relay === i + 1 ? 'selected' : ''}>${name}</option>`)
+        .join('');
 
     stepElement.innerHTML = `
         <div class="relay-step-header">
@@ -623,10 +629,12 @@ function saveDrink() {
     }
     
     // Create drink object
+    const concurrentToggle = document.getElementById('concurrentPour');
     const drink = {
         name,
         icon,
         image: image || null,
+        concurrent: concurrentToggle ? concurrentToggle.checked : false,
         steps
     };
     
@@ -687,7 +695,7 @@ function saveDrinksToBackend() {
             renderDrinksList();
             showToast('Drinks saved successfully', 'success');
         } else {
-            showToast('Error saving drinks', 'danger');
+            showToast(data.error || 'Error saving drinks', 'danger');
         }
     })
     .catch(error => {
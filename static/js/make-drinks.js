@@ -5,8 +5,11 @@ let currentDrinkTime = 0;
 let progressInterval = null;
 let progressStartTime = 0;
 let progressPhase = -1;
-let serverPoll = null;
 let serverActive = false;
+let currentOrderId = null;
+let progressStream = null;
+// Latest known status per order id, so events that arrive before our order id is known still count
+const orderStatusCache = new Map();
 let lastCommentaryAt = 0;
 const commentaryCooldownMs = 2200;
 const commentaryPhases = [
@@ -132,6 +135,14 @@ function initEventListeners() {
             makeDrink();
         });
     }
+
+    // Cancel a queued order
+    const cancelOrderBtn = document.getElementById('cancelOrderBtn');
+    if (cancelOrderBtn) {
+        cancelOrderBtn.addEventListener('click', () => {
+            cancelOrder();
+        });
+    }
 }
 
 // Prepare to make a drink
@@ -182,9 +193,8 @@ function makeDrink() {
         progressBar.setAttribute('aria-valuenow', 0);
     }
     
-    // Start progress tracking
-    startProgressTracking();
-    startServerProgressPolling();
+    // Listen for order and pour events before queueing so none are missed
+    openProgressStream();
     
     // Send make drink request to server
     fetch(`/api/make-drink/${currentDrinkId}`, {
@@ -202,8 +212,12 @@ function makeDrink() {
             if (estimate && Number.isFinite(estimate)) {
                 currentDrinkTime = Math.max(3, estimate);
             }
-            // Let the progress bar continue until completion
+            // Wait for our order to reach the front of the queue, then track the pour
+            currentOrderId = data.order_id;
             console.log('Making drink:', data.message);
+            showQueuePosition(data.position, data.estimated_wait);
+            const known = orderStatusCache.get(currentOrderId);
+            if (known) applyOrderStatus(known.status, known.error);
         } else {
             throw new Error(data.error || 'Failed to make drink');
         }
@@ -211,18 +225,169 @@ function makeDrink() {
         .catch(error => {
             console.error('Error making drink:', error);
             stopProgressTracking();
-            stopServerProgressPolling();
+            closeProgressStream();
             showErrorModal(error.message);
-        
-        // Hide status banner
-        if (statusOverlay) statusOverlay.classList.add('d-none');
-        
-        // Re-enable all make buttons
-        makeDrinkButtons.forEach(button => {
-            button.disabled = false;
-            button.classList.remove('disabled');
+            resetMakeState();
+    });
+}
+
+// Hide the status banner and re-enable the make buttons
+function resetMakeState() {
+    const statusOverlay = document.getElementById('status-overlay');
+    if (statusOverlay) statusOverlay.classList.add('d-none');
+    const cancelOrderBtn = document.getElementById('cancelOrderBtn');
+    if (cancelOrderBtn) cancelOrderBtn.classList.add('d-none');
+    
+    const makeDrinkButtons = document.querySelectorAll('.make-drink-btn');
+    makeDrinkButtons.forEach(button => {
+        button.disabled = false;
+        button.classList.remove('disabled');
+    });
+    currentOrderId = null;
+}
+
+// Subscribe to server-pushed order, step and completion events
+function openProgressStream() {
+    closeProgressStream();
+    orderStatusCache.clear();
+    progressStream = new EventSource('/api/progress-stream');
+    const source = progressStream;
+    reopenWhenRefused(source, () => {
+        if (progressStream === source) openProgressStream();
+    });
+    
+    // Sent on connect (and on reconnect if events were missed): rebuild from current state
+    progressStream.addEventListener('state', (e) => {
+        const state = JSON.parse(e.data);
+        const orders = state.orders || {};
+        Object.entries(orders.finished || {}).forEach(([id, status]) => {
+            recordOrderStatus(parseInt(id, 10), status, null);
         });
+        if (orders.current !== null && orders.current !== undefined) {
+            recordOrderStatus(orders.current, 'pouring', null);
+        }
+        if (currentOrderId !== null && (orders.queue || []).includes(currentOrderId)) {
+            showQueuePosition(orders.queue.indexOf(currentOrderId) + (orders.current !== null ? 1 : 0));
+        }
+        if (state.drink && state.drink.active && state.drink.order_id === currentOrderId) {
+            updateServerProgress(state.drink.percent, state.drink.current_step, state.drink.steps);
+        }
+    });
+    
+    progressStream.addEventListener('order', (e) => {
+        const order = JSON.parse(e.data);
+        recordOrderStatus(order.id, order.status, order.error);
+        if (currentOrderId !== null && order.id !== currentOrderId && (order.queue || []).includes(currentOrderId)) {
+            showQueuePosition(order.queue.indexOf(currentOrderId) + (order.current !== null ? 1 : 0));
+        }
     });
+    
+    const onStep = (e) => {
+        const step = JSON.parse(e.data);
+        if (step.order_id !== currentOrderId) return;
+        updateServerProgress(step.percent, step.step, step.steps);
+    };
+    progressStream.addEventListener('step-start', onStep);
+    progressStream.addEventListener('step-end', onStep);
+    
+    progressStream.addEventListener('pour-end', (e) => {
+        const pour = JSON.parse(e.data);
+        recordOrderStatus(pour.order_id, pour.success ? 'done' : 'failed', pour.success ? null : 'Pour failed');
+    });
+}
+
+function closeProgressStream() {
+    if (progressStream) {
+        progressStream.close();
+        progressStream = null;
+    }
+    serverActive = false;
+}
+
+function recordOrderStatus(orderId, status, error) {
+    const known = orderStatusCache.get(orderId);
+    if (known && known.status === status) return;
+    orderStatusCache.set(orderId, { status, error });
+    if (orderId === currentOrderId) applyOrderStatus(status, error);
+}
+
+// React to a status change of our own order
+function applyOrderStatus(status, error) {
+    const cancelOrderBtn = document.getElementById('cancelOrderBtn');
+    if (status === 'queued') {
+        if (cancelOrderBtn) cancelOrderBtn.classList.remove('d-none');
+        return;
+    }
+    if (cancelOrderBtn) cancelOrderBtn.classList.add('d-none');
+    if (status === 'pouring') {
+        if (!serverActive) {
+            serverActive = true;
+            startProgressTracking();
+        }
+    } else if (status === 'done') {
+        stopProgressTracking();
+        closeProgressStream();
+        // Small buffer so it never feels like it cuts off early
+        setTimeout(() => drinkComplete(), 800);
+    } else {
+        stopProgressTracking();
+        closeProgressStream();
+        showErrorModal(error || `Order ${status}`);
+        resetMakeState();
+    }
+}
+
+function showQueuePosition(position, estimatedWait) {
+    if (serverActive || !Number.isFinite(position)) return;
+    const statusMessage = document.getElementById('status-message');
+    const statusSubtitle = document.getElementById('status-subtitle');
+    if (statusMessage) {
+        statusMessage.textContent = position > 0 ? `Queued: #${position + 1} in line` : 'Up next...';
+    }
+    if (statusSubtitle && Number.isFinite(estimatedWait)) {
+        statusSubtitle.textContent = `${currentDrinkName} • about ${Math.ceil(estimatedWait)}s to go`;
+    }
+    const cancelOrderBtn = document.getElementById('cancelOrderBtn');
+    if (cancelOrderBtn) cancelOrderBtn.classList.remove('d-none');
+}
+
+// Apply a server progress update (percent + step) to the banner
+function updateServerProgress(percent, step, steps) {
+    const progressBar = document.getElementById('progress-bar');
+    if (progressBar && Number.isFinite(percent)) {
+        progressBar.style.width = `${percent}%`;
+        progressBar.setAttribute('aria-valuenow', percent);
+    }
+    const statusMessage = document.getElementById('status-message');
+    const statusSubtitle = document.getElementById('status-subtitle');
+    const now = Date.now();
+    if (statusMessage && Number.isFinite(percent) && now - lastCommentaryAt > commentaryCooldownMs) {
+        const phaseIndex = Math.min(4, Math.floor((percent / 100) * 5));
+        statusMessage.textContent = pickRandom(commentaryPhases[phaseIndex], `phase-${phaseIndex}`);
+        lastCommentaryAt = now;
+    }
+    if (statusSubtitle && currentDrinkName && step) {
+        statusSubtitle.textContent = `${currentDrinkName} • Step ${step}/${steps}`;
+    }
+}
+
+// Cancel our order while it is still waiting in the queue
+function cancelOrder() {
+    if (currentOrderId === null) return;
+    const orderId = currentOrderId;
+    fetch(`/api/orders/${orderId}/cancel`, { method: 'POST' })
+        .then(res => res.json())
+        .then(data => {
+            if (!data.success) {
+                showErrorModal(data.error || 'Unable to cancel order');
+                return;
+            }
+            closeProgressStream();
+            resetMakeState();
+            currentDrinkId = null;
+            currentDrinkName = null;
+        })
+        .catch(() => showErrorModal('Unable to cancel order'));
 }
 
 // Start tracking progress
@@ -250,7 +415,7 @@ function updateProgress() {
         progressBar.setAttribute('aria-valuenow', percentComplete);
     }
 
-    if (serverPoll) {
+    if (lastCommentaryAt && Date.now() - lastCommentaryAt < commentaryCooldownMs) {
         return;
     }
 
@@ -271,8 +436,8 @@ function updateProgress() {
         }
     }
     
-    // If complete, stop tracking and show completion
-    if (percentComplete >= 100 && elapsedTime >= safeTotal) {
+    // If complete, stop tracking and show completion (the server says when while streaming)
+    if (percentComplete >= 100 && elapsedTime >= safeTotal && !progressStream) {
         stopProgressTracking();
         // Small buffer so it never feels like it cuts off early
         setTimeout(() => drinkComplete(), 800);
@@ -287,64 +452,10 @@ function stopProgressTracking() {
     }
 }
 
-function startServerProgressPolling() {
-    if (serverPoll) clearInterval(serverPoll);
-    serverActive = true;
-    serverPoll = setInterval(() => {
-        fetch('/api/drink-progress')
-            .then(res => res.json())
-            .then(data => {
-                if (!data.active) {
-                    if (serverActive) {
-                        serverActive = false;
-                        stopServerProgressPolling();
-                        stopProgressTracking();
-                        setTimeout(() => drinkComplete(), 800);
-                    }
-                    return;
-                }
-                const progressBar = document.getElementById('progress-bar');
-                if (progressBar) {
-                    progressBar.style.width = `${data.percent}%`;
-                    progressBar.setAttribute('aria-valuenow', data.percent);
-                }
-                const statusMessage = document.getElementById('status-message');
-                const statusSubtitle = document.getElementById('status-subtitle');
-                const now = Date.now();
-                if (statusMessage && now - lastCommentaryAt > commentaryCooldownMs) {
-                    const phaseIndex = Math.min(4, Math.floor((data.percent / 100) * 5));
-                    statusMessage.textContent = pickRandom(commentaryPhases[phaseIndex], `phase-${phaseIndex}`);
-                    lastCommentaryAt = now;
-                }
-                if (statusSubtitle && data.drink_name) {
-                    statusSubtitle.textContent = `${data.drink_name} • Step ${data.current_step}/${data.steps}`;
-                }
-                serverActive = true;
-            })
-            .catch(() => {});
-    }, 500);
-}
-
-function stopServerProgressPolling() {
-    if (serverPoll) {
-        clearInterval(serverPoll);
-        serverPoll = null;
-    }
-    serverActive = false;
-}
-
 // Handle drink completion
 function drinkComplete() {
-    // Hide status banner
-    const statusOverlay = document.getElementById('status-overlay');
-    if (statusOverlay) statusOverlay.classList.add('d-none');
-    
-    // Re-enable all make buttons
-    const makeDrinkButtons = document.querySelectorAll('.make-drink-btn');
-    makeDrinkButtons.forEach(button => {
-        button.disabled = false;
-        button.classList.remove('disabled');
-    });
+    // Hide status banner and re-enable all make buttons
+    resetMakeState();
     
     // Update and show completion modal
     const completeDrinkName = document.getElementById('complete-drink-name');
@@ -18,17 +18,20 @@ function updateLibraryView(data) {
 
     data.folders.forEach(folder => {
         photosContainer.innerHTML += `<h4>${folder}</h4><div class="row" id="folder-${folder}"></div>`;
-        const folderRow = document.getElementById(`folder-${folder}`);
-        Object.entries(data.photos).forEach(([photo, pFolder]) => {
-            if (pFolder === folder) {
+    });
+    fetch('/api/photo-library/list-saved')
+        .then(res => res.json())
+        .then(list => {
+            (list.photos || []).forEach(photo => {
+                const folderRow = document.getElementById(`folder-${photo.folder}`);
+                if (!folderRow) return;
                 folderRow.innerHTML += `
                     <div class="col-md-3">
-                        <img src="/photos/albums/${folder}/${photo}" class="img-thumbnail">
-                        <button onclick="deletePhoto('${photo}')">Delete</button>
+                        <img src="${sizedPhotoUrl(photo.url, 'thumb')}" class="img-thumbnail">
+                        <button onclick="deletePhoto('${photo.name}', '${photo.folder}')">Delete</button>
                     </div>`;
-            }
+            });
         });
-    });
 }
 
 function uploadPhotos() {
@@ -51,10 +54,10 @@ function importFromUSB() {
     }).then(() => loadLibrary());
 }
 
-function deletePhoto(photo) {
+function deletePhoto(photo, folder) {
     fetch('/api/photo-library/manage', {
         method: 'POST',
         headers: {'Content-Type': 'application/json'},
-        body: JSON.stringify({action:'delete_photo', photo})
+        body: JSON.stringify({action:'delete_photo', photo, folder})
     }).then(() => loadLibrary());
 }
@@ -140,7 +140,61 @@ function initializeNavButtons() {
     }
 }
 
-// Periodically update relay states
+// Live relay state feed
+let relayStream = null;
+let relayStreamSeq = null;
+
+// Paint relay buttons and let page scripts react to the new states
+function applyRelayStates(states) {
+    for (const [relay, state] of Object.entries(states)) {
+        const button = document.getElementById(relay);
+        if (button) {
+            button.className = `btn w-100 btn-relay ${state ? 'btn-success' : 'btn-danger'}`;
+            button.innerHTML = `<i class="bi bi-${state ? 'toggle-on' : 'toggle-off'}"></i>${relay}`;
+        }
+    }
+    document.dispatchEvent(new CustomEvent('relaystates', { detail: states }));
+}
+
+// EventSource reconnects by itself after a dropped connection, but gives up for good when
+// the server refuses the stream (503 once every stream slot is taken); try again later then
+const STREAM_RETRY_MS = 10000;
+
+function reopenWhenRefused(source, reopen) {
+    source.addEventListener('error', () => {
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(reopen, STREAM_RETRY_MS + Math.random() * STREAM_RETRY_MS);
+        }
+    });
+}
+
+// Subscribe to relay deltas; a gap in event ids means we missed one, so resync from a fresh snapshot
+function openRelayStream() {
+    if (relayStream) relayStream.close();
+    relayStreamSeq = null;
+    relayStream = new EventSource('/api/relay-stream');
+    const source = relayStream;
+    reopenWhenRefused(source, () => {
+        if (relayStream !== source) return;
+        updateRelayStates();
+        openRelayStream();
+    });
+    relayStream.addEventListener('state', (e) => {
+        relayStreamSeq = parseInt(e.lastEventId, 10);
+        applyRelayStates(JSON.parse(e.data).states || {});
+    });
+    relayStream.addEventListener('relay', (e) => {
+        const seq = parseInt(e.lastEventId, 10);
+        if (relayStreamSeq !== null && seq !== relayStreamSeq + 1) {
+            openRelayStream();
+            return;
+        }
+        relayStreamSeq = seq;
+        applyRelayStates(JSON.parse(e.data).changes || {});
+    });
+}
+
+// Fetch all relay states once
 function updateRelayStates() {
     fetch('/get-states')
         .then(response => response.json())
@@ -166,7 +220,13 @@ function toggleRelay(relayName) {
     }
     
     fetch(`/toggle/${relayName}`)
-        .then(response => response.json())
+        .then(response => {
+            // 503 means the server is shedding load; the relay stream keeps the real state
+            if (!response.ok) {
+                throw new Error(`HTTP error! Status: ${response.status}`);
+            }
+            return response.json();
+        })
         .then(data => {
             const button = document.getElementById(relayName);
             // Update with Bootstrap classes
@@ -201,11 +261,9 @@ document.addEventListener('DOMContentLoaded', () => {
         enableDragScroll(content);
     });
     
-    // Initial update of relay states if we're on a page with relays
+    // Follow relay states live if we're on a page with relays
     if (document.querySelector('.btn-relay')) {
-        updateRelayStates();
-        // Setup periodic updates
-        setInterval(updateRelayStates, 5000);
+        openRelayStream();
     }
 });
 
@@ -277,6 +335,26 @@ function showAppDialog({ title = 'Notice', message = '', confirm = false } = {})
 window.appAlert = (message, title = 'Notice') => showAppDialog({ title, message, confirm: false });
 window.appConfirm = (message, title = 'Confirm') => showAppDialog({ title, message, confirm: true });
 
+// Poll a background job until it finishes; onUpdate(job) sees every status read.
+// Resolves with the finished job (done, failed or cancelled).
+window.waitForJob = (jobId, onUpdate, interval = 1000) => new Promise((resolve, reject) => {
+    const poll = () => {
+        fetch(`/api/jobs/${jobId}?tail=200`)
+            .then(response => response.json())
+            .then(data => {
+                if (!data.success) throw new Error(data.error || 'Job not found');
+                if (onUpdate) onUpdate(data.job);
+                if (['done', 'failed', 'cancelled'].includes(data.job.status)) {
+                    resolve(data.job);
+                } else {
+                    setTimeout(poll, interval);
+                }
+            })
+            .catch(reject);
+    };
+    poll();
+});
+
 // On-screen keyboard for touch inputs
 document.addEventListener('DOMContentLoaded', () => {
     const osk = document.getElementById('osk');
@@ -453,6 +531,12 @@ document.addEventListener('DOMContentLoaded', () => {
     closeBtn.addEventListener('click', hideKeyboard);
 });
 
+// Ask for a downscaled copy of a library/USB photo ('thumb' or 'screen', see PHOTO_VARIANTS in app.py)
+function sizedPhotoUrl(url, size) {
+    if (!url || !(url.startsWith('/photos/albums/') || url.startsWith('/api/photo-library/usb-preview/'))) return url;
+    return `${url}${url.includes('?') ? '&' : '?'}size=${size}`;
+}
+
 // Screensaver
 document.addEventListener('DOMContentLoaded', () => {
     const saver = document.getElementById('screensaver');
@@ -471,7 +555,7 @@ document.addEventListener('DOMContentLoaded', () => {
 
     function showSaver() {
         if (!enabled || !photoUrl) return;
-        saverImg.src = photoUrl;
+        saverImg.src = sizedPhotoUrl(photoUrl, 'screen');
         saver.classList.remove('hidden');
         saver.setAttribute('aria-hidden', 'false');
     }
@@ -30,12 +30,24 @@ function checkForUpdates() {
     const bsUpdateModal = new bootstrap.Modal(updateModal);
     bsUpdateModal.show();
     
+    // The update runs as a background job; show its output as it arrives
+    let shown = 0;
+    const showOutput = (job) => {
+        const fresh = job.output_lines - shown;
+        if (fresh > 0) {
+            job.output.slice(-fresh).forEach(line => { updateLogs.innerHTML += line + "\n"; });
+            shown = job.output_lines;
+            updateLogs.scrollTop = updateLogs.scrollHeight;
+        }
+    };
+
     fetch('/git-pull')
         .then(response => response.json())
-        .then(data => {
-            if (data.success) {
+        .then(data => window.waitForJob(data.job_id, showOutput))
+        .then(job => {
+            if (job.status === 'done') {
                 updateLogs.innerHTML += "Safe update successful.\n";
-                updateLogs.innerHTML += data.output + "\n";
+                updateLogs.innerHTML += job.result + "\n";
                 updateLogs.innerHTML += "Rebooting system in 5 seconds...\n";
                 
                 // Auto scroll to bottom
@@ -47,7 +59,7 @@ function checkForUpdates() {
                 }, 5000);
             } else {
                 updateLogs.innerHTML += "Safe update failed:\n";
-                updateLogs.innerHTML += data.error + "\n";
+                updateLogs.innerHTML += (job.error || job.status) + "\n";
             }
             
             // Auto scroll to bottom
@@ -70,30 +82,79 @@ function performSystemUpdate() {
     const bsUpdateModal = new bootstrap.Modal(updateModal);
     bsUpdateModal.show();
     
-    // Create EventSource for streaming update logs
-    const eventSource = new EventSource('/system-update-logs');
-    
-    eventSource.onmessage = (event) => {
-        // Append the new log line
-        updateLogs.innerHTML += event.data + "\n";
-        // Auto-scroll to the latest log
+    // Starting returns the running update instead of a second one
+    fetch('/system-update', { method: 'POST' })
+        .then(response => response.json())
+        .then(data => followSystemUpdate(data.job_id))
+        .catch(err => {
+            updateLogs.innerHTML += `Could not start the update: ${err.message}\n`;
+        });
+}
+
+let systemUpdateStream = null;
+
+const APT_PHASES = { update: 'Refreshing package lists', download: 'Downloading', unpack: 'Unpacking', configure: 'Setting up', done: 'Finished' };
+
+function showUpdateProgress(progress) {
+    const box = document.getElementById('update-progress');
+    if (!box || !progress) return;
+    box.style.display = '';
+    document.getElementById('update-progress-bar').style.width = `${progress.percent}%`;
+    const phase = APT_PHASES[progress.phase] || progress.phase;
+    document.getElementById('update-progress-text').textContent = progress.total
+        ? `${phase}${progress.package ? ` ${progress.package}` : ''} — ${progress.done}/${progress.total} packages`
+        : (progress.phase === 'done' ? 'Everything is already up to date' : phase);
+}
+
+// Stream the update's log. The stream is separate from the update itself: after a drop
+// the browser reconnects with Last-Event-ID and gets exactly the lines it missed.
+function followSystemUpdate(jobId) {
+    const updateLogs = document.getElementById('update-logs');
+    if (systemUpdateStream) systemUpdateStream.close();
+    const append = (text) => {
+        updateLogs.innerHTML += text + "\n";
         updateLogs.scrollTop = updateLogs.scrollHeight;
     };
+    const eventSource = new EventSource(`/system-update-logs?job=${encodeURIComponent(jobId)}`);
+    systemUpdateStream = eventSource;
     
-    eventSource.onerror = () => {
-        // Close the connection when it errors out (which might be normal at the end)
+    eventSource.addEventListener('line', (event) => append(JSON.parse(event.data).line));
+    eventSource.addEventListener('progress', (event) => showUpdateProgress(JSON.parse(event.data)));
+    eventSource.addEventListener('state', (event) => {
+        const state = JSON.parse(event.data);
+        if (state.missed) append(`... ${state.missed} earlier lines not kept ...`);
+        showUpdateProgress(state.progress);
+    });
+    eventSource.addEventListener('end', (event) => {
+        const end = JSON.parse(event.data);
         eventSource.close();
-        
-        // Add a final message if it's not already there
-        if (!updateLogs.innerHTML.includes("System update completed") && 
-            !updateLogs.innerHTML.includes("Update failed")) {
-            updateLogs.innerHTML += "Connection closed. The system may be rebooting.\n";
+        systemUpdateStream = null;
+        if (end.status !== 'done') append(`System update ${end.status}: ${end.error || ''}`);
+    });
+    
+    eventSource.onerror = () => {
+        // EventSource retries on its own; once it gives up the server is gone (usually rebooting)
+        if (eventSource.readyState === EventSource.CLOSED) {
+            systemUpdateStream = null;
+            append("Connection closed. The system may be rebooting.");
         }
-        
-        updateLogs.scrollTop = updateLogs.scrollHeight;
     };
 }
 
+// After a reload mid-update, reopen the log where it is
+function resumeSystemUpdateView() {
+    fetch('/api/jobs')
+        .then(res => res.json())
+        .then(data => {
+            const running = (data.jobs || []).find(job => job.kind === 'system-update' && ['queued', 'running'].includes(job.status));
+            if (!running) return;
+            document.getElementById('update-logs').innerHTML = '';
+            new bootstrap.Modal(document.getElementById('update-modal')).show();
+            followSystemUpdate(running.id);
+        })
+        .catch(() => {});
+}
+
 // Close the update modal
 function closeUpdateModal() {
     const updateModal = document.getElementById('update-modal');
@@ -166,7 +227,7 @@ function loadScreensaver() {
                     card.className = 'btn btn-outline w-100';
                     card.style.textAlign = 'left';
                     card.innerHTML = `
-                        <img src="${photo.url}" alt="${photo.name}" style="width:100%; height:120px; object-fit:cover; border-radius:10px; margin-bottom:8px;">
+                        <img src="${sizedPhotoUrl(photo.url, 'thumb')}" alt="${photo.name}" style="width:100%; height:120px; object-fit:cover; border-radius:10px; margin-bottom:8px;">
                         <div>${photo.folder}/${photo.name}</div>
                     `;
                     card.addEventListener('click', () => {
@@ -210,7 +271,7 @@ function setScreensaverPhoto(url) {
         previewImg.src = '';
         return;
     }
-    previewImg.src = url;
+    previewImg.src = sizedPhotoUrl(url, 'screen');
     previewWrap.style.display = 'block';
 }
 
@@ -277,26 +338,52 @@ function openWiFiConfig() {
 }
 
 // Relay configuration
+const RELAY_DRIVER_LABELS = { gpio: 'Onboard GPIO', mcp23017: 'MCP23017 expander', mock: 'Simulated' };
+
+function relayAddressHex(address) {
+    return `0x${Number(address ?? 0x20).toString(16)}`;
+}
+
+function showRelayDriverFields(row) {
+    const driver = row.querySelector('.relay-driver').value;
+    row.querySelector('.relay-gpio-fields').style.display = driver === 'gpio' ? '' : 'none';
+    row.querySelector('.relay-expander-fields').style.display = driver === 'mcp23017' ? '' : 'none';
+}
+
 function renderRelayConfig(relays) {
     const container = document.getElementById('relayConfigList');
     if (!container) return;
     container.innerHTML = '';
     relays.forEach((relay, idx) => {
+        const driver = relay.driver || 'gpio';
         const row = document.createElement('div');
         row.className = 'panel';
         row.style.padding = '12px';
         row.innerHTML = `
             <div class="grid grid-2">
                 <input class="form-control osk-input relay-name" type="text" value="${relay.name || `Relay ${idx + 1}`}" placeholder="Relay name">
+                <select class="form-select relay-driver">
+                    ${Object.entries(RELAY_DRIVER_LABELS).map(([value, label]) =>
+                        `<option value="${value}" ${driver === value ? 'selected' : ''}>${label}</option>`).join('')}
+                </select>
+            </div>
+            <div class="grid grid-2 relay-gpio-fields" style="margin-top: 8px;">
                 <input class="form-control relay-gpio" type="number" value="${relay.gpio ?? ''}" placeholder="GPIO">
             </div>
+            <div class="grid grid-3 relay-expander-fields" style="margin-top: 8px;">
+                <input class="form-control relay-bus" type="number" min="0" value="${relay.bus ?? 1}" placeholder="I2C bus">
+                <input class="form-control relay-address" type="text" value="${relayAddressHex(relay.address)}" placeholder="Address (0x20)">
+                <input class="form-control relay-pin" type="number" min="0" max="15" value="${relay.pin ?? ''}" placeholder="Pin 0-15">
+            </div>
             <div style="margin-top: 8px;">
                 <button class="btn btn-outline w-100 relay-remove">Remove</button>
             </div>
         `;
+        row.querySelector('.relay-driver').addEventListener('change', () => showRelayDriverFields(row));
         row.querySelector('.relay-remove').addEventListener('click', () => {
             row.remove();
         });
+        showRelayDriverFields(row);
         container.appendChild(row);
     });
 }
@@ -306,38 +393,58 @@ function loadRelayConfig() {
         .then(res => res.json())
         .then(data => {
             if (data.success) renderRelayConfig(data.relays || []);
+            const maxConcurrent = document.getElementById('maxConcurrentRelays');
+            if (maxConcurrent && data.success) maxConcurrent.value = data.max_concurrent_relays || 0;
         })
         .catch(() => {});
 }
 
+// Read a relay row back into the shape /api/relays takes
+function readRelayRow(row, idx) {
+    const relay = {
+        name: row.querySelector('.relay-name')?.value?.trim() || `Relay ${idx + 1}`,
+        driver: row.querySelector('.relay-driver')?.value || 'gpio'
+    };
+    if (relay.driver === 'gpio') {
+        relay.gpio = parseInt(row.querySelector('.relay-gpio')?.value || '0', 10);
+    } else if (relay.driver === 'mcp23017') {
+        relay.bus = parseInt(row.querySelector('.relay-bus')?.value || '1', 10);
+        relay.address = parseInt(row.querySelector('.relay-address')?.value || '0x20');
+        relay.pin = parseInt(row.querySelector('.relay-pin')?.value ?? '', 10);
+    }
+    return relay;
+}
+
 function addRelayRow() {
     const container = document.getElementById('relayConfigList');
     if (!container) return;
-    const idx = container.children.length + 1;
-    renderRelayConfig([
-        ...Array.from(container.children).map(row => ({
-            name: row.querySelector('.relay-name')?.value || `Relay ${idx}`,
-            gpio: row.querySelector('.relay-gpio')?.value || ''
-        })),
-        { name: `Relay ${idx}`, gpio: '' }
-    ]);
+    const rows = Array.from(container.children).map(readRelayRow);
+    const last = rows[rows.length - 1];
+    const idx = rows.length + 1;
+    // Expander boards are filled pin by pin, so continue on the same board
+    const next = last && last.driver === 'mcp23017' && last.pin < 15
+        ? { name: `Relay ${idx}`, driver: 'mcp23017', bus: last.bus, address: last.address, pin: last.pin + 1 }
+        : { name: `Relay ${idx}`, gpio: '' };
+    renderRelayConfig([...rows, next]);
 }
 
 function saveRelayConfig() {
     const container = document.getElementById('relayConfigList');
     if (!container) return;
-    const relays = Array.from(container.children).map((row, idx) => ({
-        name: row.querySelector('.relay-name')?.value?.trim() || `Relay ${idx + 1}`,
-        gpio: parseInt(row.querySelector('.relay-gpio')?.value || '0', 10)
-    }));
-    if (relays.some(r => !r.gpio || r.gpio <= 0)) {
+    const relays = Array.from(container.children).map(readRelayRow);
+    if (relays.some(r => r.driver === 'gpio' && (!r.gpio || r.gpio <= 0))) {
         window.appAlert('Please enter valid GPIO numbers for all relays.');
         return;
     }
+    if (relays.some(r => r.driver === 'mcp23017' && !(r.pin >= 0 && r.pin <= 15 && r.address >= 0x20 && r.address <= 0x27))) {
+        window.appAlert('Expander relays need an address from 0x20 to 0x27 and a pin from 0 to 15.');
+        return;
+    }
+    const maxConcurrent = parseInt(document.getElementById('maxConcurrentRelays')?.value || '0', 10);
     fetch('/api/relays', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ relays })
+        body: JSON.stringify({ relays, max_concurrent_relays: Number.isFinite(maxConcurrent) ? maxConcurrent : 0 })
     })
     .then(res => res.json())
     .then(data => {
@@ -398,7 +505,7 @@ function checkNetworkManagerStatus() {
             } else {
                 updateWiFiStatus();
                 // Auto-scan for networks if NetworkManager is working
-                setTimeout(() => scanForNetworks(), 500);
+                setTimeout(() => scanForNetworks(false), 500);
             }
         })
         .catch(err => {
@@ -476,12 +583,15 @@ function enableNetworkManager() {
         });
 }
 
-// Enhanced WiFi network scanning with better error handling
-function scanForNetworks() {
+// Enhanced WiFi network scanning with better error handling.
+// The server answers from its scan cache; if a rescan is running we show the cached
+// list straight away and follow up once with ?wait=1 for the fresh results.
+function scanForNetworks(refresh = true, wait = false) {
     const networksContainer = document.getElementById('networks-container');
     const scanBtn = document.getElementById('scan-networks-btn');
+    const url = wait ? '/scan-wifi-networks?wait=1' : `/scan-wifi-networks${refresh ? '?refresh=1' : ''}`;
     
-    if (networksContainer) {
+    if (networksContainer && !wait) {
         networksContainer.innerHTML = `
             <div class="text-center py-4">
                 <div class="spinner-border text-primary mb-3" role="status"></div>
@@ -496,10 +606,12 @@ function scanForNetworks() {
         scanBtn.innerHTML = '<span class="spinner-border spinner-border-sm" role="status" aria-hidden="true"></span> Scanning...';
     }
     
-    fetch('/scan-wifi-networks')
+    fetch(url)
         .then(response => response.json())
         .then(data => {
-            if (scanBtn) {
+            if (data.scanning && !wait) {
+                scanForNetworks(false, true);
+            } else if (scanBtn) {
                 scanBtn.disabled = false;
                 scanBtn.innerHTML = '<i class="bi bi-arrow-repeat"></i> Scan Again';
             }
@@ -1112,6 +1224,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 .catch(() => window.appAlert('Rollback failed'));
         });
     }
+    resumeSystemUpdateView();
     loadRelayConfig();
     const addRelayBtn = document.getElementById('addRelayBtn');
     const saveRelayBtn = document.getElementById('saveRelayBtn');
@@ -2,7 +2,9 @@
 let allRelaysOn = false;
 let testInProgress = false;
 let currentModal = null; // Track the current modal instance
-let selfTestPoll = null;
+let testStream = null;
+let followingSelfTest = false;
+let testEnd = null; // The test this page started: {test, resolve, started}
 
 // Log message function
 function logMessage(message) {
@@ -20,20 +22,6 @@ function logMessage(message) {
     }
 }
 
-// Add function to check test status
-function checkTestStatus() {
-    return fetch('/test-in-progress')
-        .then(response => response.json())
-        .then(data => {
-            testInProgress = data.testing;
-            return testInProgress;
-        })
-        .catch(err => {
-            console.error('Error checking test status:', err);
-            return false;
-        });
-}
-
 // Utility function to show a modal
 function showModal(title, message) {
     // Hide any existing modal first
@@ -89,6 +77,9 @@ function toggleRelay(relayName) {
             if (response.status === 409) {
                 throw new Error('Test in progress');
             }
+            if (response.status === 503) {
+                throw new Error('Server busy');
+            }
             return response.json();
         })
         .then(data => {
@@ -108,6 +99,8 @@ function toggleRelay(relayName) {
             }
             if (err.message === 'Test in progress') {
                 showModal('Error', 'Cannot toggle relay while a test is running.');
+            } else if (err.message === 'Server busy') {
+                showModal('Busy', 'The controller is busy, please try again.');
             }
         });
 }
@@ -131,6 +124,9 @@ function toggleAll() {
             if (response.status === 409) {
                 throw new Error('Test in progress');
             }
+            if (response.status === 503) {
+                throw new Error('Server busy');
+            }
             return response.json();
         })
         .then(data => {
@@ -151,10 +147,61 @@ function toggleAll() {
             }
             if (err.message === 'Test in progress') {
                 showModal('Error', 'Cannot toggle relays while a test is running.');
+            } else if (err.message === 'Server busy') {
+                showModal('Busy', 'The controller is busy, please try again.');
             }
         });
 }
 
+// Run a relay for a set time (optionally repeated), timed on the server
+function pulseRelay() {
+    if (testInProgress) {
+        showModal('Test in Progress', 'Please wait for the current test to complete.');
+        return;
+    }
+    const relay = document.getElementById('pulseRelay')?.value;
+    const duration = parseFloat(document.getElementById('pulseSeconds')?.value || '0');
+    const repeat = parseInt(document.getElementById('pulseRepeat')?.value || '1', 10) || 1;
+    if (!relay || !(duration > 0)) {
+        showModal('Pulse', 'Enter how many seconds to run the relay for.');
+        return;
+    }
+    fetch('/api/relays/pulses', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ relay, duration, repeat })
+    })
+        .then(response => {
+            if (response.status === 503) {
+                throw new Error('Server busy');
+            }
+            return response.json();
+        })
+        .then(data => {
+            if (!data.success) {
+                showModal('Pulse', data.error || 'Could not start the pulse.');
+                return;
+            }
+            logMessage(`${relay} pulsing ${duration}s${repeat > 1 ? ` x${repeat}` : ''}`);
+        })
+        .catch(err => {
+            console.error('Error starting pulse:', err);
+            showModal(err.message === 'Server busy' ? 'Busy' : 'Error',
+                err.message === 'Server busy' ? 'The controller is busy, please try again.' : 'Could not start the pulse.');
+        });
+}
+
+function cancelPulses() {
+    fetch('/api/relays/pulses', { method: 'DELETE' })
+        .then(response => response.json())
+        .then(data => {
+            if (data.success) {
+                logMessage(data.cancelled.length ? `Cancelled pulses: ${data.cancelled.join(', ')}` : 'No pulses running');
+            }
+        })
+        .catch(err => console.error('Error cancelling pulses:', err));
+}
+
 // Update the toggle all button appearance
 function updateToggleAllButton() {
     const button = document.getElementById('toggleAllButton');
@@ -182,6 +229,7 @@ function timeTest() {
     showModal('Time Test', 'Running time test...'); // Show initial modal
     logMessage('Starting time test...');
     
+    const ended = waitForTestEnd('time');
     fetch('/time-test')
         .then(response => {
             if (response.status === 409) {
@@ -189,11 +237,13 @@ function timeTest() {
             }
             return response.json();
         })
-        .then(data => {
+        .then(data => testStarted(data, ended))
+        .then(end => {
+            if (end.success === false) throw new Error('Test did not finish');
             testInProgress = false;
             disableRelayButtons(false); // Re-enable relay buttons after the test
-            showModal('Time Test Completed', data.status);
-            logMessage(`Time test completed: ${data.status}`);
+            showModal('Time Test Completed', end.result);
+            logMessage(`Time test completed: ${end.result}`);
             
             if (button) {
                 button.classList.remove('opacity-75');
@@ -201,6 +251,7 @@ function timeTest() {
         })
         .catch(err => {
             console.error('Error performing time test:', err);
+            testEnd = null;
             testInProgress = false;
             disableRelayButtons(false);
             
@@ -236,8 +287,9 @@ function selfTest() {
     
     showModal('Self Test', 'Running relay self test (sequential on/off)...');
     logMessage('Starting relay self test (sequential)...');
-    startSelfTestPolling();
+    startFollowingSelfTest();
     
+    const ended = waitForTestEnd('self');
     fetch('/self-test')
         .then(response => {
             if (response.status === 409) {
@@ -245,12 +297,14 @@ function selfTest() {
             }
             return response.json();
         })
-        .then(data => {
+        .then(data => testStarted(data, ended))
+        .then(end => {
+            if (end.success === false) throw new Error('Test did not finish');
             testInProgress = false;
             disableRelayButtons(false); // Re-enable relay buttons after the test
-            showModal('Self Test Completed', data.status);
-            logMessage(`Self test completed: ${data.status}`);
-            stopSelfTestPolling();
+            showModal('Self Test Completed', end.result);
+            logMessage(`Self test completed: ${end.result}`);
+            stopFollowingSelfTest();
             
             if (button) {
                 button.classList.remove('opacity-75');
@@ -258,9 +312,10 @@ function selfTest() {
         })
         .catch(err => {
             console.error('Error performing self-test:', err);
+            testEnd = null;
             testInProgress = false;
             disableRelayButtons(false);
-            stopSelfTestPolling();
+            stopFollowingSelfTest();
             
             if (button) {
                 button.classList.remove('opacity-75');
@@ -276,26 +331,68 @@ function selfTest() {
         });
 }
 
-function startSelfTestPolling() {
-    if (selfTestPoll) clearInterval(selfTestPoll);
-    selfTestPoll = setInterval(() => {
-        fetch('/api/self-test-progress')
-            .then(res => res.json())
-            .then(data => {
-                if (!data.active) return;
-                const msg = `Testing ${data.relay}: ${data.action} (step ${data.step}/${data.steps})`;
-                updateModalMessage(msg);
-                logMessage(msg);
-            })
-            .catch(() => {});
-    }, 400);
+// Track tests and pours (from any screen) pushed by the server instead of polling for them
+function openTestStream() {
+    if (testStream) testStream.close();
+    testStream = new EventSource('/api/progress-stream');
+    const source = testStream;
+    reopenWhenRefused(source, () => {
+        if (testStream === source) openTestStream();
+    });
+    const showStep = (data) => {
+        if (!followingSelfTest || !data || !data.active) return;
+        const msg = `Testing ${data.relay}: ${data.action} (step ${data.step}/${data.steps})`;
+        updateModalMessage(msg);
+        logMessage(msg);
+    };
+    testStream.addEventListener('state', (e) => {
+        const state = JSON.parse(e.data);
+        testInProgress = !!state.testing;
+        showStep(state.self_test);
+        // Reconnected too late to replay test-end: the test is over, outcome unknown
+        if (!state.testing && testEnd && testEnd.started) {
+            settleTestEnd({test: testEnd.test, success: null, result: 'Test finished'});
+        }
+    });
+    testStream.addEventListener('test-step', (e) => {
+        showStep(JSON.parse(e.data));
+    });
+    ['test-start', 'pour-start'].forEach(name => {
+        testStream.addEventListener(name, () => { testInProgress = true; });
+    });
+    ['test-end', 'pour-end'].forEach(name => {
+        testStream.addEventListener(name, () => { testInProgress = false; });
+    });
+    testStream.addEventListener('test-end', (e) => {
+        const data = JSON.parse(e.data);
+        if (testEnd && testEnd.test === data.test) settleTestEnd(data);
+    });
+}
+
+// Our own tests finish on the stream's test-end rather than by polling their job
+function waitForTestEnd(test) {
+    return new Promise(resolve => { testEnd = {test, resolve, started: false}; });
+}
+
+function testStarted(data, ended) {
+    if (!data.success) throw new Error(data.status || 'Test did not start');
+    if (testEnd) testEnd.started = true;
+    return ended;
 }
 
-function stopSelfTestPolling() {
-    if (selfTestPoll) {
-        clearInterval(selfTestPoll);
-        selfTestPoll = null;
-    }
+function settleTestEnd(end) {
+    const waiter = testEnd;
+    testEnd = null;
+    if (waiter) waiter.resolve(end);
+}
+
+// Show self-test steps in the modal while our own self test runs
+function startFollowingSelfTest() {
+    followingSelfTest = true;
+}
+
+function stopFollowingSelfTest() {
+    followingSelfTest = false;
 }
 
 // Disable or enable relay buttons
@@ -339,11 +436,9 @@ function updateAllRelaysState() {
 
 // Initialize
 document.addEventListener('DOMContentLoaded', () => {
-    // Check test status initially
-    checkTestStatus();
-    
-    // Initialize toggle all button state
-    updateRelayStates();
+    // Follow test status live; relay states arrive via the relay stream in script.js
+    openTestStream();
+    document.addEventListener('relaystates', () => updateAllRelaysState());
     
     // Add event listeners with proper event handling
     const timeTestBtn = document.getElementById('timeTestBtn');
@@ -368,6 +463,11 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
     
+    const pulseBtn = document.getElementById('pulseBtn');
+    const cancelPulsesBtn = document.getElementById('cancelPulsesBtn');
+    if (pulseBtn) pulseBtn.addEventListener('click', pulseRelay);
+    if (cancelPulsesBtn) cancelPulsesBtn.addEventListener('click', cancelPulses);
+    
     if (toggleAllBtn) {
         toggleAllBtn.addEventListener('click', function() {
             // Only proceed if the button isn't handling a previous click
@@ -393,14 +493,6 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
     
-    // Periodically update relay states and check test status
-    setInterval(() => {
-        if (!testInProgress) {
-            updateRelayStates();
-            checkTestStatus();
-        }
-    }, 2000);
-    
     // Log initial state
     logMessage('Test mode initialized - ready for operation');
 });
@@ -0,0 +1,31 @@
+"""Run the app out of a scratch directory with in-memory relays.
+
+app.py keeps its state files relative to the working directory and opens the
+relays on import, so both are arranged here before the first `import app`.
+"""
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp(prefix="relay-control-tests-")
+TEST_RELAYS = [{"name": f"Relay {n}", "gpio": pin} for n, pin in ((1, 17), (2, 27), (3, 22), (4, 23))]
+
+os.environ.setdefault("GPIOZERO_PIN_FACTORY", "mock")
+with open(os.path.join(WORKDIR, "config.json"), "w") as f:
+    json.dump({"system_name": "Test Bar", "relay_backend": "mock", "relays": TEST_RELAYS}, f)
+os.chdir(WORKDIR)
+sys.path.insert(0, ROOT)
+
+import app as relay_app  # noqa: E402
+
+@pytest.fixture
+def app_module():
+    return relay_app
+
+@pytest.fixture
+def client():
+    return relay_app.app.test_client()
@@ -0,0 +1,63 @@
+import pytest
+
+def step(relay, action, time):
+    return {"relay": relay, "action": action, "time": time}
+
+def timeline(plan):
+    return [(event.at, event.relay_name, event.on) for event in plan.events]
+
+def test_sequential_steps_hand_over_without_overlap(app_module):
+    plan = app_module.compile_drink({"name": "Layered", "steps": [
+        step(1, "on", 2), step(1, "off", 0), step(2, "on", 1), step(2, "off", 0),
+    ]})
+
+    assert plan.total_time == 3
+    # Relay 1 goes off before relay 2 comes on at the same instant
+    assert timeline(plan) == [
+        (0.0, "Relay 1", True), (2.0, "Relay 1", False), (2.0, "Relay 2", True), (3.0, "Relay 2", False),
+    ]
+
+def test_redundant_transitions_are_dropped(app_module):
+    plan = app_module.compile_drink({"steps": [step(1, "off", 0), step(1, "on", 1), step(1, "on", 1)]})
+
+    assert timeline(plan) == [(0.0, "Relay 1", True)]
+    assert plan.total_time == 2
+
+def test_concurrent_pours_start_together_without_a_limit(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "get_max_concurrent_relays", lambda: None)
+    plan = app_module.compile_drink({"concurrent": True, "steps": [
+        step(1, "on", 3), step(2, "on", 1), step(3, "on", 2),
+    ]})
+
+    assert plan.total_time == 3
+    assert sorted(at for at, _, on in timeline(plan) if on) == [0.0, 0.0, 0.0]
+
+def test_concurrent_pours_are_packed_under_the_limit(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "get_max_concurrent_relays", lambda: 2)
+    plan = app_module.compile_drink({"concurrent": True, "steps": [
+        step(1, "on", 3), step(2, "on", 2), step(3, "on", 2), step(4, "on", 1),
+    ]})
+
+    # {3, 1} and {2, 2} is the shortest split over two pumps
+    assert plan.total_time == 4
+    running = set()
+    for _, relay, on in timeline(plan):
+        (running.add if on else running.discard)(relay)
+        assert len(running) <= 2
+
+def test_same_pump_twice_is_one_longer_pour(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "get_max_concurrent_relays", lambda: None)
+    plan = app_module.compile_drink({"concurrent": True, "steps": [step(1, "on", 1), step(1, "on", 2)]})
+
+    assert timeline(plan) == [(0.0, "Relay 1", True), (3.0, "Relay 1", False)]
+    assert plan.step_offsets == ((0.0, 1.0), (1.0, 2.0))
+
+def test_compile_drinks_indexes_plans_and_rejects_bad_steps(app_module):
+    plans = app_module.compile_drinks([{"name": "A", "steps": [step(1, "on", 1)]},
+                                       {"name": "B", "steps": [step(2, "on", 1)]}])
+    assert {idx: plan.name for idx, plan in plans.items()} == {0: "A", 1: "B"}
+
+    with pytest.raises(ValueError, match="only 4 configured"):
+        app_module.compile_drinks([{"name": "Bad", "steps": [step(9, "on", 1)]}])
+    with pytest.raises(ValueError, match="invalid action"):
+        app_module.compile_drink({"name": "Bad", "steps": [step(1, "pour", 1)]})
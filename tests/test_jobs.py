@@ -0,0 +1,102 @@
+import json
+import threading
+import time
+
+import pytest
+
+def sse_events(body):
+    """[(id, event, data)] from an SSE body, skipping keep-alive comments."""
+    events = []
+    for block in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if line and not line.startswith(":"))
+        if fields:
+            events.append((int(fields["id"]), fields["event"], json.loads(fields["data"])))
+    return events
+
+def finished_job(app_module, lines, kind="system-update"):
+    def work(job):
+        for line in lines:
+            job.log(line)
+        return "ok"
+    job = app_module.job_engine.submit(kind, work, group="test")
+    wait_until_finished(job)
+    assert job.status == "done"
+    return job
+
+def wait_until_finished(job, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not job.finished and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+def follow(client, url, **kwargs):
+    # Closing the stream hands its lane slot back
+    with client.get(url, **kwargs) as response:
+        return response.get_data(as_text=True)
+
+def test_log_stream_replays_from_the_start(app_module, client):
+    job = finished_job(app_module, ["one", "two", "three"])
+
+    events = sse_events(follow(client, f"/system-update-logs?job={job.id}"))
+
+    assert [event for _, event, _ in events] == ["line", "line", "line", "end"]
+    assert [data["line"] for _, event, data in events if event == "line"] == ["one", "two", "three"]
+    assert [event_id for event_id, _, _ in events] == [1, 2, 3, 4]
+
+def test_reconnect_with_last_event_id_gets_only_missed_lines(app_module, client):
+    job = finished_job(app_module, ["one", "two", "three"])
+
+    body = follow(client, f"/system-update-logs?job={job.id}", headers={"Last-Event-ID": "2"})
+
+    assert [(event_id, event) for event_id, event, _ in sse_events(body)] == [(3, "line"), (4, "end")]
+
+def test_viewer_behind_the_ring_is_told_what_it_missed(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "JOB_EVENT_HISTORY", 3)
+    job = finished_job(app_module, [f"line {n}" for n in range(10)])
+
+    events = sse_events("".join(app_module.job_event_stream(job, None)))
+
+    assert events[0][1] == "state" and events[0][2]["missed"] == 8
+    assert [event_id for event_id, _, _ in events[1:]] == [9, 10, 11]
+    assert events[-1][1] == "end"
+
+def test_progress_events_follow_apt_output(app_module):
+    progress = app_module.AptProgress()
+    lines = ["Get:1 http://deb.example bookworm InRelease [151 kB]",
+             "1 upgraded, 0 newly installed, 0 to remove and 0 not upgraded.",
+             "Get:2 http://deb.example bookworm/main arm64 libfoo arm64 1.1 [10 kB]",
+             "Unpacking libfoo (1.1) over (1.0) ...",
+             "Setting up libfoo (1.1) ..."]
+
+    seen = [progress.feed(line) for line in lines]
+
+    assert seen[0] is None
+    assert [(p["phase"], p["percent"]) for p in seen[1:]] == [
+        ("download", 0), ("download", 20), ("unpack", 50), ("configure", 100)]
+    assert seen[-1]["done"] == seen[-1]["total"] == 1
+
+def test_log_stream_never_starts_an_update(app_module, client):
+    before = len(app_module.job_engine.jobs())
+    response = client.get("/system-update-logs?job=missing")
+    assert response.status_code == 404
+    assert len(app_module.job_engine.jobs()) == before
+
+def test_group_limit_queues_and_unique_returns_the_running_job(app_module):
+    engine = app_module.JobEngine(workers=2, limits={"update": 1})
+    gate = threading.Event()
+    first = engine.submit("update", lambda job: gate.wait(5) and "first", group="update", unique=True)
+    assert engine.submit("update", lambda job: "again", group="update", unique=True) is first
+    second = engine.submit("other-update", lambda job: "second", group="update")
+
+    time.sleep(0.1)
+    assert (first.status, second.status) == ("running", "queued")
+    assert engine.cancel(second.id).status == "cancelled"
+
+    gate.set()
+    wait_until_finished(first)
+    assert (first.status, first.result) == ("done", "first")
+
+@pytest.mark.parametrize("tail", ["0", "5", "abc"])
+def test_job_status_tail(app_module, client, tail):
+    job = finished_job(app_module, [f"line {n}" for n in range(10)], kind="test-job")
+    data = client.get(f"/api/jobs/{job.id}?tail={tail}").get_json()
+    assert data["success"] and data["job"]["output_lines"] == 10
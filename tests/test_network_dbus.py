@@ -0,0 +1,91 @@
+"""NetworkManagerDBus against python-dbusmock's NetworkManager on a private system bus."""
+import subprocess
+
+import pytest
+
+dbusmock = pytest.importorskip("dbusmock")
+import dbus  # noqa: E402  (installed with python-dbusmock)
+from dbusmock.templates.networkmanager import (  # noqa: E402
+    DeviceState,
+    InfrastructureMode,
+    NM80211ApSecurityFlags,
+)
+
+import app  # noqa: E402
+
+WPA_PSK = NM80211ApSecurityFlags.NM_802_11_AP_SEC_KEY_MGMT_PSK
+OPEN = NM80211ApSecurityFlags.NM_802_11_AP_SEC_NONE
+
+class TestNetworkManagerDBus(dbusmock.DBusTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Sets DBUS_SYSTEM_BUS_ADDRESS, which the backend's connection follows
+        cls.start_system_bus()
+        cls.dbus_con = cls.get_dbus(system_bus=True)
+
+    def setUp(self):
+        self.p_mock, self.obj_nm = self.spawn_server_template(
+            "networkmanager", {"NetworkingEnabled": True, "WirelessEnabled": True}, stdout=subprocess.PIPE)
+        self.mock = dbus.Interface(self.obj_nm, dbusmock.MOCK_IFACE)
+        self.device = self.mock.AddWiFiDevice("mock_WiFi", "wlan0", DeviceState.DISCONNECTED)
+        self.backend = app.NetworkManagerDBus()
+
+    def tearDown(self):
+        self.backend.close()
+        self.p_mock.stdout.close()
+        self.p_mock.terminate()
+        self.p_mock.wait()
+
+    def add_access_point(self, name, ssid, strength, security):
+        return self.mock.AddAccessPoint(self.device, name, ssid, "00:11:22:33:44:%02x" % strength,
+                                        InfrastructureMode.NM_802_11_MODE_INFRA, 2412, 54000,
+                                        strength, security)
+
+    def test_check_status(self):
+        ok, message = self.backend.check_status()
+        self.assertTrue(ok, message)
+
+    def test_scan_keeps_strongest_access_point_per_ssid(self):
+        self.add_access_point("ap_cafe_far", "Cafe", 30, WPA_PSK)
+        self.add_access_point("ap_cafe_near", "Cafe", 80, WPA_PSK)
+        self.add_access_point("ap_guest", "Guest", 55, OPEN)
+
+        ok, networks = self.backend.scan()
+
+        self.assertTrue(ok, networks)
+        self.assertEqual(networks, [
+            {"ssid": "Cafe", "signal": 80, "security": True},
+            {"ssid": "Guest", "signal": 55, "security": False},
+        ])
+
+    def test_status_disconnected(self):
+        self.assertEqual(self.backend.wifi_status(), {"connected": False})
+
+    def test_status_reads_active_connection(self):
+        self.add_access_point("ap_home", "Home", 70, WPA_PSK)
+        connection = self.mock.AddWiFiConnection(self.device, "home_conn", "Home", "wpa-psk")
+        # Also marks the device activated, as NetworkManager would
+        self.mock.AddActiveConnection([self.device], connection, "/", "Home", 2)
+
+        status = self.backend.wifi_status()
+
+        self.assertTrue(status["connected"])
+        self.assertEqual(status["ssid"], "Home")
+
+    def test_connect_activates_and_verifies(self):
+        self.add_access_point("ap_cafe", "Cafe", 70, WPA_PSK)
+
+        ok, message = self.backend.connect("Cafe", "secret123")
+
+        self.assertTrue(ok, message)
+        status = self.backend.wifi_status()
+        self.assertEqual((status["connected"], status["ssid"]), (True, "Cafe"))
+
+    def test_connect_unknown_network(self):
+        self.add_access_point("ap_cafe", "Cafe", 70, WPA_PSK)
+
+        ok, message = self.backend.connect("Elsewhere", "secret123")
+
+        self.assertFalse(ok)
+        self.assertIn("not found", message)
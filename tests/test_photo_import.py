@@ -0,0 +1,68 @@
+import os
+import threading
+import time
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def test_resume_skips_only_verified_copies(app_module, tmp_path):
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    write(usb / "a.jpg", b"first photo")
+
+    name, record, copied = app_module.import_photo(str(usb), "a.jpg", None)
+    assert copied and record["size"] == len(b"first photo")
+    assert os.path.isfile(app_module.photo_index.blob_path(record["sha256"]))
+
+    # Unchanged source: verified by hash and skipped
+    assert app_module.import_photo(str(usb), "a.jpg", record) == (name, record, False)
+
+    # Same size, different content: the record no longer matches, so it is stored again
+    write(usb / "a.jpg", b"other photo")
+    _, changed, copied = app_module.import_photo(str(usb), "a.jpg", record)
+    assert copied and changed["sha256"] != record["sha256"]
+
+def follow_import(client, import_id, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        job = client.get(f"/api/photo-library/import-jobs/{import_id}").get_json()["job"]
+        if job["status"] not in ("queued", "running") or time.monotonic() > deadline:
+            return job
+        time.sleep(0.01)
+
+def test_usb_import_runs_on_the_job_engine_and_resumes(app_module, client, tmp_path, monkeypatch):
+    usb = tmp_path / "usb"
+    usb.mkdir()
+    for name in ("b.jpg", "c.jpg"):
+        write(usb / name, f"photo {name}".encode())
+    monkeypatch.setattr(app_module, "find_usb_mount", lambda: None)
+
+    manifest = app_module.submit_import("Party", ["b.jpg", "c.jpg", "missing.jpg"])
+    paused = follow_import(client, manifest["id"])
+    assert (paused["status"], paused["error"]) == ("paused", "USB drive not found")
+    assert app_module.job_engine.get(paused["job_id"]).kind == app_module.PHOTO_IMPORT_KIND
+
+    monkeypatch.setattr(app_module, "find_usb_mount", lambda: str(usb))
+    assert client.post(f"/api/photo-library/import-jobs/{manifest['id']}/resume").get_json()["success"]
+    done = follow_import(client, manifest["id"])
+    assert (done["status"], done["imported_count"], done["error_count"]) == ("done", 2, 1)
+    engine_job = app_module.job_engine.get(done["job_id"])
+    assert engine_job.status == "done" and engine_job.result["imported_count"] == 2
+
+    # Resuming a finished import is refused; importing stored content again copies nothing
+    assert client.post(f"/api/photo-library/import-jobs/{manifest['id']}/resume").status_code == 409
+    again = follow_import(client, app_module.submit_import("Party", ["b.jpg"])["id"])
+    assert (again["status"], again["imported_count"], again["skipped_count"]) == ("done", 0, 1)
+
+def test_import_cancelled_while_queued_is_recorded(app_module, client):
+    gate = threading.Event()
+    # Hold the import group so the import stays queued
+    app_module.job_engine.submit("test-block", lambda job: gate.wait(5), group=app_module.PHOTO_IMPORT_KIND)
+    try:
+        manifest = app_module.submit_import("Party", ["b.jpg"])
+        assert client.post(f"/api/jobs/{manifest['job_id']}/cancel").status_code == 200
+        job = client.get(f"/api/photo-library/import-jobs/{manifest['id']}").get_json()["job"]
+        assert job["status"] == "cancelled"
+    finally:
+        gate.set()
@@ -0,0 +1,49 @@
+import time
+
+import pytest
+
+@pytest.fixture
+def photo(app_module, tmp_path):
+    src = tmp_path / "move-me.jpg"
+    src.write_bytes(b"photo to move")
+    sha256, size, _ = app_module.photo_index.store_file(str(src))
+    app_module.photo_index.add_photos("Moves", [("move-me.jpg", size, sha256)])
+    yield "move-me.jpg"
+    app_module.photo_index.delete_folder("Moves")
+
+def move(client, photo, new_folder):
+    return client.post("/api/photo-library/manage", json={
+        "action": "move_photo", "photo": photo, "folder": "Moves", "new_folder": new_folder})
+
+@pytest.mark.parametrize("new_folder", [None, "", "   ", "../..", "Moves"])
+def test_move_rejects_a_missing_or_same_destination(app_module, client, photo, new_folder):
+    response = move(client, photo, new_folder)
+
+    assert response.status_code == 400 and response.get_json()["success"] is False
+    assert app_module.photo_index.has_photo("Moves", photo)
+
+def test_move_to_a_new_folder_sanitises_its_name(app_module, client, photo):
+    assert move(client, photo, "../Party Pics").status_code == 200
+
+    assert app_module.photo_index.has_photo("Party_Pics", photo)
+    assert not app_module.photo_index.has_photo("Moves", photo)
+    app_module.photo_index.delete_folder("Party_Pics")
+
+def test_blob_freed_inside_the_grace_period_is_collected_later(app_module, client, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "PHOTO_BLOB_GC_GRACE", 0.5)
+    src = tmp_path / "short-lived.jpg"
+    src.write_bytes(b"deleted right after import")
+    sha256, size, _ = app_module.photo_index.store_file(str(src))
+    app_module.photo_index.add_photos("Brief", [("short-lived.jpg", size, sha256)])
+
+    response = client.post("/api/photo-library/manage", json={
+        "action": "delete_photo", "photo": "short-lived.jpg", "folder": "Brief"})
+    assert response.status_code == 200
+    # Still inside its grace period, so the delete itself leaves it
+    assert app_module.photo_index.has_blob(sha256)
+
+    deadline = time.monotonic() + 5
+    while app_module.photo_index.has_blob(sha256) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert not app_module.photo_index.has_blob(sha256)
+    app_module.photo_index.delete_folder("Brief")
@@ -0,0 +1,134 @@
+import time
+
+import pytest
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+@pytest.fixture
+def controller(app_module):
+    """A controller of its own on an in-memory bank, so its writes can be inspected."""
+    backend = app_module.MockRelayBackend()
+
+    def open_backend(relays):
+        backend.open(relays)
+        return backend
+
+    controller = app_module.RelayController(open_backend)
+    controller.call(app_module.Reconfigure(app_module.config_cache.relays), timeout=5)
+    yield controller, backend
+    controller.call(app_module.AllOff(), timeout=5)
+
+def edges(backend, name, since):
+    return [(at - since, states[name]) for at, states in backend.history if at >= since and name in states]
+
+def test_pulse_repeats_on_the_controller_clock(app_module, controller):
+    controller, backend = controller
+    started = time.monotonic()
+    controller.call(app_module.SetRelays({}, {"Relay 1": app_module.PulseSpec(0.05, 0.05, 3)}), timeout=5)
+
+    assert wait_for(lambda: not controller.snapshot.pulses)
+    seen = edges(backend, "Relay 1", started)
+    assert [on for _, on in seen] == [True, False, True, False, True, False]
+    for (at, _), expected in zip(seen, (0.0, 0.05, 0.1, 0.15, 0.2, 0.25)):
+        assert at == pytest.approx(expected, abs=0.04)
+    assert controller.snapshot.states["Relay 1"] is False
+
+def test_explicit_state_cancels_a_pulse(app_module, controller):
+    controller, backend = controller
+    controller.call(app_module.SetRelays({}, {"Relay 2": app_module.PulseSpec(10.0)}), timeout=5)
+    assert "Relay 2" in controller.snapshot.pulses
+
+    controller.call(app_module.SetRelays({"Relay 2": False}), timeout=5)
+
+    assert controller.snapshot.pulses == {}
+    assert backend.levels["Relay 2"] is False
+
+def test_running_test_refuses_manual_switching_until_stopped(app_module, controller):
+    controller, backend = controller
+    test = controller.submit(app_module.RunTest("time"))
+    assert wait_for(lambda: controller.busy)
+
+    with pytest.raises(app_module.RelayBusy):
+        controller.call(app_module.SetRelays({"Relay 1": True}), timeout=5)
+    with pytest.raises(app_module.RelayBusy):
+        controller.call(app_module.RunTest("self"), timeout=5)
+
+    assert controller.call(app_module.AllOff(), timeout=5) is True
+    with pytest.raises(app_module.RelayAborted):
+        test.result(timeout=5)
+    assert not controller.busy
+    assert not any(backend.levels.values())
+    # Test pages finish on this event instead of polling the test's job
+    ends = [data for _, event, data in app_module.progress_events.history() if event == "test-end"]
+    assert ends[-1] == {"test": "time", "success": False, "result": None}
+
+def test_pour_switches_simultaneous_events_in_one_write(app_module, controller, monkeypatch):
+    controller, backend = controller
+    monkeypatch.setattr(app_module, "get_max_concurrent_relays", lambda: 1)
+    plan = app_module.compile_drink({"concurrent": True, "steps": [
+        {"relay": 1, "action": "on", "time": 0.1}, {"relay": 2, "action": "on", "time": 0.1},
+    ]})._replace(generation=controller.snapshot.generation)
+    started = time.monotonic()
+
+    lateness = controller.call(app_module.RunPlan(plan, "test-drink", None, None), timeout=5)
+
+    assert len(lateness) == 4
+    writes = [states for at, states in backend.history if at >= started]
+    # One pump hands over to the other in a single bank write
+    assert {"Relay 1": False, "Relay 2": True} in writes or {"Relay 2": False, "Relay 1": True} in writes
+    assert not any(backend.levels.values())
+
+def test_test_routes_leave_the_busy_check_to_the_controller(app_module, client):
+    first = client.get("/time-test")
+    assert first.status_code == 202
+    assert app_module.relay_controller.busy
+
+    refused = client.get("/self-test")
+    assert refused.status_code == 409 and refused.get_json()["success"] is False
+
+    app_module.job_engine.cancel(first.get_json()["job_id"])
+    assert wait_for(lambda: not app_module.relay_controller.busy)
+
+def test_reconfigure_keeps_the_old_relays_when_new_outputs_fail(app_module):
+    backend = app_module.MockRelayBackend()
+
+    def open_backend(relays):
+        if "Broken" in relays.names:
+            raise OSError("GPIO busy")
+        backend.open(relays)
+        return backend
+
+    controller = app_module.RelayController(open_backend)
+    controller.call(app_module.Reconfigure(app_module.config_cache.relays), timeout=5)
+    before = controller.snapshot
+    broken = app_module.RelayRegistry([app_module.clean_relay_entry(1, {"name": "Broken", "gpio": 5})])
+
+    with pytest.raises(OSError):
+        controller.call(app_module.Reconfigure(broken), timeout=5)
+
+    assert (controller.snapshot.names, controller.snapshot.generation) == (before.names, before.generation)
+    controller.call(app_module.SetRelays({"Relay 1": True}), timeout=5)
+    assert backend.levels["Relay 1"] is True
+    controller.call(app_module.AllOff(), timeout=5)
+
+def test_relay_config_that_fails_to_open_is_not_saved(app_module, client, monkeypatch):
+    before = app_module.get_relay_config()
+
+    def open_backend(relays):
+        if "Broken" in relays.names:
+            raise OSError("GPIO busy")
+        return app_module.open_relay_backend(relays)
+
+    monkeypatch.setattr(app_module.relay_controller, "open_backend", open_backend)
+    response = client.post("/api/relays", json={"relays": [{"name": "Broken", "gpio": 5}]})
+
+    assert response.status_code == 400 and "GPIO busy" in response.get_json()["error"]
+    assert app_module.get_relay_config() == before
+    assert app_module.relay_controller.snapshot.names == tuple(relay["name"] for relay in before)
+    assert client.get("/toggle-all/off").status_code == 200
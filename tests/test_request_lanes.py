@@ -0,0 +1,71 @@
+import time
+
+from werkzeug.test import create_environ
+
+LANES = {"default": {"workers": 2, "queue": 0, "timeout": 0}}
+
+def streaming_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return iter([b"first", b"second"])
+
+def call(lanes, path="/"):
+    status = []
+    body = lanes(create_environ(path), lambda s, headers: status.append(s))
+    return status[0], body
+
+def test_drain_waits_for_streamed_bodies(app_module):
+    lanes = app_module.RequestLanes(streaming_app, LANES)
+    status, body = call(lanes)
+    assert status == "200 OK"
+    next(iter(body))
+
+    # The view has returned but the body is still being sent
+    assert not lanes.drain(0.05)
+    status, refused = call(lanes)
+    assert status.startswith("503") and b"shutting down" in b"".join(refused)
+
+    body.close()
+    assert lanes.drain(0.05)
+    assert lanes.in_flight == 0
+
+def lane_capacity(app_module, name):
+    lane = app_module.request_lanes.lanes[name]
+    return lane.workers + lane.queue
+
+def test_test_client_requests_do_not_leak_lane_slots(app_module, client):
+    # The test client never closes responses; buffered ones must not hold their slot anyway
+    for path, lane in (("/maintenance", "default"), ("/api/orders", "control")):
+        for _ in range(3 * lane_capacity(app_module, lane)):
+            assert client.get(path).status_code == 200, path
+        assert app_module.request_lanes.lanes[lane].active == 0
+
+def test_streamed_response_holds_its_slot_until_closed(app_module, client):
+    lane = app_module.request_lanes.lanes["stream"]
+    response = client.get("/api/relay-stream", buffered=False)
+    assert response.status_code == 200
+    assert lane.active == 1
+
+    response.close()
+    assert lane.active == 0
+
+def test_full_lane_refuses_without_parking_a_thread(app_module):
+    lanes = app_module.RequestLanes(streaming_app, {"default": app_module.REQUEST_LANE_DEFAULTS["bulk"]})
+    held = [call(lanes)[1] for _ in range(lanes.lanes["default"].workers)]
+
+    started = time.monotonic()
+    status, _ = call(lanes)
+    assert status.startswith("503") and time.monotonic() - started < 0.1
+
+    for body in held:
+        body.close()
+    assert call(lanes)[0] == "200 OK"
+
+def test_server_threads_cover_every_lane_by_default(app_module, monkeypatch):
+    lanes = app_module.request_lanes
+    assert [name for name, lane in lanes.lanes.items() if lane.queue] == ["control"]
+    assert app_module.server_thread_count() == lanes.threads() == 37
+
+    get = app_module.config_cache.get
+    monkeypatch.setattr(app_module.config_cache, "get",
+                        lambda key, default=None: 8 if key == "server_threads" else get(key, default))
+    assert app_module.server_thread_count() == 8
@@ -0,0 +1,17 @@
+def test_precompressed_asset_keeps_its_name(app_module, client):
+    url = app_module.static_assets.url("js/settings.js")
+    assert url != "/static/js/settings.js"
+
+    response = client.get(url, headers={"Accept-Encoding": "gzip"})
+
+    assert response.status_code == 200
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Content-Disposition"] == "inline; filename=settings.js"
+    assert response.headers["Cache-Control"] == app_module.STATIC_IMMUTABLE
+    response.close()
+
+def test_unchanged_asset_revalidates(app_module, client):
+    url = app_module.static_assets.url("js/script.js")
+    etag = client.get(url).headers["ETag"]
+
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
@@ -0,0 +1,21 @@
+import time
+
+def test_rescans_stop_once_the_screen_goes_idle(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "WIFI_SCAN_IDLE_AFTER", 0.2)
+    scanner = app_module.WifiScanner(lambda: (True, []))
+    scanner.interval = lambda: 0.02
+
+    scanner.request_scan()
+    time.sleep(0.1)
+    assert scanner.scans > 1  # the loop rescans while the screen is in use
+
+    time.sleep(0.3)
+    assert scanner._thread is None
+    idle_scans = scanner.scans
+    time.sleep(0.1)
+    assert scanner.scans == idle_scans
+
+    # Coming back to the screen starts the loop again
+    scanner.request_scan()
+    time.sleep(0.1)
+    assert scanner._thread is not None and scanner.scans > idle_scans + 1